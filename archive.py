@@ -0,0 +1,371 @@
+import bisect
+import io
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+ZIP64_LIMIT = 0xFFFFFFFF
+STORED = 0
+DEFLATED = 8
+UTF8_NAMES = 0x800
+READ_SIZE = 1024 * 1024
+
+
+def dos_time(mtime):
+    t = time.localtime(max(mtime, 315532800))  # ZIP dates start in 1980
+    year = min(max(t.tm_year, 1980), 2107)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ArchiveEntry:
+    def __init__(self, path, arcname, stat):
+        self.path = path
+        self.arcname = arcname
+        self.size = stat.st_size
+        self.mode = stat.st_mode
+        self.mtime = stat.st_mtime
+        self.crc = 0
+        self.method = STORED
+        self.compressed_size = stat.st_size  # Bytes of its data in the archive
+        self.offset = 0  # Offset of the local header in the archive
+
+
+class FileHandles:
+    # Open files of a folder read in place, one per file and at most limit
+    # at once, so reading it chunk by chunk does not reopen a file each time
+    def __init__(self, limit=32):
+        self.limit = limit
+        self.files = OrderedDict()  # Map path to its open file, least recently used first
+        self.lock = threading.Lock()
+
+    def read(self, path, offset, length):
+        with self.lock:
+            f = self.files.pop(path, None)
+            if f is None:
+                f = open(path, 'rb')
+                while len(self.files) >= self.limit:
+                    self.files.popitem(last=False)[1].close()
+            self.files[path] = f
+            f.seek(offset)
+            return f.read(length)
+
+
+class FolderArchive:
+    # A ZIP of a folder that is never written to disk. Entries are checked
+    # and compressed in parallel (zlib releases the GIL) to fix the byte
+    # layout, then read() builds any range of the archive on demand, so every
+    # send mode can read it like a file. Deflated entries are compressed
+    # again when read, the same way, and the last ones kept up to
+    # memory_budget; larger or incompressible files are stored and read from
+    # the folder as they are sent.
+    def __init__(self, folder_path, workers=None, memory_budget=64 * 1024 * 1024, compress_limit=16 * 1024 * 1024):
+        folder_path = os.path.abspath(folder_path)
+        self.name = os.path.basename(folder_path) + ".zip"
+        self.memory_budget = memory_budget
+        self.compress_limit = compress_limit  # Files above this are stored
+        self.deflated = OrderedDict()  # Map entry to its deflated data, least recently read first
+        self.memory_used = 0
+        self.lock = threading.Lock()
+        self.handles = FileHandles()
+        folder_name = os.path.basename(folder_path)
+        entries = [ArchiveEntry(path, f"{folder_name}/{relpath}", os.stat(path)) for path, relpath in list_folder(folder_path)]
+        with ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+            list(pool.map(self.prepare, entries))
+        self.entries = entries
+        self.layout()
+
+    def prepare(self, entry):
+        if entry.size > self.compress_limit:
+            with open(entry.path, 'rb') as f:
+                while True:
+                    block = f.read(READ_SIZE)
+                    if not block:
+                        break
+                    entry.crc = zlib.crc32(block, entry.crc)
+            return
+        compressed = self.deflate(entry)
+        if len(compressed) >= entry.size * 0.9:
+            return  # Not worth it, e.g. images or archives
+        entry.method = DEFLATED
+        entry.compressed_size = len(compressed)
+
+    def deflate(self, entry):
+        # Fed in READ_SIZE blocks every time, so the data read back matches
+        # what the layout was built from
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        parts = []
+        crc = size = 0
+        with open(entry.path, 'rb') as f:
+            while True:
+                block = f.read(READ_SIZE)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                parts.append(compressor.compress(block))
+        parts.append(compressor.flush())
+        if entry.method == STORED:
+            entry.crc, entry.size = crc, size
+        return b''.join(parts)
+
+    def layout(self):
+        # segments is a sorted list of (archive offset, bytes or entry)
+        self.segments = []
+        offset = 0
+        central = []
+        for entry in self.entries:
+            entry.offset = offset
+            header = self.local_header(entry)
+            self.segments.append((offset, header))
+            offset += len(header)
+            self.segments.append((offset, entry))
+            offset += entry.compressed_size
+            central.append(self.central_header(entry))
+        directory = b''.join(central)
+        self.segments.append((offset, directory + self.end_records(offset, len(directory))))
+        self.segments = [(start, data) for start, data in self.segments if self.segment_length(data)]
+        self.starts = [start for start, data in self.segments]
+        self.size = offset + len(self.segments[-1][1]) if self.segments else 0
+
+    def segment_length(self, data):
+        return data.compressed_size if isinstance(data, ArchiveEntry) else len(data)
+
+    def local_header(self, entry):
+        name = entry.arcname.encode()
+        time_, date = dos_time(entry.mtime)
+        extra = b''
+        sizes = entry.compressed_size, entry.size
+        if entry.size >= ZIP64_LIMIT or entry.compressed_size >= ZIP64_LIMIT:
+            extra = struct.pack('<HHQQ', 1, 16, entry.size, entry.compressed_size)
+            sizes = ZIP64_LIMIT, ZIP64_LIMIT
+        version = 45 if extra else 20
+        return LOCAL_HEADER.pack(0x04034b50, version, UTF8_NAMES, entry.method, time_, date, entry.crc,
+                                 sizes[0], sizes[1], len(name), len(extra)) + name + extra
+
+    def central_header(self, entry):
+        name = entry.arcname.encode()
+        time_, date = dos_time(entry.mtime)
+        fields = []
+        size, compressed_size, offset = entry.size, entry.compressed_size, entry.offset
+        if size >= ZIP64_LIMIT:
+            fields.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            fields.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = struct.pack('<HH', 1, 8 * len(fields)) + struct.pack(f'<{len(fields)}Q', *fields) if fields else b''
+        version = 45 if extra else 20
+        return CENTRAL_HEADER.pack(0x02014b50, (3 << 8) | version, version, UTF8_NAMES, entry.method, time_, date, entry.crc,
+                                   compressed_size, size, len(name), len(extra), 0, 0, 0, (entry.mode & 0xFFFF) << 16,
+                                   offset) + name + extra
+
+    def end_records(self, directory_offset, directory_size):
+        count = len(self.entries)
+        records = b''
+        if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+            zip64_offset = directory_offset + directory_size
+            records += ZIP64_END_RECORD.pack(0x06064b50, ZIP64_END_RECORD.size - 12, (3 << 8) | 45, 45, 0, 0,
+                                             count, count, directory_size, directory_offset)
+            records += ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_offset, 1)
+            count = min(count, 0xFFFF)
+            directory_offset = min(directory_offset, ZIP64_LIMIT)
+            directory_size = min(directory_size, ZIP64_LIMIT)
+        return records + END_RECORD.pack(0x06054b50, 0, 0, count, count, directory_size, directory_offset, 0)
+
+    def read(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        parts = []
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0 and index < len(self.segments):
+            start, data = self.segments[index]
+            skip = offset - start
+            take = min(length, self.segment_length(data) - skip)
+            if isinstance(data, ArchiveEntry) and data.method == DEFLATED:
+                parts.append(self.read_deflated(data, skip, take))
+            elif isinstance(data, ArchiveEntry):
+                parts.append(self.read_stored(data, skip, take))
+            else:
+                parts.append(data[skip:skip + take])
+            offset += take
+            length -= take
+            index += 1
+        return b''.join(parts)
+
+    def read_stored(self, entry, offset, length):
+        data = self.handles.read(entry.path, offset, length)
+        # A file that shrank since the layout was fixed still fills its slot
+        return data.ljust(length, b'\0')
+
+    def read_deflated(self, entry, offset, length):
+        with self.lock:
+            data = self.deflated.get(entry)
+            if data is not None:
+                self.deflated.move_to_end(entry)
+        if data is None:
+            # A file changed since the layout was fixed still fits its slot
+            data = self.deflate(entry)[:entry.compressed_size].ljust(entry.compressed_size, b'\0')
+            with self.lock:
+                if entry not in self.deflated:
+                    self.deflated[entry] = data
+                    self.memory_used += len(data)
+                while self.memory_used > self.memory_budget and len(self.deflated) > 1:
+                    self.memory_used -= len(self.deflated.popitem(last=False)[1])
+        return data[offset:offset + length]
+
+    def open(self):
+        return ArchiveReader(self)
+
+
+class ArchiveReader(io.RawIOBase):
+    # File object over a FolderArchive or FolderPack, for code that reads inputs as files
+    def __init__(self, archive):
+        self.archive = archive
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.archive.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.archive.read(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def list_folder(folder_path):
+    # (path, path relative to the folder) of every file, in a stable order
+    files = []
+    for root, dirs, names in os.walk(folder_path):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files.append((path, os.path.relpath(path, folder_path).replace(os.sep, '/')))
+    return files
+
+
+class FolderPack:
+    # A folder sent for delta re-sharing. Small files are packed back to
+    # back; a receiver rebuilds a chunk of them from its old copies of the
+    # same files, so an unchanged file keeps its chunks hashing the same even
+    # when files before it changed size. Large files start on a chunk
+    # boundary and are zero padded to one, and come with Adler-32 sums of
+    # their chunks for receivers to find moved data in their old copy (see
+    # delta.py). The file list travels in the manifest's payload. The pack is
+    # not compressed itself; the chunk compressor does that on the way out.
+    def __init__(self, folder_path, chunk_size=64 * 1024, weak_min_size=256 * 1024):
+        folder_path = os.path.abspath(folder_path)
+        self.name = os.path.basename(folder_path) + ".pack"
+        self.chunk_size = chunk_size
+        self.weak_min_size = weak_min_size  # Files from this size on are chunk aligned and searched for moved data
+        self.meta = {'folder': True}
+        self.handles = FileHandles()
+        self.files = []  # (path, relative path, size)
+        self.starts = []
+        offset = 0
+        for path, relpath in list_folder(folder_path):
+            size = os.path.getsize(path)
+            aligned = size >= weak_min_size
+            if aligned:
+                offset = -(-offset // chunk_size) * chunk_size
+            self.files.append((path, relpath, size))
+            self.starts.append(offset)
+            offset += size
+            if aligned:
+                offset = -(-offset // chunk_size) * chunk_size
+        self.size = -(-offset // chunk_size) * chunk_size
+
+    def listing(self):
+        with ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+            weak = list(pool.map(self.weak_sums, self.files))
+        files = [[relpath, size, sums, start] for (path, relpath, size), sums, start in zip(self.files, weak, self.starts)]
+        return zlib.compress(json.dumps({'files': files}, separators=(',', ':')).encode())
+
+    def weak_sums(self, file):
+        path, relpath, size = file
+        if size < self.weak_min_size:
+            return ''
+        sums = []
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(self.chunk_size)
+                if not block:
+                    break
+                sums.append(zlib.adler32(block))
+        return b''.join(struct.pack('!I', value) for value in sums).hex()
+
+    def read(self, offset, length):
+        # Gaps between files read as zeros, as does a file that shrank
+        length = max(0, min(length, self.size - offset))
+        end = offset + length
+        data = bytearray(length)
+        index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while index < len(self.files) and self.starts[index] < end:
+            path, relpath, size = self.files[index]
+            start = self.starts[index]
+            first, last = max(offset, start), min(end, start + size)
+            if first < last:
+                piece = self.handles.read(path, first - start, last - first)
+                data[first - offset:first - offset + len(piece)] = piece
+            index += 1
+        return bytes(data)
+
+    def open(self):
+        return ArchiveReader(self)
+
+
+# Inputs to the send paths are file paths, or FolderArchives and FolderPacks
+# that are read in place
+
+def open_input(source):
+    return open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source.open()
+
+
+def input_size(source):
+    return os.path.getsize(source) if isinstance(source, (str, os.PathLike)) else source.size
+
+
+def input_name(source):
+    return os.path.basename(source) if isinstance(source, (str, os.PathLike)) else source.name
+
+
+def input_chunk_size(source, default):
+    return getattr(source, 'chunk_size', default)
+
+
+def input_meta(source):
+    # Extra metadata sent with every frame of the transfer
+    return getattr(source, 'meta', {})
+
+
+def input_listing(source):
+    # Compressed JSON sent after the hashes in the manifest's payload, whose
+    # keys are added to the transfer metadata on arrival. Unlike frame
+    # metadata it is not capped at MAX_META_SIZE.
+    return source.listing() if hasattr(source, 'listing') else b''
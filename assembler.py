@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+
+
+class ChunkBitmap:
+    def __init__(self, total_chunks, data=None):
+        self.total_chunks = total_chunks
+        if data is None:
+            self.bits = bytearray((total_chunks + 7) // 8)
+        else:
+            if len(data) != (total_chunks + 7) // 8:
+                raise ValueError(f"Bitmap of {len(data)} bytes for {total_chunks} chunks")
+            self.bits = bytearray(data)
+            if total_chunks & 7:
+                self.bits[-1] &= (1 << (total_chunks & 7)) - 1  # Bits past the last chunk are not chunks
+        self.count = sum(bin(b).count('1') for b in self.bits)
+
+    def __contains__(self, chunk_id):
+        return bool(self.bits[chunk_id >> 3] & (1 << (chunk_id & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, chunk_id):
+        if chunk_id in self:
+            return False
+        self.bits[chunk_id >> 3] |= 1 << (chunk_id & 7)
+        self.count += 1
+        return True
+
+    def discard(self, chunk_id):
+        if chunk_id in self:
+            self.bits[chunk_id >> 3] &= ~(1 << (chunk_id & 7))
+            self.count -= 1
+
+    def missing(self):
+        return [i for i in range(self.total_chunks) if i not in self]
+
+    def missing_ranges(self, end=None, max_ranges=None):
+        # (first, count) runs of missing chunk ids below end. Whole bytes that
+        # are all held or all missing are stepped over at once.
+        end = self.total_chunks if end is None else min(end, self.total_chunks)
+        ranges = []
+        start = None
+        i = 0
+        while i < end:
+            if i & 7 == 0 and i + 8 <= end:
+                byte = self.bits[i >> 3]
+                if byte == 0xff and start is None or byte == 0 and start is not None:
+                    i += 8
+                    continue
+            if i in self:
+                if start is not None:
+                    ranges.append((start, i - start))
+                    start = None
+                    if max_ranges and len(ranges) == max_ranges:
+                        return ranges
+            elif start is None:
+                start = i
+            i += 1
+        if start is not None:
+            ranges.append((start, end - start))
+        return ranges
+
+    def is_complete(self):
+        return self.count == self.total_chunks
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+
+class ChunkAssembler:
+    # Writes chunks straight into a preallocated ".part" file at their final
+    # offset, so memory use does not depend on file size or arrival order.
+    # A journal (see journal.TransferJournal) records progress on disk, and
+    # a resumed download passes the bitmap it saved.
+    def __init__(self, file_path, file_size, chunk_size, bitmap=None, journal=None):
+        self.file_path = str(file_path)
+        self.part_path = self.file_path + ".part"
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.total_chunks = max(1, -(-file_size // chunk_size))
+        self.bitmap = bitmap if bitmap is not None else ChunkBitmap(self.total_chunks)
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.finalized = False
+        self.aborted = False  # Set once abort() threw the download away
+        self.last_write = time.monotonic()
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        self.preallocate()
+
+    def preallocate(self):
+        if hasattr(os, 'posix_fallocate') and self.file_size:
+            try:
+                os.posix_fallocate(self.fd, 0, self.file_size)
+                return
+            except OSError:
+                pass  # Filesystem does not support it, fall back to a sparse file
+        os.ftruncate(self.fd, self.file_size)
+
+    def chunk_length(self, chunk_id):
+        return min(self.chunk_size, self.file_size - chunk_id * self.chunk_size)
+
+    def write_chunk(self, chunk_id, data):
+        if not 0 <= chunk_id < self.total_chunks:
+            raise ValueError(f"Chunk {chunk_id} out of range for {self.total_chunks} chunks")
+        if len(data) != self.chunk_length(chunk_id):
+            raise ValueError(f"Chunk {chunk_id} has {len(data)} bytes, expected {self.chunk_length(chunk_id)}")
+        with self.lock:
+            if chunk_id in self.bitmap:
+                return False
+            self.pwrite(data, chunk_id * self.chunk_size)
+            self.bitmap.add(chunk_id)
+            self.last_write = time.monotonic()
+            if self.journal is not None:
+                self.journal.chunk_written(self.bitmap)
+            return True
+
+    def check(self, manifest):
+        # Forgets chunks whose data on disk does not match the manifest, e.g.
+        # after a crash between writing a chunk and saving the bitmap
+        for chunk_id in range(self.total_chunks):
+            if chunk_id in self.bitmap and not manifest.verify(chunk_id, self.pread(self.chunk_length(chunk_id), chunk_id * self.chunk_size)):
+                self.bitmap.discard(chunk_id)
+
+    def read_chunk(self, chunk_id):
+        with self.lock:
+            if chunk_id not in self.bitmap:
+                return None
+            if self.finalized:
+                # Keep serving chunks to other peers from the finished file
+                with open(self.file_path, 'rb') as f:
+                    f.seek(chunk_id * self.chunk_size)
+                    return f.read(self.chunk_length(chunk_id))
+            return self.pread(self.chunk_length(chunk_id), chunk_id * self.chunk_size)
+
+    def pwrite(self, data, offset):
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            while view:
+                view = view[os.write(self.fd, view):]
+
+    def pread(self, length, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, length, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        return os.read(self.fd, length)
+
+    @property
+    def received(self):
+        return len(self.bitmap)
+
+    def is_complete(self):
+        return self.bitmap.is_complete()
+
+    def finalize(self):
+        # Atomically moves the finished file into place. Returns None if
+        # another thread already did.
+        with self.lock:
+            if self.finalized:
+                return None
+            if not self.bitmap.is_complete():
+                raise ValueError(f"{self.bitmap.total_chunks - len(self.bitmap)} chunk(s) still missing")
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            os.replace(self.part_path, self.file_path)
+            self.finalized = True
+            if self.journal is not None:
+                self.journal.remove()
+        return self.file_path
+
+    def abort(self):
+        with self.lock:
+            if self.finalized:
+                return
+            self.aborted = True
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            if self.journal is not None:
+                self.journal.remove()
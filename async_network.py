@@ -0,0 +1,295 @@
+import asyncio
+import math
+import socket
+import threading
+import time
+
+from archive import input_size, open_input
+from broadcast import BroadcastTree
+from compression import CODEC_NONE
+from network import PeerNetwork
+from scheduler import traffic_class
+from transfers import TransferCancelled
+from protocol import FLAG_RELAY, FLAG_REPAIR, HEADER, KIND_CHUNK, KIND_MANIFEST, KIND_MESSAGE, Frame, MetaCache, encode_meta, replace_flags, unpack_header
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, network):
+        self.network = network
+
+    def datagram_received(self, data, addr):
+        try:
+            self.network.handle_discovery(data, addr)
+        except Exception as e:
+            self.network.report_error(f"Error in peer discovery: {str(e)}")
+
+
+class MulticastProtocol(asyncio.DatagramProtocol):
+    def __init__(self, network):
+        self.network = network
+
+    def datagram_received(self, data, addr):
+        # Receivers write to disk, keep that off the event loop
+        future = self.network.loop.run_in_executor(None, self.network.multicast.handle_datagram, data, addr)
+        future.add_done_callback(self.report)
+
+    def report(self, future):
+        if future.exception() is not None:
+            self.network.report_error(f"Error receiving multicast packet: {str(future.exception())}")
+
+
+class PeerStream:
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.last_used = 0.0
+
+
+class AsyncPeerNetwork(PeerNetwork):
+    # Drop-in alternative to PeerNetwork that runs discovery, messaging and
+    # file transfer on a single asyncio event loop instead of one thread per
+    # listener and connection. The blocking methods the panels call are thin
+    # wrappers that schedule coroutines on the loop; the *_async variants can
+    # be awaited directly from code running on it.
+    def __init__(self, port=8080, file_port=8081, on_peer_discovered=None, on_file_chunk_received=None, on_message_received=None):
+        super().__init__(port, file_port, on_peer_discovered, on_file_chunk_received, on_message_received)
+        self.streams = {}  # Map (ip, port) to a long-lived PeerStream
+        self.idle_timeout = self.pool.idle_timeout
+        self.connect_timeout = self.pool.connect_timeout
+        self.servers = []
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def report_error(self, message):
+        if self.on_error:
+            self.on_error(message)
+
+    def start(self, receive_files=True):
+        self.run(self.start_async(receive_files))
+
+    async def start_async(self, receive_files=True):
+        await self.loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), sock=self.socket)
+        handlers = [(self.message_port, self.handle_message_stream)]
+        if receive_files:
+            handlers.append((self.file_port, self.handle_file_stream))
+        for port, handler in handlers:
+            server = await asyncio.start_server(handler, sock=self.listen_socket(port), backlog=self.listen_backlog, limit=2 ** 16)
+            self.servers.append(server)
+        if receive_files:
+            try:
+                await self.loop.create_datagram_endpoint(lambda: MulticastProtocol(self), sock=self.multicast.open_socket())
+            except OSError as e:
+                self.report_error(f"Error joining multicast group: {str(e)}")
+        self.loop.create_task(self.evict_idle_streams())
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        threading.Thread(target=self.messages.run, daemon=True).start()
+
+    def listen_socket(self, port):
+        # Built by hand so SO_RCVBUF is set before listen(), like serve() does
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.receive_buffer:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        s.bind(('', port))
+        s.setblocking(False)
+        return s
+
+    async def read_frames(self, reader):
+        meta_cache = MetaCache()
+        while True:
+            try:
+                header = await asyncio.wait_for(reader.readexactly(HEADER.size), self.read_timeout)
+            except asyncio.TimeoutError:
+                return  # Sender went idle, it reconnects when it has more to send
+            except asyncio.IncompleteReadError as e:
+                if not e.partial:
+                    return
+                raise ConnectionError("Connection closed in the middle of a frame")
+            kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len = unpack_header(header)
+            if session != self.session_id:
+                return  # Another lab's traffic, dropped before reading its payload
+            body = memoryview(await asyncio.wait_for(reader.readexactly(meta_len + payload_len), self.read_timeout))
+            meta = meta_cache.decode(transfer_id, body[:meta_len])
+            yield Frame(kind, flags, codec, transfer_id, seq, total, meta, header + body[:meta_len], body[meta_len:])
+
+    async def send_frame_async(self, peer_ip, port, header, payload=b''):
+        if self.scheduler.limited():
+            # Waiting for tokens blocks, so it happens off the loop
+            await self.loop.run_in_executor(None, self.scheduler.acquire, peer_ip, len(header) + len(payload), traffic_class(header))
+        stream = self.streams.get((peer_ip, port))
+        if stream is None:
+            stream = self.streams[(peer_ip, port)] = PeerStream()
+        async with stream.lock:
+            for attempt in range(2):
+                try:
+                    # Receivers never write back, so EOF means the peer closed the stream
+                    if stream.writer is None or stream.writer.is_closing() or stream.reader.at_eof():
+                        if stream.writer is not None:
+                            stream.writer.close()
+                        stream.reader, stream.writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, port), self.connect_timeout)
+                        if self.pool.send_buffer:
+                            stream.writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.pool.send_buffer)
+                    stream.writer.write(header)
+                    stream.writer.write(payload)
+                    await stream.writer.drain()
+                    stream.last_used = time.monotonic()
+                    return
+                except (OSError, asyncio.TimeoutError):
+                    if stream.writer is not None:
+                        stream.writer.close()
+                        stream.writer = None
+                    if attempt:
+                        raise
+
+    async def evict_idle_streams(self):
+        while True:
+            await asyncio.sleep(max(1, self.idle_timeout / 2))
+            now = time.monotonic()
+            for address, stream in list(self.streams.items()):
+                if not stream.lock.locked() and now - stream.last_used > self.idle_timeout:
+                    if stream.writer is not None:
+                        stream.writer.close()
+                    del self.streams[address]
+
+    def send_message(self, peer_ip, message, sender_name):
+        return self.run(self.send_message_async(peer_ip, message, sender_name))
+
+    async def send_message_async(self, peer_ip, message, sender_name):
+        try:
+            payload = message.encode()
+            header = self.frame_header(KIND_MESSAGE, encode_meta({'sender_name': sender_name}), len(payload))
+            await self.send_frame_async(peer_ip, self.message_port, header, payload)
+            return True
+        except Exception as e:
+            self.report_error(f"Error sending message to {peer_ip}: {str(e)}")
+            return False
+
+    def transmit_messages(self, peer_ip, frames, done=None):
+        # Same contract as PeerNetwork.transmit_messages, as a task on the event loop
+        asyncio.run_coroutine_threadsafe(self.transmit_messages_async(peer_ip, frames, done), self.loop)
+
+    async def transmit_messages_async(self, peer_ip, frames, done):
+        try:
+            for header, payload in frames:
+                await self.send_frame_async(peer_ip, self.message_port, header, payload)
+        except Exception as e:
+            self.mark_unreachable(peer_ip, f"Error sending message to {peer_ip}: {str(e)}")
+        finally:
+            if done:
+                done()
+
+    async def handle_message_stream(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        try:
+            async for frame in self.read_frames(reader):
+                self.messages.handle_frame(frame, addr[0])
+        except Exception as e:
+            self.report_error(f"Error receiving message: {str(e)}")
+        finally:
+            writer.close()
+
+    def send_file_chunks(self, file_path, peers, role, sender_name, on_progress=None, background=False, transfer_id=None):
+        return self.run(self.send_file_chunks_async(file_path, peers, role, sender_name, on_progress, background, transfer_id))
+
+    async def send_file_chunks_async(self, file_path, peers, role, sender_name, on_progress=None, background=False, transfer_id=None):
+        try:
+            recipients = self.plan_recipients([peer[0] for peer in peers], input_size(file_path))
+            # Hashing the file and sending the manifest block, keep them off the loop
+            transfer_id, meta = await self.loop.run_in_executor(None, self.prepare_transfer, file_path, recipients, role, sender_name, background, transfer_id)
+            self.keep_source(transfer_id, file_path)
+            chunk_size = meta['chunk_size']
+            num_chunks = max(1, math.ceil(meta['file_size'] / chunk_size))
+            cached = await self.loop.run_in_executor(None, self.cached_chunks, transfer_id, recipients, meta)
+            meta = encode_meta(meta)
+            with open_input(file_path) as f:
+                def load(chunk_id):
+                    chunk = f.read(chunk_size)
+                    if chunk_id in cached:
+                        return CODEC_NONE, None
+                    return self.compressor.compress(chunk) if self.compressor is not None else (CODEC_NONE, chunk)
+
+                # Disk reads and compression go to the default executor, one
+                # chunk ahead, so the loop keeps sending and serving other streams
+                loading = self.loop.run_in_executor(None, load, 0)
+                for i in range(num_chunks):
+                    codec, payload = await loading
+                    if i + 1 < num_chunks:
+                        loading = self.loop.run_in_executor(None, load, i + 1)
+                    if payload is not None:
+                        header = self.frame_header(KIND_CHUNK, meta, len(payload), transfer_id, i, num_chunks, FLAG_RELAY, codec)
+                        started = time.monotonic()
+                        await self.send_to_relay_async(recipients, i, header, payload)
+                        self.record_send(transfer_id, len(header) + len(payload), time.monotonic() - started)
+                    if on_progress:
+                        # The transfer manager pauses by blocking in the
+                        # callback, which must not happen on the loop
+                        await self.loop.run_in_executor(None, on_progress, i + 1, num_chunks, ((i + 1) / num_chunks) * 100)
+            await self.loop.run_in_executor(None, self.report_sent, transfer_id, recipients, num_chunks)
+            return True
+        except TransferCancelled:
+            self.drop_transfer(transfer_id)
+            return False
+        except Exception as e:
+            self.report_error(f"Error sending file chunks: {str(e)}")
+            return False
+
+    async def send_to_relay_async(self, recipients, chunk_id, header, chunk):
+        for n in range(len(recipients)):
+            peer_ip = recipients[(chunk_id + n) % len(recipients)]
+            if self.is_unreachable(peer_ip):
+                continue
+            try:
+                await self.send_frame_async(peer_ip, self.file_port, header, chunk)
+                return peer_ip
+            except Exception as e:
+                self.mark_unreachable(peer_ip, f"Error sending chunk to {peer_ip}: {str(e)}")
+        raise ConnectionError(f"No reachable peer for chunk {chunk_id}")
+
+    async def handle_file_stream(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        own_ip = writer.get_extra_info('sockname')[0]
+        try:
+            async for frame in self.read_frames(reader):
+                if frame.kind == KIND_MANIFEST:
+                    await self.loop.run_in_executor(None, self.on_manifest, frame, addr[0])
+                    continue
+                swarm = self.swarms.get(frame.transfer_id)
+                if swarm is not None or frame.kind != KIND_CHUNK:
+                    # Swarm state is shared with the threaded engine, it only
+                    # queues work and never blocks on the network
+                    await self.loop.run_in_executor(None, self.handle_swarm_frame, swarm, frame, own_ip, addr[0])
+                    continue
+                # Hashing and disk writes happen off the event loop
+                if not await self.loop.run_in_executor(None, self.deliver_chunk, frame, addr[0]):
+                    continue
+                if frame.flags & FLAG_RELAY:
+                    await self.relay_chunk_async(frame, own_ip, addr[0])
+                elif 'fanout' in frame.meta and not frame.flags & FLAG_REPAIR:
+                    await self.forward_to_children_async(frame, own_ip)
+        except Exception as e:
+            self.report_error(f"Error receiving chunk: {str(e)}")
+        finally:
+            writer.close()
+
+    async def relay_chunk_async(self, frame, own_ip, source_ip):
+        header = replace_flags(frame.raw_header, frame.flags & ~FLAG_RELAY)
+        await self.forward_async(self.relay_targets(frame, own_ip, source_ip), header, frame.payload)
+
+    async def forward_to_children_async(self, frame, own_ip):
+        # Tree mode is store-and-forward on this engine: the stream reader
+        # hands over whole frames, so a chunk is passed on once it has fully
+        # arrived rather than while it is still being received
+        tree = BroadcastTree(frame.meta.get('recipients', []), frame.meta['fanout'])
+        await self.forward_async(tree.children(own_ip, self.is_unreachable), frame.raw_header, frame.payload)
+
+    async def forward_async(self, targets, header, payload):
+        results = await asyncio.gather(
+            *(self.send_frame_async(peer_ip, self.file_port, header, payload) for peer_ip in targets),
+            return_exceptions=True)
+        for peer_ip, result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.mark_unreachable(peer_ip, f"Error forwarding chunk to {peer_ip}: {str(result)}")
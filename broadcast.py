@@ -0,0 +1,92 @@
+from scheduler import traffic_class
+
+
+class BroadcastTree:
+    # Arranges the recipients of a transfer into a k-ary tree in heap order:
+    # the sender feeds recipients[0] and the node at index i forwards to the
+    # nodes at i*k+1 .. i*k+k. A fanout of 1 gives a chain.
+    def __init__(self, recipients, fanout):
+        self.recipients = list(recipients)
+        self.fanout = max(1, fanout)
+        self.index = {peer_ip: i for i, peer_ip in enumerate(self.recipients)}
+
+    def child_indexes(self, i):
+        first = i * self.fanout + 1
+        return range(first, min(first + self.fanout, len(self.recipients)))
+
+    def children(self, peer_ip, is_unreachable=None):
+        # Children of peer_ip, or of the sender when peer_ip is None. An
+        # unreachable child is replaced by its own children so its subtree
+        # is still served.
+        if peer_ip is None:
+            pending = [0] if self.recipients else []
+        elif peer_ip in self.index:
+            pending = list(self.child_indexes(self.index[peer_ip]))
+        else:
+            return []
+        children = []
+        while pending:
+            i = pending.pop(0)
+            child = self.recipients[i]
+            if is_unreachable is not None and is_unreachable(child):
+                pending.extend(self.child_indexes(i))
+            else:
+                children.append(child)
+        return children
+
+
+class CutThroughForwarder:
+    # Sink for FrameReader.read_frame that forwards a frame to this peer's
+    # children piece by piece while it is still being received. A child that
+    # fails is replaced by its own children, which are first sent what the
+    # frame carried so far; the pieces are views into the reader's buffer,
+    # which stays untouched until the frame is complete.
+    def __init__(self, network, tree, own_ip, raw_header):
+        self.network = network
+        self.tree = tree
+        self.pieces = [raw_header]
+        self.priority = traffic_class(raw_header)
+        self.connections = {}
+        self.add_children(tree.children(own_ip, network.is_unreachable))
+
+    def __bool__(self):
+        return bool(self.connections)
+
+    def add_children(self, children):
+        pending = list(children)
+        while pending:
+            peer_ip = pending.pop(0)
+            conn = None
+            try:
+                conn = self.network.pool.acquire((peer_ip, self.network.file_port))
+                for piece in self.pieces:
+                    conn.sock.sendall(piece)
+                self.connections[peer_ip] = conn
+            except OSError as e:
+                if conn is not None:
+                    self.network.pool.release(conn, failed=True)
+                self.network.mark_unreachable(peer_ip, f"Error forwarding chunk to {peer_ip}: {str(e)}")
+                pending.extend(self.tree.children(peer_ip, self.network.is_unreachable))
+
+    def write(self, data):
+        self.pieces.append(data)
+        failed = []
+        for peer_ip, conn in list(self.connections.items()):
+            try:
+                self.network.scheduler.acquire(peer_ip, len(data), self.priority)
+                conn.sock.sendall(data)
+            except OSError as e:
+                del self.connections[peer_ip]
+                self.network.pool.release(conn, failed=True)
+                self.network.mark_unreachable(peer_ip, f"Error forwarding chunk to {peer_ip}: {str(e)}")
+                failed.append(peer_ip)
+        for peer_ip in failed:
+            self.add_children(self.tree.children(peer_ip, self.network.is_unreachable))
+
+    def close(self, failed=False):
+        # On failure the children only got part of the frame, so their
+        # connections are dropped rather than reused
+        for conn in self.connections.values():
+            self.network.pool.release(conn, failed)
+        self.connections = {}
+        self.pieces = []
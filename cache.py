@@ -0,0 +1,85 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+class ChunkCache:
+    # Content-addressed store of received chunks, one file per SHA-256, kept
+    # under max_size by evicting the least recently used chunks. When a file
+    # is shared again, the chunks found here are not sent over the network.
+    def __init__(self, directory, max_size=2 * 1024 ** 3):
+        self.directory = str(directory)
+        self.max_size = max_size
+        self.entries = OrderedDict()  # Map hex digest to size, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        # File modification times carry the LRU order across restarts
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+        self.evict()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __contains__(self, digest):
+        return digest.hex() in self.entries
+
+    def get(self, digest):
+        name = digest.hex()
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+        try:
+            with open(self.path(name), 'rb') as f:
+                data = f.read()
+            os.utime(self.path(name))
+        except OSError:
+            data = None
+        if data is None or hashlib.sha256(data).digest() != digest:
+            self.remove(name)  # Missing or damaged on disk
+            return None
+        return data
+
+    def put(self, digest, data):
+        name = digest.hex()
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return
+        temp_path = self.path(name) + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path(name))
+        with self.lock:
+            if name not in self.entries:
+                self.entries[name] = len(data)
+                self.size += len(data)
+        self.evict()
+
+    def remove(self, name):
+        with self.lock:
+            size = self.entries.pop(name, None)
+            if size is None:
+                return
+            self.size -= size
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.size <= self.max_size or not self.entries:
+                    return
+                name = next(iter(self.entries))
+            self.remove(name)
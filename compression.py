@@ -0,0 +1,131 @@
+import lzma
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Codec of a chunk frame's payload, recorded in the frame header so relays
+# pass compressed chunks on as they are and only the receiver decodes them
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+# (codec, level) choices, cheapest first. zlib and lzma release the GIL,
+# so chunks compress in parallel on the worker pool.
+OPTIONS = [(CODEC_ZLIB, 1), (CODEC_ZLIB, 6), (CODEC_LZMA, 0)]
+# Starting guesses until measured: input bytes per second of one core, and
+# output size relative to zlib level 1
+DEFAULT_SPEEDS = {(CODEC_ZLIB, 1): 60e6, (CODEC_ZLIB, 6): 20e6, (CODEC_LZMA, 0): 8e6}
+DEFAULT_GAINS = {(CODEC_ZLIB, 1): 1.0, (CODEC_ZLIB, 6): 0.9, (CODEC_LZMA, 0): 0.8}
+
+
+def compress(codec, level, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+def decode_chunk(codec, payload, max_size):
+    # Never inflates past max_size, so a bad frame cannot exhaust memory
+    if codec == CODEC_NONE:
+        return payload
+    if codec == CODEC_ZLIB:
+        decoder = zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        decoder = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown chunk codec {codec}")
+    data = decoder.decompress(payload, max_size + 1)
+    if len(data) > max_size:
+        raise ValueError(f"Compressed chunk inflates past {max_size} bytes")
+    return data
+
+
+class ChunkCompressor:
+    # Compresses chunks only when it pays off. A few slices of each chunk are
+    # test-compressed first, so video, images and archives go out untouched.
+    # Otherwise the option with the best expected throughput is used, from
+    # the measured link rate, each option's measured speed and its measured
+    # size relative to zlib level 1: compressed data moves at
+    # min(link rate / ratio, speed * workers).
+    def __init__(self, workers=None, window=4, sample_size=4096, min_saving=0.1):
+        self.workers = workers or os.cpu_count() or 1
+        self.window = window  # Chunks compressed ahead of the one being sent
+        self.sample_size = sample_size
+        self.min_saving = min_saving  # Fraction of a chunk compression has to save to be used
+        self.link_rate = None  # Bytes per second the sends have been moving
+        self.speeds = dict(DEFAULT_SPEEDS)
+        self.gains = dict(DEFAULT_GAINS)
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def record_send(self, size, seconds):
+        if seconds > 0:
+            with self.lock:
+                rate = size / seconds
+                self.link_rate = rate if self.link_rate is None else 0.8 * self.link_rate + 0.2 * rate
+
+    def choose(self, data):
+        # Returns the (codec, level) to use for data, or None to send it raw
+        if len(data) < 2 * self.sample_size:
+            sample = bytes(data)
+        else:
+            middle = len(data) // 2 - self.sample_size // 2
+            sample = bytes(data[:self.sample_size]) + bytes(data[middle:middle + self.sample_size]) + bytes(data[-self.sample_size:])
+        if not sample:
+            return None
+        ratio = len(zlib.compress(sample, 1)) / len(sample)
+        if ratio > 1 - self.min_saving:
+            return None
+        with self.lock:
+            if self.link_rate is None:
+                return OPTIONS[0]
+            best, best_rate = None, self.link_rate
+            for option in OPTIONS:
+                rate = min(self.link_rate / (ratio * self.gains[option]), self.speeds[option] * self.workers)
+                if rate > best_rate * 1.05:  # Only pay for more CPU when it clearly helps
+                    best, best_rate = option, rate
+            return best
+
+    def compress(self, data):
+        # Returns (codec, payload)
+        option = self.choose(data)
+        if option is None:
+            return CODEC_NONE, data
+        started = time.thread_time()
+        payload = compress(option[0], option[1], data)
+        elapsed = time.thread_time() - started
+        with self.lock:
+            if elapsed > 0:
+                self.speeds[option] = 0.8 * self.speeds[option] + 0.2 * len(data) / elapsed
+            if option != OPTIONS[0]:
+                baseline = len(zlib.compress(data[:self.sample_size], 1)) or 1
+                sampled = len(compress(option[0], option[1], data[:self.sample_size])) or 1
+                self.gains[option] = 0.8 * self.gains[option] + 0.2 * min(1.0, sampled / baseline)
+        if len(payload) > len(data) * (1 - self.min_saving):
+            return CODEC_NONE, data
+        return option[0], payload
+
+    def encode(self, chunks, skip=()):
+        # Compresses (chunk id, data) pairs up to window chunks ahead on the
+        # worker pool and yields (chunk id, codec, payload) in order. Chunks
+        # in skip are not compressed and come out with a payload of None.
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(self.workers)
+        pending = deque()
+        for chunk_id, data in chunks:
+            pending.append((chunk_id, None if chunk_id in skip else self.pool.submit(self.compress, data)))
+            if len(pending) > self.window:
+                yield self.result(pending.popleft())
+        while pending:
+            yield self.result(pending.popleft())
+
+    def result(self, item):
+        chunk_id, future = item
+        if future is None:
+            return chunk_id, CODEC_NONE, None
+        return (chunk_id,) + future.result()
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+from functools import partial
+
+ADLER_MOD = 65521
+UNPACKED_LIST = ".unpacked_files"  # Kept in a received folder: the files its last pack listed
+
+
+def pack_entries(meta):
+    # (relative path, size, weak sums, offset in the pack) of every file in
+    # a FolderPack. Files with weak sums start on a chunk boundary.
+    return [tuple(entry) for entry in meta['files']]
+
+
+def local_path(folder_path, relpath):
+    path = os.path.normpath(os.path.join(folder_path, relpath))
+    if os.path.isabs(relpath) or not path.startswith(os.path.normpath(folder_path) + os.sep):
+        raise ValueError(f"Refusing to write outside the folder: {relpath}")
+    return path
+
+
+def read_block(path, offset, length, chunk_size):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length).ljust(chunk_size, b'\0')
+    except OSError:
+        return None
+
+
+def read_pieces(pieces, chunk_size):
+    # Builds a chunk of packed small files from (path, file offset, length,
+    # chunk offset) pieces; the rest of the chunk is zeros
+    chunk = bytearray(chunk_size)
+    try:
+        for path, offset, length, start in pieces:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            if len(data) != length:
+                return None
+            chunk[start:start + length] = data
+    except OSError:
+        return None
+    return bytes(chunk)
+
+
+def find_block(data, length, weak, strong, chunk_size):
+    # Rolls an Adler-32 window over data, checking SHA-256 only where the
+    # weak sum matches. Returns the offset of the block or -1.
+    if len(data) < length:
+        return -1
+    value = zlib.adler32(data[:length])
+    a, b = value & 0xffff, value >> 16
+    last = len(data) - length
+    i = 0
+    while True:
+        if (b << 16 | a) == weak and hashlib.sha256(data[i:i + length].ljust(chunk_size, b'\0')).digest() == strong:
+            return i
+        if i == last:
+            return -1
+        out, new = data[i], data[i + length]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - length * out + a - 1) % ADLER_MOD
+        i += 1
+
+
+class FolderDelta:
+    # Works out which chunks of a FolderPack a receiver can build from its
+    # copy of the previous version of the folder. A chunk of packed small
+    # files is rebuilt from the old files at the same paths and kept if it
+    # hashes right. Large files are compared with the old file chunk by
+    # chunk in place, and a chunk that is not in place is looked for within
+    # search_window bytes around it (rsync style), which finds data moved
+    # by an insertion or deletion and carries the shift on to the next
+    # chunks.
+    def __init__(self, search_window=256 * 1024, max_searches=16):
+        self.search_window = search_window
+        self.max_searches = max_searches  # Per file, bounds the time spent on a rewritten file
+
+    def local_chunks(self, manifest, folder_path):
+        # Map chunk id to a function that reads it from the old folder
+        found = {}
+        if not os.path.isdir(folder_path):
+            return found
+        chunk_size = manifest.chunk_size
+        packed = {}  # Map chunk id to the pieces of small files it holds
+        for relpath, size, weak, offset in pack_entries(manifest.meta):
+            try:
+                path = local_path(folder_path, relpath)
+                if not size or not os.path.isfile(path) or not os.path.getsize(path):
+                    continue
+                if not weak:
+                    for chunk_id in range(offset // chunk_size, (offset + size - 1) // chunk_size + 1):
+                        first, last = max(offset, chunk_id * chunk_size), min(offset + size, (chunk_id + 1) * chunk_size)
+                        packed.setdefault(chunk_id, []).append((path, first - offset, last - first, first - chunk_id * chunk_size))
+                    continue
+                for chunk_id, (old_offset, length) in self.match_file(manifest, path, size, weak, offset // chunk_size).items():
+                    found[chunk_id] = partial(read_block, path, old_offset, length, chunk_size)
+            except (OSError, ValueError):
+                continue  # Fetch this file in full
+        for chunk_id, pieces in packed.items():
+            chunk = read_pieces(pieces, chunk_size)
+            if chunk is not None and hashlib.sha256(chunk).digest() == manifest.chunk_hash(chunk_id):
+                found[chunk_id] = partial(read_pieces, pieces, chunk_size)
+        return found
+
+    def match_file(self, manifest, path, size, weak, first):
+        chunk_size = manifest.chunk_size
+        weak_sums = [value for value, in struct.iter_unpack('!I', bytes.fromhex(weak))] if weak else None
+        found = {}
+        shift = 0
+        searches = 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as old:
+            for i in range(-(-size // chunk_size)):
+                length = min(chunk_size, size - i * chunk_size)
+                strong = manifest.chunk_hash(first + i)
+                offset = i * chunk_size + shift
+                if 0 <= offset and offset + length <= len(old) and \
+                        hashlib.sha256(old[offset:offset + length].ljust(chunk_size, b'\0')).digest() == strong:
+                    found[first + i] = (offset, length)
+                    continue
+                if weak_sums is None or length != chunk_size or searches >= self.max_searches:
+                    continue
+                searches += 1
+                start = max(0, offset - self.search_window)
+                position = find_block(old[start:offset + self.search_window + length], length, weak_sums[i], strong, chunk_size)
+                if position >= 0:
+                    found[first + i] = (start + position, length)
+                    shift = start + position - i * chunk_size
+        return found
+
+
+def unpack_folder(pack_path, meta, folder_path):
+    # Writes the files of a received FolderPack into folder_path. Files the
+    # previous pack listed and this one does not were deleted by the sender
+    # and are removed; files it never listed are left alone.
+    entries = pack_entries(meta)
+    with open(pack_path, 'rb') as pack:
+        for relpath, size, weak, offset in entries:
+            path = local_path(folder_path, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            pack.seek(offset)
+            temp_path = path + ".tmp"
+            with open(temp_path, 'wb') as f:
+                remaining = size
+                while remaining:
+                    data = pack.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise ValueError(f"Pack ends inside {relpath}")
+                    f.write(data)
+                    remaining -= len(data)
+            os.replace(temp_path, path)
+    listed = [relpath for relpath, size, weak, offset in entries]
+    record = os.path.join(folder_path, UNPACKED_LIST)
+    try:
+        with open(record) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = []
+    for relpath in set(previous) - set(listed):
+        path = local_path(folder_path, relpath)
+        try:
+            os.remove(path)
+            # Directories left empty go too
+            path = os.path.dirname(path)
+            while path != os.path.normpath(folder_path) and not os.listdir(path):
+                os.rmdir(path)
+                path = os.path.dirname(path)
+        except OSError:
+            pass
+    os.makedirs(folder_path, exist_ok=True)
+    with open(record, 'w') as f:
+        json.dump(listed, f)
@@ -0,0 +1,96 @@
+# Systematic Reed-Solomon erasure code over GF(256). A block of k source
+# packets gets r repair packets, and any k of the k + r rebuild the block.
+# Rows of the code are Cauchy rows, so every k x k submatrix is invertible.
+# Packets are multiplied with bytes.translate and added with one big-int
+# XOR, which keeps the per-byte work in C.
+
+EXP = [0] * 512
+LOG = [0] * 256
+value = 1
+for power in range(255):
+    EXP[power] = value
+    LOG[value] = power
+    value <<= 1
+    if value & 0x100:
+        value ^= 0x11d
+for power in range(255, 512):
+    EXP[power] = EXP[power - 255]
+del value, power
+
+MUL_TABLES = {}
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    return EXP[255 - LOG[a]]
+
+
+def mul_table(c):
+    table = MUL_TABLES.get(c)
+    if table is None:
+        table = MUL_TABLES[c] = bytes(gf_mul(c, x) for x in range(256))
+    return table
+
+
+def combine(coefficients, packets, length):
+    # Sum of coefficient * packet over GF(256)
+    acc = 0
+    for c, packet in zip(coefficients, packets):
+        if c == 1:
+            acc ^= int.from_bytes(packet, 'little')
+        elif c:
+            acc ^= int.from_bytes(bytes(packet).translate(mul_table(c)), 'little')
+    return acc.to_bytes(length, 'little')
+
+
+class BlockCode:
+    def __init__(self, k, r):
+        if not 0 < k or not 0 <= r or k + r > 256:
+            raise ValueError(f"Unsupported block code ({k} source, {r} repair packets)")
+        self.k = k
+        self.r = r
+
+    def row(self, index):
+        # Generator row of packet index: source packets are sent as they are
+        if index < self.k:
+            return [1 if i == index else 0 for i in range(self.k)]
+        x = self.k + (index - self.k)
+        return [gf_inv(x ^ i) for i in range(self.k)]
+
+    def encode(self, sources, length):
+        # sources are k packets of at most length bytes, shorter ones are zero padded
+        sources = [bytes(packet).ljust(length, b'\0') for packet in sources]
+        return [combine(self.row(self.k + j), sources, length) for j in range(self.r)]
+
+    def decode(self, packets, length):
+        # packets maps packet index to its data for at least k indexes.
+        # Returns the missing source packets as a map of index to data.
+        indexes = sorted(packets)[:self.k]
+        if len(indexes) < self.k:
+            raise ValueError(f"Need {self.k} packets to decode, got {len(indexes)}")
+        missing = [i for i in range(self.k) if i not in packets]
+        if not missing:
+            return {}
+        inverse = self.invert([self.row(i) for i in indexes])
+        symbols = [bytes(packets[i]).ljust(length, b'\0') for i in indexes]
+        return {i: combine(inverse[i], symbols, length) for i in missing}
+
+    def invert(self, matrix):
+        # Gauss-Jordan elimination over GF(256)
+        n = len(matrix)
+        rows = [row[:] + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+        for col in range(n):
+            pivot = next(i for i in range(col, n) if rows[i][col])
+            rows[col], rows[pivot] = rows[pivot], rows[col]
+            scale = gf_inv(rows[col][col])
+            rows[col] = [gf_mul(scale, x) for x in rows[col]]
+            for i in range(n):
+                factor = rows[i][col]
+                if i != col and factor:
+                    rows[i] = [x ^ gf_mul(factor, y) for x, y in zip(rows[i], rows[col])]
+        return [row[n:] for row in rows]
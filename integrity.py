@@ -0,0 +1,88 @@
+import hashlib
+import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from archive import input_size, open_input
+
+HASH_SIZE = hashlib.sha256().digest_size
+
+
+def merkle_root(hashes):
+    level = list(hashes) or [hashlib.sha256(b'').digest()]
+    while len(level) > 1:
+        paired = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])  # An odd node moves up unchanged
+        level = paired
+    return level[0]
+
+
+class Manifest:
+    # SHA-256 of every chunk of a file plus their Merkle root. The root goes
+    # into the transfer metadata, so a receiver can check the hash list it
+    # was sent before trusting it to verify chunks.
+    def __init__(self, file_size, chunk_size, hashes):
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.total_chunks = max(1, math.ceil(file_size / chunk_size))
+        self.hashes = bytes(hashes)
+        if len(self.hashes) != self.total_chunks * HASH_SIZE:
+            raise ValueError(f"Manifest has {len(self.hashes) // HASH_SIZE} hashes, expected {self.total_chunks}")
+        self.root = merkle_root(self.chunk_hash(i) for i in range(self.total_chunks))
+        self.meta = None  # Transfer metadata the manifest arrived with
+        self.origin = None  # IP of the peer that sent it, asked again for bad chunks
+
+    @classmethod
+    def from_file(cls, file_path, chunk_size, workers=4):
+        # hashlib releases the GIL on large buffers, so chunks hash in parallel
+        file_size = input_size(file_path)
+
+        def digest(chunk_id):
+            with open_input(file_path) as f:
+                f.seek(chunk_id * chunk_size)
+                return hashlib.sha256(f.read(chunk_size)).digest()
+
+        total_chunks = max(1, math.ceil(file_size / chunk_size))
+        with ThreadPoolExecutor(workers) as pool:
+            return cls(file_size, chunk_size, b''.join(pool.map(digest, range(total_chunks))))
+
+    def chunk_hash(self, chunk_id):
+        return self.hashes[chunk_id * HASH_SIZE:(chunk_id + 1) * HASH_SIZE]
+
+    def verify(self, chunk_id, data):
+        return 0 <= chunk_id < self.total_chunks and hashlib.sha256(data).digest() == self.chunk_hash(chunk_id)
+
+
+class VerifyQueue:
+    # Hashes and delivers one connection's chunks on a helper thread, so the
+    # reader goes back to receiving while the last chunk is checked. Each
+    # connection has its own, so a chunk never waits behind another
+    # connection's work, and the queue is short so memory stays bounded.
+    def __init__(self, network, window=2):
+        self.network = network
+        self.jobs = queue.Queue(maxsize=window)
+        self.thread = None
+
+    def submit(self, fn, *args):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+        self.jobs.put((fn, args))
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                if self.network.on_error:
+                    self.network.on_error(f"Error handling received chunk: {str(e)}")
@@ -0,0 +1,67 @@
+import json
+import os
+import time
+
+from assembler import ChunkBitmap
+from integrity import Manifest
+
+
+def write_atomic(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class TransferJournal:
+    # Keeps what a download needs to survive a restart next to its ".part"
+    # file: the transfer's manifest, and a bitmap of the chunks written so
+    # far. The bitmap is saved every few seconds rather than per chunk; on
+    # resume the chunks it lists are checked against the manifest, so a
+    # stale save costs a re-fetch, never a corrupt file.
+    def __init__(self, part_path):
+        self.path = str(part_path) + ".journal"
+        self.bitmap_path = str(part_path) + ".bitmap"
+        self.save_interval = 2  # Seconds between bitmap saves
+        self.last_save = 0.0
+
+    def start(self, transfer_id, manifest):
+        write_atomic(self.path, json.dumps({
+            'transfer_id': transfer_id,
+            'origin': manifest.origin,
+            'meta': manifest.meta,
+            'hashes': manifest.hashes.hex()
+        }).encode())
+
+    def chunk_written(self, bitmap):
+        now = time.monotonic()
+        if now - self.last_save >= self.save_interval and not bitmap.is_complete():
+            write_atomic(self.bitmap_path, bitmap.to_bytes())
+            self.last_save = now
+
+    def remove(self):
+        for path in (self.path, self.bitmap_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def load(path):
+        # Returns the transfer id, manifest and saved bitmap of a journal file
+        with open(path, 'rb') as f:
+            state = json.loads(f.read().decode())
+        meta = state['meta']
+        manifest = Manifest(meta['file_size'], meta['chunk_size'], bytes.fromhex(state['hashes']))
+        manifest.meta = meta
+        manifest.origin = state['origin']
+        bitmap = ChunkBitmap(manifest.total_chunks)
+        bitmap_path = path[:-len(".journal")] + ".bitmap"
+        if os.path.exists(bitmap_path):
+            with open(bitmap_path, 'rb') as f:
+                data = f.read()
+            try:
+                bitmap = ChunkBitmap(manifest.total_chunks, data)
+            except ValueError:
+                pass  # Torn write, start over from an empty bitmap
+        return state['transfer_id'], manifest, bitmap
@@ -8,6 +8,7 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
 from PyQt5.QtCore import Qt, QTimer, QSize
 from PyQt5.QtGui import QPixmap, QIcon, QFont, QColor, QPalette, QLinearGradient
 from network import PeerNetwork
+from async_network import AsyncPeerNetwork
 from student import StudentPanel
 from teacher import TeacherPanel
 from admin import AdminPanel
@@ -210,6 +211,18 @@ class MainWindow(QMainWindow):
         self.network = None
         self.current_user = {"role": None, "name": None, "username": None}
     
+    def create_network(self):
+        """Create the networking engine, GEHU_P2P_ENGINE=asyncio selects the asyncio one"""
+        if os.environ.get("GEHU_P2P_ENGINE", "").lower() == "asyncio":
+            network = AsyncPeerNetwork()
+        else:
+            network = PeerNetwork()
+        try:
+            network.scheduler.load("data/traffic.json")  # Bandwidth limits, set from the teacher panel
+        except Exception as e:
+            print(f"Failed to load bandwidth limits: {e}")
+        return network
+
     def create_welcome_screen(self):
         """Create the welcome screen with role selection"""
         widget = QWidget()
@@ -448,7 +461,7 @@ class MainWindow(QMainWindow):
         if role == "student":
             # Initialize network for student if not already initialized
             if not self.network:
-                self.network = PeerNetwork()
+                self.network = self.create_network()
                 
             panel = StudentPanel(self.network, name, username)
             self.panel_layout.addWidget(panel)
@@ -456,7 +469,7 @@ class MainWindow(QMainWindow):
         elif role == "teacher":
             # Initialize network for teacher if not already initialized
             if not self.network:
-                self.network = PeerNetwork()
+                self.network = self.create_network()
                 
             panel = TeacherPanel(self.network, name, username)
             self.panel_layout.addWidget(panel)
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import OrderedDict
+
+from protocol import KIND_ACK, KIND_MESSAGE, encode_meta
+
+
+class OutgoingMessage:
+    __slots__ = ('seq', 'payload', 'sender_name', 'on_result', 'first_sent', 'last_sent')
+
+    def __init__(self, seq, payload, sender_name, on_result, now):
+        self.seq = seq
+        self.payload = payload
+        self.sender_name = sender_name
+        self.on_result = on_result
+        self.first_sent = now
+        self.last_sent = now
+
+
+class Outbox:
+    # Messages to one peer that it has not acknowledged yet, oldest first
+    def __init__(self):
+        self.next_seq = 0
+        self.pending = OrderedDict()
+        self.resending = False  # A retransmission to this peer is still on its way
+
+
+class Inbox:
+    # Receive state of one sender: the next sequence number to deliver and
+    # the messages that arrived ahead of it
+    def __init__(self, expected):
+        self.expected = expected
+        self.held = {}
+
+
+class MessageBus:
+    # Reliable, ordered messages over the pooled message connections. Each
+    # message to a peer gets the next sequence number of that peer, and
+    # stays queued until the peer acknowledges it or message_timeout runs
+    # out, being re-sent every retransmit_timeout meanwhile. Receivers hold
+    # back messages that arrive ahead of a gap, drop duplicates and answer
+    # with one cumulative ack per sender every ack_delay, however many
+    # messages came in. Every frame also carries the oldest sequence number
+    # the sender still retransmits, so receivers skip messages it gave up on.
+    def __init__(self, network, ack_delay=0.02, retransmit_timeout=1.0, message_timeout=10, max_holdback=256, max_senders=1024):
+        self.network = network
+        self.ack_delay = ack_delay
+        self.retransmit_timeout = retransmit_timeout
+        self.message_timeout = message_timeout
+        self.max_holdback = max_holdback  # Messages kept per sender while waiting for a gap to fill
+        self.max_senders = max_senders  # Senders whose state is kept, least recently heard from go first
+        self.outboxes = {}  # Map peer IP to its Outbox
+        self.inboxes = OrderedDict()  # Map sender id to its Inbox
+        self.pending_acks = {}  # Map (sender IP, sender id) to the sequence number to acknowledge
+        self.lock = threading.Lock()
+        self.acks_waiting = threading.Condition(self.lock)
+        self.deliver_lock = threading.Lock()  # Keeps deliveries in order across connection threads
+
+    def send(self, peers, message, sender_name, on_result=None):
+        # on_result is called with (peer IP, delivered) once the peer has
+        # acknowledged the message or it has timed out
+        payload = message.encode()
+        now = time.monotonic()
+        frames = []
+        with self.lock:
+            for peer_ip in peers:
+                outbox = self.outboxes.setdefault(peer_ip, Outbox())
+                outbox.next_seq += 1
+                item = outbox.pending[outbox.next_seq] = OutgoingMessage(outbox.next_seq, payload, sender_name, on_result, now)
+                frames.append((peer_ip, self.frame(outbox, item)))
+        for peer_ip, frame in frames:
+            self.network.transmit_messages(peer_ip, [frame])
+
+    def frame(self, outbox, item):
+        meta = {'sender_name': item.sender_name, 'id': self.network.node_id, 'base': next(iter(outbox.pending))}
+        return self.network.frame_header(KIND_MESSAGE, encode_meta(meta), len(item.payload), 0, item.seq), item.payload
+
+    def handle_frame(self, frame, sender_ip):
+        if frame.kind == KIND_ACK:
+            self.handle_ack(frame, sender_ip)
+        elif frame.kind == KIND_MESSAGE:
+            self.handle_message(frame, sender_ip)
+
+    def handle_ack(self, frame, peer_ip):
+        if frame.meta.get('to') != self.network.node_id:
+            return  # Meant for an earlier run of this peer
+        acked = []
+        with self.lock:
+            outbox = self.outboxes.get(peer_ip)
+            while outbox is not None and outbox.pending and next(iter(outbox.pending)) <= frame.seq:
+                acked.append(outbox.pending.popitem(last=False)[1])
+        for item in acked:
+            if item.on_result:
+                item.on_result(peer_ip, True)
+
+    def handle_message(self, frame, sender_ip):
+        message, sender_name = str(frame.payload, 'utf-8'), frame.meta.get('sender_name', 'Unknown')
+        sender_id = frame.meta.get('id')
+        with self.deliver_lock:
+            if sender_id is None:
+                deliver = [(message, sender_name)]  # Sent with send_message, outside the bus
+            else:
+                deliver = self.accept(frame, sender_ip, sender_id, (message, sender_name))
+            if self.network.on_message_received:
+                for message, sender_name in deliver:
+                    self.network.on_message_received(message, sender_ip, sender_name)
+
+    def accept(self, frame, sender_ip, sender_id, entry):
+        # Returns the messages that are now in order, oldest first
+        base = frame.meta.get('base', frame.seq)
+        deliver = []
+        with self.lock:
+            inbox = self.inboxes.get(sender_id)
+            if inbox is None:
+                inbox = self.inboxes[sender_id] = Inbox(base)
+                if len(self.inboxes) > self.max_senders:
+                    self.inboxes.popitem(last=False)
+            else:
+                self.inboxes.move_to_end(sender_id)
+            if base > inbox.expected:
+                # The sender gave up on the messages before base
+                for seq in sorted(seq for seq in inbox.held if seq < base):
+                    deliver.append(inbox.held.pop(seq))
+                inbox.expected = base
+            if inbox.expected <= frame.seq < inbox.expected + self.max_holdback:
+                inbox.held.setdefault(frame.seq, entry)
+            while inbox.expected in inbox.held:
+                deliver.append(inbox.held.pop(inbox.expected))
+                inbox.expected += 1
+            # Duplicates are acknowledged too, the first ack may have been lost
+            self.pending_acks[(sender_ip, sender_id)] = inbox.expected - 1
+            self.acks_waiting.notify()
+        return deliver
+
+    def run(self):
+        last_check = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.pending_acks:
+                    self.acks_waiting.wait(self.retransmit_timeout / 4)
+                waiting = bool(self.pending_acks)
+            if waiting:
+                time.sleep(self.ack_delay)  # Let the acks of a burst of messages collect
+                self.flush_acks()
+            if time.monotonic() - last_check >= self.retransmit_timeout / 4:
+                last_check = time.monotonic()
+                self.retransmit()
+
+    def flush_acks(self):
+        with self.lock:
+            acks, self.pending_acks = self.pending_acks, {}
+        for (sender_ip, sender_id), seq in acks.items():
+            if seq > 0:
+                header = self.network.frame_header(KIND_ACK, encode_meta({'to': sender_id}), 0, 0, seq)
+                self.network.transmit_messages(sender_ip, [(header, b'')])
+
+    def retransmit(self):
+        now = time.monotonic()
+        expired, resends = [], []
+        with self.lock:
+            for peer_ip, outbox in self.outboxes.items():
+                while outbox.pending and now - next(iter(outbox.pending.values())).first_sent > self.message_timeout:
+                    expired.append((peer_ip, outbox.pending.popitem(last=False)[1]))
+                if outbox.resending:
+                    continue
+                frames = []
+                for item in outbox.pending.values():
+                    if now - item.last_sent > self.retransmit_timeout:
+                        item.last_sent = now
+                        frames.append(self.frame(outbox, item))
+                if frames:
+                    outbox.resending = True
+                    resends.append((peer_ip, outbox, frames))
+        for peer_ip, item in expired:
+            if item.on_result:
+                item.on_result(peer_ip, False)
+        for peer_ip, outbox, frames in resends:
+            self.network.transmit_messages(peer_ip, frames, lambda outbox=outbox: setattr(outbox, 'resending', False))
@@ -0,0 +1,282 @@
+import heapq
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from assembler import ChunkBitmap
+from fec import BlockCode
+from scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from protocol import HEADER, KIND_MCAST_DATA, KIND_MCAST_REPAIR, KIND_MCAST_STATUS, KIND_NACK, MetaCache, encode_meta, unpack_header
+
+NACK_RANGE = struct.Struct('!II')  # First missing packet, number of missing packets
+MAX_NACK_RANGES = 128  # Keeps a NACK inside a single unfragmented datagram
+
+
+def parse_datagram(data):
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise ValueError("Truncated datagram")
+    kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len = unpack_header(view[:HEADER.size])
+    meta_end = HEADER.size + meta_len
+    if len(view) < meta_end + payload_len:
+        raise ValueError("Truncated datagram")
+    return kind, session, transfer_id, seq, total, view[HEADER.size:meta_end], view[meta_end:meta_end + payload_len]
+
+
+class MulticastSender:
+    # Sends one file to the multicast group, each packet once, paced to
+    # multicast_rate. Receivers answer the periodic status packets with
+    # NACKs for the packets they missed, and those are sent again to the
+    # whole group since other receivers usually missed them too. With FEC
+    # every block of k packets is followed by r repair packets, so most
+    # losses are rebuilt by the receivers without a round trip.
+    def __init__(self, network, transfer_id, meta, source, recipients):
+        self.network = network
+        self.transfer_id = transfer_id
+        self.source = source
+        self.total = source.total_chunks
+        self.fec = meta.get('fec')  # [k, r] or None
+        self.block = []  # Packets of the current FEC block
+        self.recipients = set(recipients)
+        self.encoded_meta = encode_meta(meta)
+        self.group = (network.multicast_group, network.multicast_port)
+        self.sent = 0  # Packets sent for the first time, in order
+        self.repairs = []  # Heap of packets to send again
+        self.queued = set()
+        self.repaired_at = {}  # Map packet to the time it was last sent as a repair
+        self.done = set()  # Recipients that reported a complete copy
+        self.next_send = time.monotonic()
+        self.last_heard = time.monotonic()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, network.multicast_ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if network.multicast_interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(network.multicast_interface))
+        self.sock.bind((network.multicast_interface, 0))
+
+    def pace(self, size):
+        # Leaky bucket: never more than multicast_rate bytes per second, and
+        # idle time is not saved up for a burst. The group traffic also
+        # counts against the network's overall limit.
+        self.network.scheduler.acquire(None, size, PRIORITY_BACKGROUND if self.transfer_id in self.network.background_transfers else PRIORITY_INTERACTIVE)
+        now = time.monotonic()
+        self.next_send = max(self.next_send, now) + size / self.network.multicast_rate
+        delay = self.next_send - now
+        if delay > 0.002:
+            time.sleep(delay)
+
+    def send_packet(self, seq):
+        data = self.source.read_chunk(seq)
+        self.sock.sendto(self.network.frame_header(KIND_MCAST_DATA, b'', len(data), self.transfer_id, seq, self.total) + data, self.group)
+        self.pace(HEADER.size + len(data))
+        return data
+
+    def send_repairs(self, block_id):
+        k, r = self.fec
+        repairs = BlockCode(len(self.block), r).encode(self.block, self.source.chunk_size)
+        for j, data in enumerate(repairs):
+            self.sock.sendto(self.network.frame_header(KIND_MCAST_REPAIR, b'', len(data), self.transfer_id, block_id * r + j, self.total) + data, self.group)
+            self.pace(HEADER.size + len(data))
+        self.block = []
+
+    def send_status(self):
+        self.sock.sendto(self.network.frame_header(KIND_MCAST_STATUS, self.encoded_meta, 0, self.transfer_id, self.sent, self.total), self.group)
+
+    def read_nacks(self, timeout=0):
+        while select.select([self.sock], [], [], timeout)[0]:
+            timeout = 0
+            data, addr = self.sock.recvfrom(65535)
+            try:
+                kind, session, transfer_id, seq, total, meta, payload = parse_datagram(data)
+            except ValueError:
+                continue
+            if kind != KIND_NACK or transfer_id != self.transfer_id or session != self.network.session_id:
+                continue
+            self.last_heard = time.monotonic()
+            if not payload:
+                if addr[0] not in self.done:
+                    self.done.add(addr[0])
+                    self.network.transfer_completed(self.transfer_id, addr[0])
+                continue
+            for first, count in NACK_RANGE.iter_unpack(bytes(payload[:len(payload) // NACK_RANGE.size * NACK_RANGE.size])):
+                for seq in range(first, min(first + count, self.sent)):
+                    # A NACK sent before the last repair arrived is not a new loss
+                    if seq not in self.queued and self.last_heard - self.repaired_at.get(seq, 0) > self.network.multicast_status_interval:
+                        self.queued.add(seq)
+                        heapq.heappush(self.repairs, seq)
+
+    def run(self, on_progress=None):
+        step = max(1, self.total // 100)
+        last_status = 0
+        while True:
+            now = time.monotonic()
+            if now - last_status >= self.network.multicast_status_interval:
+                self.send_status()
+                last_status = now
+            self.read_nacks()
+            if self.repairs:
+                seq = heapq.heappop(self.repairs)
+                self.queued.discard(seq)
+                self.repaired_at[seq] = now
+                self.send_packet(seq)
+            elif self.sent < self.total:
+                data = self.send_packet(self.sent)
+                self.sent += 1
+                if self.fec:
+                    self.block.append(data)
+                    if len(self.block) == self.fec[0] or self.sent == self.total:
+                        self.send_repairs((self.sent - 1) // self.fec[0])
+                if self.sent == self.total:
+                    self.last_heard = now  # The timeout for confirmations starts now
+                if on_progress and (self.sent % step == 0 or self.sent == self.total):
+                    on_progress(self.sent, self.total, (self.sent / self.total) * 100)
+            elif self.recipients <= self.done:
+                return
+            elif now - self.last_heard > self.network.multicast_timeout:
+                missing = len(self.recipients - self.done)
+                raise TimeoutError(f"{missing} peer(s) did not confirm the multicast transfer")
+            else:
+                self.read_nacks(max(0, last_status + self.network.multicast_status_interval - now))
+
+    def close(self):
+        self.sock.close()
+        self.source.close()
+
+
+class MulticastTransfer:
+    def __init__(self, transfer_id, meta, total):
+        self.transfer_id = transfer_id
+        self.meta = meta
+        self.bitmap = ChunkBitmap(total)
+        self.last_active = time.monotonic()
+        self.fec = meta.get('fec')  # [k, r] or None
+        self.blocks = {}  # Map FEC block id to {index in block: packet} while the block is incomplete
+
+    def block_range(self, block_id):
+        first = block_id * self.fec[0]
+        return first, min(first + self.fec[0], self.bitmap.total_chunks)
+
+    def packet_length(self, seq):
+        return min(self.meta['chunk_size'], self.meta['file_size'] - seq * self.meta['chunk_size'])
+
+
+class MulticastReceiver:
+    # Receiving side of the multicast transport, shared by both network
+    # engines: they hand every datagram from the group to handle_datagram
+    def __init__(self, network):
+        self.network = network
+        self.transfers = {}  # Map transfer id to its MulticastTransfer
+        self.meta_cache = MetaCache()
+        self.lock = threading.Lock()
+        self.expire_after = 600  # Seconds a finished or abandoned transfer is remembered
+
+    def open_socket(self):
+        network = self.network
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Several peers on one machine
+        # Room for bursts while the receiving thread is busy writing to disk
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, network.multicast_receive_buffer)
+        sock.bind(('', network.multicast_port))
+        membership = socket.inet_aton(network.multicast_group) + socket.inet_aton(network.multicast_interface or '0.0.0.0')
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        return sock
+
+    def handle_datagram(self, data, addr):
+        if self.network.multicast_loss_rate and random.random() < self.network.multicast_loss_rate:
+            return
+        kind, session, transfer_id, seq, total, meta, payload = parse_datagram(data)
+        if session != self.network.session_id:
+            return  # Another lab sharing the group
+        if not self.network.on_file_chunk_received:
+            return  # Not receiving files, e.g. the sender hearing its own packets
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if kind == KIND_MCAST_STATUS:
+                if transfer is None:
+                    transfer = self.open_transfer(transfer_id, self.meta_cache.decode(transfer_id, meta), total)
+                self.send_nack(transfer, seq, addr)
+            elif kind == KIND_MCAST_DATA and transfer is not None:
+                self.on_data(transfer, seq, payload, addr)
+            elif kind == KIND_MCAST_REPAIR and transfer is not None and transfer.fec:
+                self.on_repair(transfer, seq, payload, addr)
+
+    def open_transfer(self, transfer_id, meta, total):
+        now = time.monotonic()
+        for old_id, old in list(self.transfers.items()):
+            if now - old.last_active > self.expire_after:
+                del self.transfers[old_id]
+        transfer = self.transfers[transfer_id] = MulticastTransfer(transfer_id, meta, total)
+        return transfer
+
+    def on_data(self, transfer, seq, payload, addr):
+        transfer.last_active = time.monotonic()
+        if seq >= transfer.bitmap.total_chunks or seq in transfer.bitmap:
+            return
+        self.deliver(transfer, seq, payload, addr)
+        if transfer.fec:
+            block_id, index = divmod(seq, transfer.fec[0])
+            if block_id in transfer.blocks or not self.block_complete(transfer, block_id):
+                transfer.blocks.setdefault(block_id, {})[index] = bytes(payload)
+                self.try_decode(transfer, block_id, addr)
+
+    def on_repair(self, transfer, seq, payload, addr):
+        transfer.last_active = time.monotonic()
+        block_id, index = divmod(seq, transfer.fec[1])
+        if block_id * transfer.fec[0] >= transfer.bitmap.total_chunks or self.block_complete(transfer, block_id):
+            return
+        transfer.blocks.setdefault(block_id, {})[transfer.fec[0] + index] = bytes(payload)
+        self.try_decode(transfer, block_id, addr)
+
+    def block_complete(self, transfer, block_id):
+        first, last = transfer.block_range(block_id)
+        return all(seq in transfer.bitmap for seq in range(first, last))
+
+    def try_decode(self, transfer, block_id, addr):
+        # Rebuilds the block's missing packets once any k of its packets are in
+        first, last = transfer.block_range(block_id)
+        if self.block_complete(transfer, block_id):
+            transfer.blocks.pop(block_id, None)
+            return
+        packets = transfer.blocks[block_id]
+        k = last - first
+        if len(packets) < k:
+            return
+        # Repair packets are numbered after the block's k source packets, and
+        # the last block of a file may be short
+        packets = {index if index < transfer.fec[0] else index - transfer.fec[0] + k: packet
+                   for index, packet in packets.items()}
+        code = BlockCode(k, transfer.fec[1])
+        for index, packet in code.decode(packets, transfer.meta['chunk_size']).items():
+            seq = first + index
+            if seq not in transfer.bitmap:
+                self.deliver(transfer, seq, memoryview(packet)[:transfer.packet_length(seq)], addr)
+        del transfer.blocks[block_id]
+
+    def deliver(self, transfer, seq, payload, addr):
+        header = dict(transfer.meta, transfer_id=transfer.transfer_id, chunk_id=seq, total_chunks=transfer.bitmap.total_chunks)
+        header.setdefault('sender_name', 'Unknown')
+        self.network.on_file_chunk_received(header, payload, addr[0])
+        transfer.bitmap.add(seq)
+        if transfer.bitmap.is_complete():
+            self.send_nack(transfer, seq, addr)  # Tell the sender straight away
+
+    def send_nack(self, transfer, sent, addr):
+        # Missing packets among the first `sent` as aggregated ranges; an
+        # empty list tells the sender this peer has the whole file
+        transfer.last_active = time.monotonic()
+        ranges = transfer.bitmap.missing_ranges(sent, MAX_NACK_RANGES)
+        if not ranges and not transfer.bitmap.is_complete():
+            return  # Nothing lost so far
+        payload = b''.join(NACK_RANGE.pack(first, count) for first, count in ranges)
+        header = self.network.frame_header(KIND_NACK, b'', len(payload), transfer.transfer_id, 0, transfer.bitmap.total_chunks)
+        try:
+            self.network.socket.sendto(header + payload, addr)
+        except OSError as e:
+            if self.network.on_error:
+                self.network.on_error(f"Error sending multicast NACK: {str(e)}")
+
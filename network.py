@@ -1,160 +1,1224 @@
+import json
 import socket
 import threading
 import os
-import json
+import random
+import shutil
 import math
+import queue
+import select
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from archive import input_chunk_size, input_listing, input_meta, input_name, input_size, open_input
+from assembler import ChunkBitmap
+from broadcast import BroadcastTree, CutThroughForwarder
+from compression import CODEC_NONE, ChunkCompressor, decode_chunk
+from integrity import Manifest, VerifyQueue
+from messaging import MessageBus
+from multicast import MulticastReceiver, MulticastSender
+from peers import PeerRegistry
+from protocol import (FLAG_BACKGROUND, FLAG_RELAY, FLAG_REPAIR, FrameReader, KIND_BITFIELD, KIND_CHUNK, KIND_COMPLETE, KIND_HAVE, KIND_MANIFEST,
+                      KIND_MANIFEST_REQUEST, KIND_MESSAGE, KIND_REQUEST, KIND_SENT, MAX_PAYLOAD_SIZE, encode_meta, pack_header, replace_flags, session_id)
+from scheduler import TrafficScheduler, traffic_class
+from striping import StreamTuner, StripedSender, send_parts
+from swarm import CHUNK_ID, FileSource, Swarm
+from transfers import TransferCancelled
+
+
+class PooledConnection:
+    def __init__(self):
+        self.sock = None
+        self.lock = threading.Lock()
+        self.last_used = 0.0
+
+
+class ConnectionPool:
+    # Keeps long-lived TCP connections per (ip, port) so many frames share
+    # a handshake. Addresses on a striped port get several connections,
+    # as many as their StreamTuner finds raise goodput, and concurrent sends
+    # to them go out over separate connections; every other address gets
+    # one. Connections idle for longer than idle_timeout are closed by a
+    # background sweeper.
+    def __init__(self, connect_timeout=5, idle_timeout=30, send_buffer=4 * 1024 * 1024, max_streams=4):
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.send_buffer = send_buffer  # SO_SNDBUF asked for on every connection, None for the OS default
+        self.max_streams = max_streams
+        self.striped_ports = set()
+        self.connections = {}  # Map address to its list of PooledConnections
+        self.tuners = {}  # Map striped address to its StreamTuner
+        self.next_pick = 0
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    def get(self, address):
+        # Returns a connection to address with its lock held: an idle one,
+        # a new one while the address may have more, or else the next in turn
+        with self.lock:
+            conns = self.connections.get(address)
+            if conns is None:
+                conns = self.connections[address] = []
+            if self.sweeper is None:
+                self.sweeper = threading.Thread(target=self.sweep_idle, daemon=True)
+                self.sweeper.start()
+            limit = self.stream_limit(address)
+            for conn in conns[:limit]:
+                if conn.lock.acquire(blocking=False):
+                    return conn
+            if len(conns) < limit:
+                conn = PooledConnection()
+                conn.lock.acquire()
+                conns.append(conn)
+                return conn
+            self.next_pick += 1
+            conn = conns[self.next_pick % limit]
+        conn.lock.acquire()
+        return conn
+
+    def stream_limit(self, address):
+        if address[1] not in self.striped_ports:
+            return 1
+        tuner = self.tuners.get(address)
+        if tuner is None:
+            tuner = self.tuners[address] = StreamTuner(self.max_streams)
+        return tuner.streams
+
+    def connect(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self.send_buffer:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+            # Control frames must not wait for Nagle; chunks leave in one
+            # sendmsg, so they gain nothing from it either
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(self.connect_timeout)
+            sock.connect(address)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def is_alive(self, sock):
+        # Receivers never write back, so a readable socket means it was closed
+        readable, _, _ = select.select([sock], [], [], 0)
+        return not readable
+
+    def acquire(self, address):
+        # Returns the connection locked and connected; pair with release()
+        conn = self.get(address)
+        try:
+            if conn.sock is None or not self.is_alive(conn.sock):
+                self.close_connection(conn)
+                conn.sock = self.connect(address)
+        except BaseException:
+            conn.lock.release()
+            raise
+        return conn
+
+    def release(self, conn, failed=False):
+        # A failed connection may hold half a frame, so it is never reused
+        if failed:
+            self.close_connection(conn)
+        else:
+            conn.last_used = time.monotonic()
+        conn.lock.release()
+
+    def send(self, address, *parts):
+        for attempt in range(2):
+            conn = self.acquire(address)
+            try:
+                send_parts(conn.sock, parts)
+            except OSError:
+                self.release(conn, failed=True)
+                if attempt:
+                    raise
+            else:
+                self.release(conn)
+                tuner = self.tuners.get(address)
+                if tuner is not None:
+                    tuner.record(sum(len(part) for part in parts), time.monotonic())
+                return
+
+    def close_connection(self, conn):
+        if conn.sock is not None:
+            try:
+                conn.sock.close()
+            except OSError:
+                pass
+            conn.sock = None
+
+    def sweep_idle(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 2))
+            self.evict_idle()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            items = [(address, conn) for address, conns in self.connections.items() for conn in conns]
+        for address, conn in items:
+            if conn.lock.acquire(blocking=False):
+                try:
+                    if conn.sock is not None and now - conn.last_used > self.idle_timeout:
+                        self.close_connection(conn)
+                        with self.lock:
+                            conns = self.connections.get(address, [])
+                            if conn in conns:
+                                conns.remove(conn)
+                            if not conns:
+                                self.connections.pop(address, None)
+                finally:
+                    conn.lock.release()
+
+    def close_all(self):
+        with self.lock:
+            items = [conn for conns in self.connections.values() for conn in conns]
+            self.connections.clear()
+        for conn in items:
+            with conn.lock:
+                self.close_connection(conn)
+
 
 class PeerNetwork:
     def __init__(self, port=8080, file_port=8081, on_peer_discovered=None, on_file_chunk_received=None, on_message_received=None):
         self.port = port
         self.file_port = file_port
         self.message_port = 50008
-        self.peers = []
+        self.peers = PeerRegistry()  # Live peers, iterates as (ip, port) pairs
+        self.node_id = os.urandom(4).hex()  # Peer id, also tells our own broadcasts apart
+        self.name = ''
+        self.role = ''  # 'teacher' or 'student', set by the panel
+        self.session = None  # Join code of the session this peer is in, see join_session
+        self.session_id = 0  # Its number, stamped on every frame sent and required of every frame received
+        self.storage_path = None  # Where received files go, its free space is announced
+        self.heartbeat_interval = 5  # Seconds between announcements
+        self.echo_every = 6  # Announcements between RTT echo requests
+        self.announce_jitter = 1.0  # Seconds over which answers to a discovery query are spread
+        self.announce_suppress = 1.0  # Seconds after announcing in which queries are not answered again
+        self.last_announce = 0.0
+        self.answer_pending = False
+        self.announce_lock = threading.Lock()
+        self.on_peer_lost = None  # Called with the IP of a peer that stopped announcing
         self.chunk_size = 1024 * 1024  # 1MB chunks
+        self.send_window = 4  # Max chunks read ahead of the socket while sending
         self.on_peer_discovered = on_peer_discovered
         self.on_file_chunk_received = on_file_chunk_received
         self.on_message_received = on_message_received
         self.on_error = None  # Callback for error reporting
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.socket.bind(('', self.port))
-        self.peer_names = {}  # Map IP to name
+        self.pool = ConnectionPool()
+        self.pool.striped_ports.add(self.file_port)  # File data may go over several connections per peer
+        self.receive_buffer = 4 * 1024 * 1024  # SO_RCVBUF asked for on accepted connections, for long fat links
+        self.max_stripe_width = 16  # Chunk sends a transfer keeps in flight across all its connections
+        self.sends_in_flight = 0
+        self.send_stats = {}  # Map transfer id to [bytes written to sockets, seconds spent writing them]
+        self.sends_lock = threading.Lock()
+        self.listen_backlog = 128  # Pending connections the OS queues per listener
+        self.max_connections = 64  # Inbound connections served in parallel per listener, at least (see connection_limit)
+        self.read_timeout = 60  # Seconds a connection may stay silent before it is closed
+        self.unreachable = {}  # Map IP to the time a send to it last failed
+        self.unreachable_backoff = 30  # Seconds to skip a peer after a failed send
+        self.swarms = {}  # Map transfer id to the Swarm this peer takes part in
+        self.swarms_lock = threading.Lock()
+        self.open_store = None  # Called with a chunk header to get the store a swarm download writes to
+        self.swarm_stall_timeout = 120  # Seconds a seed waits without any progress before giving up
+        self.tree_fanout = 2  # Children each peer forwards to in tree mode, 1 makes a chain
+        self.multicast_group = '239.255.80.80'
+        self.multicast_port = 50010
+        self.multicast_interface = ''  # Local address to send and join on, empty for the default route
+        self.multicast_ttl = 1  # Stay on the local network
+        self.multicast_rate = 8 * 1024 * 1024  # Bytes per second the sender paces itself to
+        self.multicast_payload_size = 1400  # File bytes per datagram, so a packet fits in one Ethernet frame
+        self.multicast_status_interval = 0.5  # Seconds between status packets that receivers answer with NACKs
+        self.multicast_timeout = 30  # Seconds the sender waits for missing confirmations
+        self.multicast_receive_buffer = 4 * 1024 * 1024  # Socket receive buffer asked for by multicast receivers
+        self.fec_block_size = 16  # Multicast packets per FEC block
+        self.fec_repair_count = 2  # Repair packets sent per FEC block, 0 turns FEC off
+        self.multicast_loss_rate = 0.0  # Fraction of received multicast packets dropped on purpose, for testing
+        self.multicast = MulticastReceiver(self)
+        self.manifests = {}  # Map transfer id to the Manifest received for it
+        self.manifests_changed = threading.Condition()
+        self.manifest_timeout = 10  # Seconds the first chunk of a transfer waits for its manifest
+        self.manifest_frames = {}  # Map transfer id to the (meta, payload, total chunks) of its manifest frame, for peers that missed it
+        self.manifests_missing = {}  # Map transfer id to the chunk ids dropped while its manifest was missing
+        self.sources = {}  # Map transfer id to (FileSource, expiry time) for re-sending bad chunks
+        self.source_linger = 3600  # Seconds a sent file is kept open for re-fetches and resumed downloads
+        self.held_requests = {}  # Map paused transfer id to {peer IP: chunk ids it asked for again}
+        self.chunk_cache = None  # ChunkCache that receivers check a manifest against before anything is sent
+        self.cache_replies = {}  # Map transfer id to {peer IP: ChunkBitmap of the chunks it already has}
+        self.cache_replies_changed = threading.Condition()
+        self.cache_reply_timeout = 2  # Seconds a sender waits for every recipient to report its cached chunks
+        self.delta_reply_timeout = 20  # The same for folder packs, which receivers compare with their old copy first
+        self.cached_share = 0.5  # Fraction of recipients that must hold a chunk already for it not to be sent
+        self.compressor = ChunkCompressor(window=self.send_window)  # None sends every chunk uncompressed
+        self.find_local = None  # Called with a manifest, returns {chunk id: function reading it} for chunks held outside the cache
+        self.message_workers = 32  # Peers messages are sent to at once
+        self.message_pool = None
+        self.message_pool_lock = threading.Lock()
+        self.messages = MessageBus(self)  # Sequenced, acknowledged delivery for broadcast_message
+        self.scheduler = TrafficScheduler()  # Bandwidth limits and priorities of everything sent over TCP and multicast
+        self.background_transfers = set()  # Transfer ids whose data goes out after all other traffic
+        self.on_transfer_complete = None  # Called with (transfer id, peer IP) when a recipient reports a complete copy
+        self.on_transfer_sent = None  # Called with a transfer id once its sender has sent every chunk
 
     def discover_peers(self):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-                s.sendto(b"DISCOVER_PEER", ("<broadcast>", self.port))
-        except Exception as e:
-            if self.on_error:
-                self.on_error(f"Error broadcasting discovery: {str(e)}")
+        # Announces this peer and asks everyone else to announce themselves
+        self.announce(query=True)
+
+    def join_session(self, code):
+        # Moves this peer into the session of a join code, or out of any
+        # session with None. Peers, frames and multicast packets of other
+        # sessions are ignored from then on, so labs sharing a network
+        # never see each other's traffic.
+        number = session_id(code)  # ValueError for a malformed code
+        self.session = code.strip().upper() if code else None
+        self.session_id = number
+        for peer in self.peers.clear():
+            if self.on_peer_lost:
+                self.on_peer_lost(peer.ip)
+        self.announce(query=True)
+
+    def frame_header(self, kind, meta, payload_len, transfer_id=0, seq=0, total=0, flags=0, codec=0):
+        if transfer_id in self.background_transfers:
+            flags |= FLAG_BACKGROUND
+        return pack_header(kind, meta, payload_len, transfer_id, seq, total, flags, codec, self.session_id)
+
+    def start(self, receive_files=True):
+        targets = [self.listen_for_peers, self.listen_for_messages, self.heartbeat, self.messages.run]
+        if receive_files:
+            targets += [self.listen_for_file_chunks, self.listen_for_multicast]
+        for target in targets:
+            threading.Thread(target=target, daemon=True).start()
 
     def listen_for_peers(self):
         while True:
             try:
                 message, addr = self.socket.recvfrom(1024)
-                if message == b"DISCOVER_PEER":
-                    peer_ip = addr[0]
-                    if peer_ip not in [p[0] for p in self.peers]:
-                        self.peers.append(addr)
-                        if self.on_peer_discovered:
-                            self.on_peer_discovered(addr[0])
-                        self.socket.sendto(b"PEER_ACK", addr)
-                elif message.startswith(b"NAME:"):
-                    name = message[5:].decode()
-                    self.peer_names[addr[0]] = name
+                self.handle_discovery(message, addr)
             except Exception as e:
                 if self.on_error:
                     self.on_error(f"Error in peer discovery: {str(e)}")
 
-    def broadcast_name(self, name):
+    def announce(self, query=False, echo=False, address=None):
+        # One packet says everything about this peer. query asks the others to
+        # announce back, echo asks them to return the timestamp for an RTT.
+        info = {
+            'id': self.node_id,
+            'name': self.name,
+            'role': self.role,
+            'session': self.session,
+            'ports': {'discovery': self.port, 'file': self.file_port, 'message': self.message_port},
+            'disk_free': self.disk_free(),
+            'link_speed': self.link_speed(),
+            'query': query,
+            'sent_at': time.monotonic() if echo else None
+        }
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-                s.sendto(f"NAME:{name}".encode(), ("<broadcast>", self.port))
+            self.socket.sendto(b"ANNOUNCE:" + json.dumps(info, separators=(',', ':')).encode(), address or ("<broadcast>", self.port))
+            self.last_announce = time.monotonic()
         except Exception as e:
             if self.on_error:
-                self.on_error(f"Error broadcasting name: {str(e)}")
+                self.on_error(f"Error announcing this peer: {str(e)}")
+
+    def disk_free(self):
+        if self.storage_path is None:
+            return None
+        try:
+            return shutil.disk_usage(self.storage_path).free
+        except OSError:
+            return None
+
+    def link_speed(self):
+        if self.compressor is None or self.compressor.link_rate is None:
+            return None
+        return int(self.compressor.link_rate)
+
+    def handle_discovery(self, message, addr):
+        if message.startswith(b"ANNOUNCE:"):
+            info = json.loads(message[9:].decode())
+            if info.get('id') == self.node_id:
+                return  # Our own broadcast
+            if info.get('session') != self.session:
+                return  # A peer of another session
+            self.peer_seen(addr, info)
+            if info.get('sent_at') is not None:
+                self.socket.sendto(b"ANNOUNCE_ECHO:" + repr(info['sent_at']).encode(), addr)
+            if info.get('query'):
+                self.answer_query()
+        elif message.startswith(b"ANNOUNCE_ECHO:"):
+            self.peers.record_rtt(addr[0], time.monotonic() - float(message[14:]))
+
+    def answer_query(self):
+        # When a whole lab starts at once every peer queries. Answers are
+        # broadcast after a random delay, so one answer serves every query
+        # that arrives meanwhile, and none is sent if this peer announced
+        # within announce_suppress seconds anyway.
+        with self.announce_lock:
+            if self.answer_pending or time.monotonic() - self.last_announce < self.announce_suppress:
+                return
+            self.answer_pending = True
+
+        def answer():
+            with self.announce_lock:
+                self.answer_pending = False
+            self.announce()
+
+        timer = threading.Timer(random.uniform(0, self.announce_jitter), answer)
+        timer.daemon = True
+        timer.start()
+
+    def peer_seen(self, addr, info):
+        new = self.peers.seen(addr[0], addr[1], peer_id=info.get('id'), name=info.get('name') or None,
+                              role=info.get('role') or None, session=info.get('session'), ports=info.get('ports'),
+                              disk_free=info.get('disk_free'), link_speed=info.get('link_speed'))
+        if new and self.on_peer_discovered:
+            self.on_peer_discovered(addr[0])
+        return new
+
+    def heartbeat(self):
+        # Announces this peer every heartbeat_interval, asking for an echo
+        # every few times to keep RTTs current, and drops peers that have not
+        # been heard from within peers.timeout so sends only go to peers that
+        # are still there
+        count = 0
+        while True:
+            self.announce(echo=count % self.echo_every == 0)
+            count += 1
+            for peer in self.peers.expire():
+                if self.on_peer_lost:
+                    self.on_peer_lost(peer.ip)
+            time.sleep(self.heartbeat_interval)
+
+    def broadcast_name(self, name):
+        self.name = name
+        self.announce()
+
+    def plan_recipients(self, recipients, file_size):
+        # Leaves out peers that announced too little free disk for the file,
+        # and puts the fastest first, where tree mode makes them forwarders
+        planned = []
+        for peer_ip in recipients:
+            peer = self.peers.get(peer_ip)
+            if peer is not None and peer.disk_free is not None and peer.disk_free < file_size:
+                if self.on_error:
+                    self.on_error(f"Skipping {peer.name or peer_ip}: not enough free disk space")
+                continue
+            planned.append(peer_ip)
+        speeds = {peer_ip: getattr(self.peers.get(peer_ip), 'link_speed', None) or 0 for peer_ip in planned}
+        return sorted(planned, key=lambda peer_ip: -speeds[peer_ip])
+
+    def send_frame(self, peer_ip, port, header, payload=b''):
+        # header is a packed frame header (see protocol.pack_header) or one
+        # taken verbatim from a received frame when relaying
+        self.scheduler.acquire(peer_ip, len(header) + len(payload), traffic_class(header))
+        self.pool.send((peer_ip, port), header, payload)
+
+    def read_frames(self, conn, on_header=None):
+        reader = FrameReader(conn, self.chunk_size, self.session_id)
+        while True:
+            frame = reader.read_frame(on_header)
+            if frame is None:
+                return
+            yield frame
+
+    def serve(self, port, handle_connection):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.receive_buffer:
+            # Set before listen() so accepted connections inherit it and the
+            # window scale offered in the handshake can cover it
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        s.bind(('', port))
+        s.listen(self.listen_backlog)
+        # Caps the number of connections being served at once; further
+        # connections wait in the listen backlog until a slot frees up.
+        served = 0
+        slots = threading.Condition()
+
+        def run(conn, addr):
+            nonlocal served
+            try:
+                handle_connection(conn, addr)
+            finally:
+                with slots:
+                    served -= 1
+                    slots.notify()
+
+        while True:
+            with slots:
+                while served >= self.connection_limit():
+                    slots.wait(1)  # The limit grows as peers join
+                served += 1
+            try:
+                conn, addr = s.accept()
+                conn.settimeout(self.read_timeout)
+                threading.Thread(target=run, args=(conn, addr), daemon=True).start()
+            except Exception as e:
+                with slots:
+                    served -= 1
+                if self.on_error:
+                    self.on_error(f"Error accepting connection on port {port}: {str(e)}")
+
+    def connection_limit(self):
+        # Senders keep pooled connections open, up to pool.max_streams each
+        # for striped file data, so a fixed cap would leave some of them
+        # stuck in the backlog for as long as they stay connected
+        return max(self.max_connections, (len(self.peers) + 1) * self.pool.max_streams)
 
     def send_message(self, peer_ip, message, sender_name):
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5)
-                s.connect((peer_ip, self.message_port))
-                data = json.dumps({"message": message, "sender_name": sender_name})
-                s.sendall(data.encode())
-                return True
+            payload = message.encode()
+            header = self.frame_header(KIND_MESSAGE, encode_meta({'sender_name': sender_name}), len(payload))
+            self.send_frame(peer_ip, self.message_port, header, payload)
+            return True
         except Exception as e:
             if self.on_error:
                 self.on_error(f"Error sending message to {peer_ip}: {str(e)}")
             return False
 
+    def broadcast_message(self, peers, message, sender_name, on_result=None):
+        # Queues the message for every peer and returns straight away.
+        # on_result is called with (peer IP, delivered) from a worker thread
+        # once each peer has acknowledged it or messages.message_timeout
+        # has passed, so an absent machine never holds up the others.
+        self.messages.send(peers, message, sender_name, on_result)
+
+    def transmit_messages(self, peer_ip, frames, done=None):
+        # Sends (header, payload) frames to a peer's message port on the
+        # message pool, then calls done
+        with self.message_pool_lock:
+            if self.message_pool is None:
+                self.message_pool = ThreadPoolExecutor(self.message_workers)
+        self.message_pool.submit(self.send_messages, peer_ip, frames, done)
+
+    def send_messages(self, peer_ip, frames, done):
+        try:
+            for header, payload in frames:
+                self.send_frame(peer_ip, self.message_port, header, payload)
+        except Exception as e:
+            self.mark_unreachable(peer_ip, f"Error sending message to {peer_ip}: {str(e)}")
+        finally:
+            if done:
+                done()
+
     def listen_for_messages(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(('', self.message_port))
-        s.listen(5)
-        while True:
+        self.serve(self.message_port, self.handle_message_connection)
+
+    def handle_message_connection(self, conn, addr):
+        try:
+            for frame in self.read_frames(conn):
+                self.messages.handle_frame(frame, addr[0])
+        except Exception as e:
+            if self.on_error:
+                self.on_error(f"Error receiving message: {str(e)}")
+        finally:
+            conn.close()
+
+    def read_file_chunks(self, file_path):
+        # Reads the file on a helper thread, keeping at most send_window chunks
+        # in memory so large files never have to be loaded as a whole.
+        chunk_size = input_chunk_size(file_path, self.chunk_size)
+        chunk_queue = queue.Queue(maxsize=max(1, self.send_window))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunk_queue.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        def reader():
             try:
-                conn, addr = s.accept()
-                data = conn.recv(4096).decode()
-                if data:
-                    message_data = json.loads(data)
-                    if self.on_message_received:
-                        self.on_message_received(message_data["message"], addr[0], message_data["sender_name"])
-                conn.close()
+                with open_input(file_path) as f:
+                    chunk_id = 0
+                    while not stop.is_set():
+                        chunk = f.read(chunk_size)
+                        if not chunk and chunk_id:
+                            break
+                        put((chunk_id, chunk))  # An empty file is sent as one empty chunk
+                        chunk_id += 1
+                        if len(chunk) < chunk_size:
+                            break
+                put(None)
             except Exception as e:
-                if self.on_error:
-                    self.on_error(f"Error receiving message: {str(e)}")
-
-    def send_file_chunks(self, file_path, peers, role, sender_name, on_progress=None):
-        try:
-            file_name = os.path.basename(file_path)
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            file_size = len(file_data)
-            num_chunks = math.ceil(file_size / self.chunk_size)
-            chunks = [file_data[i:i + self.chunk_size] for i in range(0, file_size, self.chunk_size)]
-
-            for i, chunk in enumerate(chunks):
-                peer_idx = i % len(peers) if peers else 0
-                peer_ip = peers[peer_idx][0]
-                header = json.dumps({
-                    'file_name': file_name,
-                    'chunk_id': i,
-                    'total_chunks': num_chunks,
-                    'chunk_size': len(chunk),
-                    'role': role,
-                    'sender_name': sender_name
-                })
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(5)
-                    s.connect((peer_ip, self.file_port))
-                    s.sendall(header.encode() + b'\n' + chunk)
-                if on_progress:
-                    percentage = ((i + 1) / num_chunks) * 100
-                    on_progress(i + 1, num_chunks, percentage)
+                put(e)
+
+        threading.Thread(target=reader, daemon=True).start()
+        try:
+            while True:
+                item = chunk_queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def new_transfer_id(self):
+        return int.from_bytes(os.urandom(8), 'big') or 1
+
+    def set_background(self, transfer_id, background):
+        # Takes effect from the transfer's next frame
+        if background:
+            self.background_transfers.add(transfer_id)
+        else:
+            self.background_transfers.discard(transfer_id)
+
+    def set_paused(self, transfer_id, paused):
+        # Sends pause in their progress callback, but chunks asked for again
+        # (repairs, resumed downloads, swarm requests) are served from reader
+        # threads, so those are held back here. Held re-fetches go out on resume.
+        swarm = self.swarms.get(transfer_id)
+        if swarm is not None:
+            swarm.paused = paused
+        if paused:
+            self.held_requests.setdefault(transfer_id, {})
+            return
+        sent = self.sources.get(transfer_id)
+        for peer_ip, chunk_ids in self.held_requests.pop(transfer_id, {}).items():
+            if sent is not None:
+                threading.Thread(target=self.send_repairs, args=(sent[0], transfer_id, peer_ip, sorted(chunk_ids)), daemon=True).start()
+
+    def drop_transfer(self, transfer_id):
+        # A cancelled transfer: chunks asked for again are no longer sent
+        self.held_requests.pop(transfer_id, None)
+        self.send_goodput(transfer_id)
+        sent = self.sources.pop(transfer_id, None)
+        if sent is not None:
+            sent[0].close()
+
+    def report_complete(self, transfer_id):
+        # Tells the sender of a transfer this peer has all of it
+        manifest = self.manifests.get(transfer_id)
+        if manifest is None:
+            return  # Multicast receivers confirm through their NACKs
+        header = self.frame_header(KIND_COMPLETE, b'', 0, transfer_id, 0, manifest.total_chunks)
+        try:
+            self.send_frame(manifest.origin, self.file_port, header)
+        except Exception as e:
+            self.mark_unreachable(manifest.origin, f"Error reporting completion to {manifest.origin}: {str(e)}")
+
+    def report_sent(self, transfer_id, recipients, total_chunks):
+        # Tells every recipient the sender is done, so each one asks for
+        # whatever it is still missing. A recipient that cannot be reached
+        # asks once it is back (see on_transfer_sent).
+        header = self.frame_header(KIND_SENT, b'', 0, transfer_id, 0, total_chunks)
+        for peer_ip in recipients:
+            if self.is_unreachable(peer_ip):
+                continue
+            try:
+                self.send_frame(peer_ip, self.file_port, header)
+            except Exception:
+                self.mark_unreachable(peer_ip)
+
+    def transfer_completed(self, transfer_id, peer_ip):
+        if self.on_transfer_complete:
+            self.on_transfer_complete(transfer_id, peer_ip)
+
+    def is_unreachable(self, peer_ip):
+        failed_at = self.unreachable.get(peer_ip)
+        return failed_at is not None and time.monotonic() - failed_at < self.unreachable_backoff
+
+    def mark_unreachable(self, peer_ip, error=None):
+        # Only the first failure is reported, so a missing peer does not raise
+        # an error for every chunk
+        if error is not None and not self.is_unreachable(peer_ip) and self.on_error:
+            self.on_error(error)
+        self.unreachable[peer_ip] = time.monotonic()
+
+    def file_meta(self, file_path, role, sender_name, recipients, **extra):
+        return dict({
+            'file_name': input_name(file_path),
+            'chunk_size': input_chunk_size(file_path, self.chunk_size),
+            'file_size': input_size(file_path),
+            'role': role,
+            'sender_name': sender_name,
+            'recipients': recipients
+        }, **input_meta(file_path), **extra)
+
+    def prepare_transfer(self, file_path, recipients, role, sender_name, background=False, transfer_id=None, **extra):
+        # Hashes the file and sends its manifest straight to every recipient
+        # ahead of the data. Returns the transfer id and metadata, which
+        # carries the manifest's Merkle root.
+        transfer_id = transfer_id or self.new_transfer_id()
+        self.set_background(transfer_id, background)
+        if background:
+            extra['background'] = True  # Swarm peers send each other its chunks as background traffic too
+        manifest = Manifest.from_file(file_path, input_chunk_size(file_path, self.chunk_size))
+        meta = self.file_meta(file_path, role, sender_name, recipients, root=manifest.root.hex(), **extra)
+        listing = input_listing(file_path)
+        manifest_meta = dict(meta, listing=len(listing)) if listing else meta
+        payload = manifest.hashes + listing
+        self.keep_manifest_frame(transfer_id, manifest_meta, payload, manifest.total_chunks)
+        header = self.frame_header(KIND_MANIFEST, encode_meta(manifest_meta), len(payload), transfer_id, 0, manifest.total_chunks)
+        with self.cache_replies_changed:
+            self.cache_replies[transfer_id] = {}
+        for peer_ip in recipients:
+            try:
+                self.send_frame(peer_ip, self.file_port, header, payload)
+            except Exception as e:
+                self.mark_unreachable(peer_ip, f"Error sending manifest to {peer_ip}: {str(e)}")
+        return transfer_id, meta
+
+    def cached_chunks(self, transfer_id, recipients, meta):
+        # Recipients answer the manifest with the chunks they already hold.
+        # Chunks most of them have are not sent at all, so one recipient
+        # without an old copy does not force a full resend; the few lacking
+        # such a chunk request it once the send is done (see report_sent).
+        # Recipients that do not answer in time count as holding nothing.
+        total_chunks = max(1, math.ceil(meta['file_size'] / meta['chunk_size']))
+        deadline = time.monotonic() + (self.delta_reply_timeout if meta.get('folder') else self.cache_reply_timeout)
+        with self.cache_replies_changed:
+            while True:
+                replies = self.cache_replies[transfer_id]
+                pending = [ip for ip in recipients if ip not in replies and not self.is_unreachable(ip)]
+                remaining = deadline - time.monotonic()
+                if not pending or remaining <= 0:
+                    break
+                self.cache_replies_changed.wait(remaining)
+            del self.cache_replies[transfer_id]
+        holders = [bitmap for bitmap in replies.values() if bitmap.total_chunks == total_chunks]
+        if not holders:
+            return set()
+        quorum = self.cached_share * (len(replies) + len(pending))
+        return {chunk_id for chunk_id in range(total_chunks) if sum(chunk_id in bitmap for bitmap in holders) >= quorum}
+
+    def on_cache_reply(self, transfer_id, peer_ip, payload, total_chunks):
+        with self.cache_replies_changed:
+            replies = self.cache_replies.get(transfer_id)
+            if replies is not None:
+                try:
+                    replies[peer_ip] = ChunkBitmap(total_chunks, payload)
+                except ValueError:
+                    return  # Malformed reply, the peer counts as not having answered
+                self.cache_replies_changed.notify_all()
+
+    def keep_source(self, transfer_id, file_path):
+        # Keeps a sent file open for a while so bad chunks can be fetched again
+        now = time.monotonic()
+        for old_id, (source, expires) in list(self.sources.items()):
+            if expires < now:
+                del self.sources[old_id]
+                source.close()
+        self.sources[transfer_id] = (FileSource(file_path, input_chunk_size(file_path, self.chunk_size)), now + self.source_linger)
+
+    def send_file_chunks(self, file_path, peers, role, sender_name, on_progress=None, background=False, transfer_id=None):
+        # Each chunk is uploaded once, to one recipient picked round-robin,
+        # which relays it to all the other recipients. Every recipient ends up
+        # with the whole file while the sender's upload stays at one copy.
+        try:
+            recipients = self.plan_recipients([peer[0] for peer in peers], input_size(file_path))
+            transfer_id, meta = self.prepare_transfer(file_path, recipients, role, sender_name, background, transfer_id)
+            self.keep_source(transfer_id, file_path)
+            num_chunks = max(1, math.ceil(meta['file_size'] / meta['chunk_size']))
+            cached = self.cached_chunks(transfer_id, recipients, meta)
+            meta = encode_meta(meta)
+
+            with StripedSender(self.stripe_width(len(recipients))) as striper:
+                for i, codec, payload in self.encode_chunks(self.read_file_chunks(file_path), cached):
+                    if payload is not None:
+                        header = self.frame_header(KIND_CHUNK, meta, len(payload), transfer_id, i, num_chunks, FLAG_RELAY, codec)
+                        striper.submit(self.timed_send, transfer_id, self.send_to_relay, recipients, i, header, payload)
+                    if on_progress:
+                        percentage = ((i + 1) / num_chunks) * 100
+                        on_progress(i + 1, num_chunks, percentage)
+            self.report_sent(transfer_id, recipients, num_chunks)
             return True
+        except TransferCancelled:
+            self.drop_transfer(transfer_id)
+            return False
         except Exception as e:
             if self.on_error:
                 self.on_error(f"Error sending file chunks: {str(e)}")
             return False
 
-    def listen_for_file_chunks(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(('', self.file_port))
-        s.listen(5)
+    def encode_chunks(self, chunks, skip):
+        # (chunk id, codec, payload) for each chunk, None payloads for skipped ones
+        if self.compressor is not None:
+            return self.compressor.encode(chunks, skip)
+        return ((chunk_id, CODEC_NONE, None if chunk_id in skip else chunk) for chunk_id, chunk in chunks)
+
+    def stripe_width(self, first_hops):
+        # Enough concurrent chunk sends to keep every stream to every first
+        # hop busy; each peer's StreamTuner decides how many streams it gets
+        return max(1, min(self.max_stripe_width, first_hops * self.pool.max_streams))
+
+    def timed_send(self, transfer_id, send, target, chunk_id, header, payload):
+        # Feeds the upload rate to the compressor, which weighs it against CPU
+        # cost, and to the transfer's goodput. Striped sends share the link,
+        # so each one counts for its share of the time it took.
+        with self.sends_lock:
+            self.sends_in_flight += 1
+        started = time.monotonic()
+        try:
+            send(target, chunk_id, header, payload)
+        finally:
+            with self.sends_lock:
+                sharing = self.sends_in_flight
+                self.sends_in_flight -= 1
+        self.record_send(transfer_id, len(header) + len(payload), (time.monotonic() - started) / sharing)
+
+    def record_send(self, transfer_id, nbytes, seconds):
+        if self.compressor is not None:
+            self.compressor.record_send(nbytes, seconds)
+        with self.sends_lock:
+            stats = self.send_stats.setdefault(transfer_id, [0, 0.0])
+            stats[0] += nbytes
+            stats[1] += seconds
+
+    def send_goodput(self, transfer_id):
+        # Bytes per second a finished transfer was written to sockets at, or
+        # None if nothing was sent over TCP (all cached, swarm, multicast).
+        # Hashing, cache replies and skipped chunks do not count.
+        with self.sends_lock:
+            nbytes, seconds = self.send_stats.pop(transfer_id, (0, 0.0))
+        return nbytes / seconds if seconds > 0 else None
+
+    def send_to_relay(self, recipients, chunk_id, header, chunk):
+        # Falls through to the next recipient when the chosen relay is down
+        for n in range(len(recipients)):
+            peer_ip = recipients[(chunk_id + n) % len(recipients)]
+            if self.is_unreachable(peer_ip):
+                continue
+            try:
+                self.send_frame(peer_ip, self.file_port, header, chunk)
+                return peer_ip
+            except Exception as e:
+                self.mark_unreachable(peer_ip, f"Error sending chunk to {peer_ip}: {str(e)}")
+        raise ConnectionError(f"No reachable peer for chunk {chunk_id}")
+
+    def broadcast_file(self, file_path, peers, role, sender_name, on_progress=None, fanout=None, background=False, transfer_id=None):
+        # Chain/tree mode: the recipients form a k-ary tree (see BroadcastTree)
+        # and each one forwards a chunk to its children while still receiving
+        # it, so the transfer is pipelined down the tree instead of every
+        # chunk being fully stored before it is passed on
+        try:
+            recipients = self.plan_recipients([peer[0] for peer in peers], input_size(file_path))
+            tree = BroadcastTree(recipients, fanout or self.tree_fanout)
+            transfer_id, meta = self.prepare_transfer(file_path, recipients, role, sender_name, background, transfer_id, fanout=tree.fanout)
+            self.keep_source(transfer_id, file_path)
+            num_chunks = max(1, math.ceil(meta['file_size'] / meta['chunk_size']))
+            cached = self.cached_chunks(transfer_id, recipients, meta)
+            meta = encode_meta(meta)
+
+            with StripedSender(self.stripe_width(1)) as striper:
+                for i, codec, payload in self.encode_chunks(self.read_file_chunks(file_path), cached):
+                    if payload is not None:
+                        header = self.frame_header(KIND_CHUNK, meta, len(payload), transfer_id, i, num_chunks, 0, codec)
+                        striper.submit(self.timed_send, transfer_id, self.send_to_tree, tree, i, header, payload)
+                    if on_progress:
+                        on_progress(i + 1, num_chunks, ((i + 1) / num_chunks) * 100)
+            self.report_sent(transfer_id, recipients, num_chunks)
+            return True
+        except TransferCancelled:
+            self.drop_transfer(transfer_id)
+            return False
+        except Exception as e:
+            if self.on_error:
+                self.on_error(f"Error broadcasting file: {str(e)}")
+            return False
+
+    def send_to_tree(self, tree, chunk_id, header, chunk):
+        # The root normally gets the only copy. A peer that cannot be reached
+        # is replaced by its children, so its subtree is still served.
+        pending = tree.children(None, self.is_unreachable)
+        if not pending:
+            raise ConnectionError(f"No reachable peer for chunk {chunk_id}")
+        while pending:
+            peer_ip = pending.pop(0)
+            try:
+                self.send_frame(peer_ip, self.file_port, header, chunk)
+            except Exception as e:
+                self.mark_unreachable(peer_ip, f"Error sending chunk to {peer_ip}: {str(e)}")
+                pending.extend(tree.children(peer_ip, self.is_unreachable))
+
+    def cut_through(self, own_ip):
+        # FrameReader hook that starts forwarding tree-mode chunks to this
+        # peer's children as soon as their header has arrived
+        def on_header(kind, flags, transfer_id, meta, raw_header):
+            if kind != KIND_CHUNK or flags & FLAG_REPAIR or 'fanout' not in meta or transfer_id in self.swarms:
+                return None
+            forwarder = CutThroughForwarder(self, BroadcastTree(meta.get('recipients', []), meta['fanout']), own_ip, raw_header)
+            return forwarder if forwarder else None
+        return on_header
+
+    def send_file_multicast(self, file_path, peers, role, sender_name, on_progress=None, background=False, transfer_id=None):
+        # Multicast mode: every packet is sent once to the group, so the
+        # sender's upload does not grow with the number of peers. Lost
+        # packets are repaired from the receivers' NACKs.
+        sender = None
+        try:
+            source = FileSource(file_path, self.multicast_payload_size)
+            recipients = self.plan_recipients([peer[0] for peer in peers], input_size(file_path))
+            meta = self.file_meta(file_path, role, sender_name, recipients, chunk_size=self.multicast_payload_size)
+            if self.fec_repair_count:
+                meta['fec'] = [self.fec_block_size, self.fec_repair_count]
+            transfer_id = transfer_id or self.new_transfer_id()
+            self.set_background(transfer_id, background)
+            sender = MulticastSender(self, transfer_id, meta, source, recipients)
+            sender.run(on_progress)
+            return True
+        except TransferCancelled:
+            return False
+        except Exception as e:
+            if self.on_error:
+                self.on_error(f"Error multicasting file: {str(e)}")
+            return False
+        finally:
+            if sender is not None:
+                sender.close()
+
+    def listen_for_multicast(self):
+        try:
+            sock = self.multicast.open_socket()
+        except Exception as e:
+            if self.on_error:
+                self.on_error(f"Error joining multicast group: {str(e)}")
+            return
         while True:
             try:
-                conn, addr = s.accept()
-                header_data = b''
-                while b'\n' not in header_data:
-                    header_data += conn.recv(1024)
-                header, chunk_data = header_data.split(b'\n', 1)
-                header = json.loads(header.decode())
-                file_name = header['file_name']
-                chunk_id = header['chunk_id']
-                total_chunks = header['total_chunks']
-                chunk_size = header['chunk_size']
-                role = header['role']
-                sender_name = header.get('sender_name', 'Unknown')
-
-                while len(chunk_data) < chunk_size:
-                    chunk_data += conn.recv(4096)
-
-                if self.on_file_chunk_received:
-                    self.on_file_chunk_received(file_name, chunk_id, total_chunks, chunk_data, addr[0], role, sender_name)
-                conn.close()
-
-                if role == 'student':
-                    for peer in self.peers:
-                        if peer[0] != addr[0]:
-                            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                                s.settimeout(5)
-                                s.connect((peer[0], self.file_port))
-                                s.sendall(header.encode() + b'\n' + chunk_data)
+                data, addr = sock.recvfrom(65535)
+                self.multicast.handle_datagram(data, addr)
             except Exception as e:
                 if self.on_error:
-                    self.on_error(f"Error receiving chunk: {str(e)}")
-                conn.close()
\ No newline at end of file
+                    self.on_error(f"Error receiving multicast packet: {str(e)}")
+
+    def listen_for_file_chunks(self):
+        self.serve(self.file_port, self.handle_file_connection)
+
+    def chunk_header(self, frame):
+        header = dict(frame.meta, transfer_id=frame.transfer_id, chunk_id=frame.seq, total_chunks=frame.total)
+        header.setdefault('sender_name', 'Unknown')
+        return header
+
+    def handle_file_connection(self, conn, addr):
+        verifier = VerifyQueue(self)
+        try:
+            own_ip = conn.getsockname()[0]
+            for frame in self.read_frames(conn, self.cut_through(own_ip)):
+                if frame.kind == KIND_CHUNK:
+                    # Chunks are hashed off this thread; frame.payload points
+                    # into the reader's buffer, so the verifier gets a copy
+                    verifier.submit(self.handle_file_frame, frame.copy(), own_ip, addr[0])
+                else:
+                    self.handle_file_frame(frame, own_ip, addr[0])
+        except Exception as e:
+            if self.on_error:
+                self.on_error(f"Error receiving chunk: {str(e)}")
+        finally:
+            verifier.close()
+            conn.close()
+
+    def handle_file_frame(self, frame, own_ip, source_ip):
+        if frame.kind == KIND_MANIFEST:
+            self.on_manifest(frame, source_ip)
+            return
+        swarm = self.swarms.get(frame.transfer_id)
+        if swarm is not None or frame.kind != KIND_CHUNK:
+            self.handle_swarm_frame(swarm, frame, own_ip, source_ip)
+            return
+        if self.deliver_chunk(frame, source_ip) and frame.flags & FLAG_RELAY:
+            self.relay_chunk(frame, own_ip, source_ip)  # Only verified chunks are passed on
+
+    def deliver_chunk(self, frame, source_ip):
+        if frame.flags & FLAG_REPAIR or not frame.meta:
+            manifest = self.manifests.get(frame.transfer_id)
+            if manifest is None:
+                return False
+            frame.meta = manifest.meta  # Re-sent chunks carry no metadata
+        # frame.payload stays as sent, so relays pass on the compressed bytes
+        data = decode_chunk(frame.codec, frame.payload, frame.meta.get('chunk_size', self.chunk_size))
+        if not self.verify_chunk(frame.transfer_id, frame.meta, frame.seq, data, source_ip):
+            self.request_chunks(frame.transfer_id, [frame.seq])
+            return False
+        if self.on_file_chunk_received:
+            self.on_file_chunk_received(self.chunk_header(frame), data, source_ip)
+        return True
+
+    def on_manifest(self, frame, source_ip):
+        meta, hashes = frame.meta, frame.payload
+        if meta.get('listing'):
+            # A listing too large for frame metadata, e.g. a folder's files
+            split = len(frame.payload) - meta['listing']
+            hashes = frame.payload[:split]
+            decoder = zlib.decompressobj()
+            listing = decoder.decompress(frame.payload[split:], MAX_PAYLOAD_SIZE)
+            if decoder.unconsumed_tail:
+                raise ValueError(f"Listing for {meta.get('file_name')} is too large")
+            meta = dict(meta, **json.loads(listing.decode()))
+        manifest = Manifest(meta['file_size'], meta['chunk_size'], hashes)
+        if manifest.root.hex() != meta.get('root'):
+            raise ValueError(f"Manifest for {meta.get('file_name')} does not match its root hash")
+        manifest.meta = meta
+        manifest.origin = frame.meta.get('origin', source_ip)  # Set when a relay sent it again
+        self.keep_manifest_frame(frame.transfer_id, frame.meta, bytes(frame.payload), frame.total)
+        self.add_manifest(frame.transfer_id, manifest)
+        if self.open_store is not None:
+            self.reply_cached(frame.transfer_id, manifest)
+        dropped = self.manifests_missing.pop(frame.transfer_id, None)
+        if dropped:
+            self.request_chunks(frame.transfer_id, sorted(dropped))
+
+    def keep_manifest_frame(self, transfer_id, meta, payload, total_chunks):
+        with self.manifests_changed:
+            if len(self.manifest_frames) >= 64:
+                self.manifest_frames.pop(next(iter(self.manifest_frames)))
+            self.manifest_frames[transfer_id] = (meta, payload, total_chunks)
+
+    def request_manifest(self, transfer_id, peer_ip):
+        header = self.frame_header(KIND_MANIFEST_REQUEST, b'', 0, transfer_id)
+        try:
+            self.send_frame(peer_ip, self.file_port, header)
+        except Exception:
+            self.mark_unreachable(peer_ip)
+
+    def send_manifest(self, transfer_id, peer_ip):
+        # Sends a manifest again to a peer whose chunks arrived without it. A
+        # relay passes on the one it got, naming the peer that sent it.
+        sent = self.manifest_frames.get(transfer_id)
+        if sent is None:
+            return
+        meta, payload, total_chunks = sent
+        manifest = self.manifests.get(transfer_id)
+        if manifest is not None:
+            meta = dict(meta, origin=manifest.origin)
+        header = self.frame_header(KIND_MANIFEST, encode_meta(meta), len(payload), transfer_id, 0, total_chunks)
+        try:
+            self.send_frame(peer_ip, self.file_port, header, payload)
+        except Exception as e:
+            self.mark_unreachable(peer_ip, f"Error sending manifest to {peer_ip}: {str(e)}")
+
+    def reply_cached(self, transfer_id, manifest):
+        # Tells the sender which chunks are already held locally, in the cache
+        # or wherever find_local looks, then fills them in on another thread
+        local = self.find_local(manifest) if self.find_local is not None else {}
+        cached = ChunkBitmap(manifest.total_chunks)
+        for chunk_id in range(manifest.total_chunks):
+            if chunk_id in local or self.chunk_cache is not None and manifest.chunk_hash(chunk_id) in self.chunk_cache:
+                cached.add(chunk_id)
+        bits = cached.to_bytes()
+        header = self.frame_header(KIND_BITFIELD, b'', len(bits), transfer_id, 0, manifest.total_chunks)
+        try:
+            self.send_frame(manifest.origin, self.file_port, header, bits)
+        except Exception as e:
+            self.mark_unreachable(manifest.origin, f"Error answering manifest from {manifest.origin}: {str(e)}")
+        if len(cached):
+            threading.Thread(target=self.load_cached, args=(transfer_id, manifest, cached, local), daemon=True).start()
+
+    def load_cached(self, transfer_id, manifest, cached, local):
+        # Chunks evicted, changed or damaged since the reply was sent are
+        # fetched from the sender instead
+        lost = []
+        for chunk_id in range(manifest.total_chunks):
+            if chunk_id not in cached:
+                continue
+            data = local[chunk_id]() if chunk_id in local else None
+            if data is None or not manifest.verify(chunk_id, data):
+                data = self.chunk_cache.get(manifest.chunk_hash(chunk_id)) if self.chunk_cache is not None else None
+            if data is None:
+                lost.append(chunk_id)
+            elif self.on_file_chunk_received:
+                header = dict(manifest.meta, transfer_id=transfer_id, chunk_id=chunk_id, total_chunks=manifest.total_chunks)
+                header.setdefault('sender_name', 'Unknown')
+                self.on_file_chunk_received(header, data, manifest.origin)
+        self.request_chunks(transfer_id, lost)
+
+    def add_manifest(self, transfer_id, manifest):
+        with self.manifests_changed:
+            if len(self.manifests) >= 64:
+                self.manifests.pop(next(iter(self.manifests)))
+            self.manifests[transfer_id] = manifest
+            self.manifests_changed.notify_all()
+
+    def verify_chunk(self, transfer_id, meta, chunk_id, data, source_ip):
+        # Checks a chunk against its transfer's manifest, which may still be
+        # on its way when the chunk came through another peer
+        if 'root' not in meta:
+            return True  # Transfers without a manifest, e.g. multicast
+        with self.manifests_changed:
+            # Only the first chunks wait, once the manifest is known to be
+            # missing the rest are dropped at once and fetched when it arrives
+            dropped = self.manifests_missing.get(transfer_id)
+            if dropped is None:
+                self.manifests_changed.wait_for(lambda: transfer_id in self.manifests, self.manifest_timeout)
+            manifest = self.manifests.get(transfer_id)
+            first = manifest is None and transfer_id not in self.manifests_missing
+            if first:
+                if len(self.manifests_missing) >= 64:
+                    self.manifests_missing.pop(next(iter(self.manifests_missing)))
+                self.manifests_missing[transfer_id] = set()
+            if manifest is None:
+                self.manifests_missing.setdefault(transfer_id, set()).add(chunk_id)
+        if manifest is None:
+            if first:
+                self.request_manifest(transfer_id, source_ip)
+                if self.on_error:
+                    self.on_error(f"No manifest received for {meta.get('file_name')}, asked {source_ip} for it again")
+            return False
+        if manifest.verify(chunk_id, data):
+            if self.chunk_cache is not None:
+                self.chunk_cache.put(manifest.chunk_hash(chunk_id), data)
+            return True
+        if self.on_error:
+            self.on_error(f"Chunk {chunk_id} of {meta.get('file_name')} from {source_ip} failed verification")
+        return False
+
+    def request_chunks(self, transfer_id, chunk_ids, report=True):
+        # Asks the peer that sent the manifest for chunks again. Returns
+        # whether the request went out; report=False keeps a failure quiet.
+        manifest = self.manifests.get(transfer_id)
+        if manifest is None or not chunk_ids:
+            return False
+        payload = b''.join(CHUNK_ID.pack(chunk_id) for chunk_id in chunk_ids)
+        header = self.frame_header(KIND_REQUEST, b'', len(payload), transfer_id, 0, manifest.total_chunks)
+        try:
+            self.send_frame(manifest.origin, self.file_port, header, payload)
+            return True
+        except Exception as e:
+            self.mark_unreachable(manifest.origin, f"Error requesting chunks from {manifest.origin}: {str(e)}" if report else None)
+            return False
+
+    def request_missing(self, transfer_id, bitmap, report=True):
+        # Resuming a download: only the chunks that never arrived are sent again
+        chunk_ids = [chunk_id for first, count in bitmap.missing_ranges() for chunk_id in range(first, first + count)]
+        return self.request_chunks(transfer_id, chunk_ids, report)
+
+    def send_repairs(self, source, transfer_id, peer_ip, chunk_ids):
+        for chunk_id in chunk_ids:
+            if not 0 <= chunk_id < source.total_chunks:
+                continue
+            codec, chunk = CODEC_NONE, source.read_chunk(chunk_id)
+            if chunk is None:
+                return  # The transfer was cancelled
+            if self.compressor is not None:
+                codec, chunk = self.compressor.compress(chunk)
+            header = self.frame_header(KIND_CHUNK, b'', len(chunk), transfer_id, chunk_id, source.total_chunks, FLAG_REPAIR, codec)
+            try:
+                self.send_frame(peer_ip, self.file_port, header, chunk)
+            except Exception as e:
+                self.mark_unreachable(peer_ip, f"Error re-sending chunk to {peer_ip}: {str(e)}")
+                return
+
+    def relay_targets(self, frame, own_ip, source_ip):
+        return [peer_ip for peer_ip in frame.meta.get('recipients', [])
+                if peer_ip not in (own_ip, source_ip) and not self.is_unreachable(peer_ip)]
+
+    def relay_chunk(self, frame, own_ip, source_ip):
+        # Forwarded copies have the relay flag cleared so they stop at the recipient
+        header = replace_flags(frame.raw_header, frame.flags & ~FLAG_RELAY)
+        for peer_ip in self.relay_targets(frame, own_ip, source_ip):
+            try:
+                self.send_frame(peer_ip, self.file_port, header, frame.payload)
+            except Exception as e:
+                self.mark_unreachable(peer_ip, f"Error relaying chunk to {peer_ip}: {str(e)}")
+
+    def seed_file(self, file_path, peers, role, sender_name, on_progress=None, background=False, transfer_id=None):
+        # Swarm mode: announces the file to the peers and serves chunks on
+        # request until every peer reports a complete copy
+        source = swarm = None
+        try:
+            source = FileSource(file_path, input_chunk_size(file_path, self.chunk_size))
+            transfer_id, meta = self.prepare_transfer(file_path, self.plan_recipients([peer[0] for peer in peers], input_size(file_path)), role, sender_name, background, transfer_id, swarm=True)
+            with self.cache_replies_changed:
+                del self.cache_replies[transfer_id]  # Cached chunks show up in the peers' bitfields
+            swarm = Swarm(self, transfer_id, meta, source, None)
+            with self.swarms_lock:
+                self.swarms[transfer_id] = swarm
+            swarm.announce()
+            last_held, last_change = -1, time.monotonic()
+            while True:
+                held, total, done = swarm.progress()
+                if held != last_held:
+                    last_held, last_change = held, time.monotonic()
+                if on_progress:
+                    # Called every round, as pausing and cancelling act in it
+                    waited = time.monotonic()
+                    on_progress(held, total, (held / total) * 100)
+                    last_change += time.monotonic() - waited  # Time spent paused is not a stall
+                if done:
+                    return True
+                if time.monotonic() - last_change > self.swarm_stall_timeout:
+                    raise TimeoutError("Swarm made no progress, some peers may have left")
+                # Peers that missed the first announcement (e.g. still starting) get it again
+                swarm.announce([ip for ip in swarm.members() if ip not in swarm.neighbours])
+                time.sleep(1)
+        except TransferCancelled:
+            return False
+        except Exception as e:
+            if self.on_error:
+                self.on_error(f"Error seeding file: {str(e)}")
+            return False
+        finally:
+            if swarm is not None:
+                self.close_swarm(transfer_id, swarm)
+            if source is not None:
+                source.close()
+
+    def close_swarm(self, transfer_id, swarm):
+        with self.swarms_lock:
+            if self.swarms.get(transfer_id) is swarm:
+                del self.swarms[transfer_id]
+        swarm.close()
+
+    def handle_swarm_frame(self, swarm, frame, own_ip, source_ip):
+        if frame.kind == KIND_COMPLETE:
+            self.transfer_completed(frame.transfer_id, source_ip)
+            return
+        if frame.kind == KIND_SENT:
+            if self.on_transfer_sent:
+                self.on_transfer_sent(frame.transfer_id)
+            return
+        if frame.kind == KIND_MANIFEST_REQUEST:
+            threading.Thread(target=self.send_manifest, args=(frame.transfer_id, source_ip), daemon=True).start()
+            return
+        if swarm is None:
+            sent = self.sources.get(frame.transfer_id)
+            if frame.kind == KIND_REQUEST and sent is not None:
+                # A receiver re-fetching chunks that failed verification or
+                # resuming a download. Sent from another thread so this
+                # reader never blocks on a send.
+                chunk_ids = [chunk_id for (chunk_id,) in CHUNK_ID.iter_unpack(bytes(frame.payload))]
+                held = self.held_requests.get(frame.transfer_id)
+                if held is not None:
+                    held.setdefault(source_ip, set()).update(chunk_ids)
+                    return
+                threading.Thread(target=self.send_repairs, args=(sent[0], frame.transfer_id, source_ip, chunk_ids), daemon=True).start()
+                return
+            if frame.kind == KIND_BITFIELD and frame.transfer_id in self.cache_replies:
+                self.on_cache_reply(frame.transfer_id, source_ip, frame.payload, frame.total)
+                return
+            if frame.kind != KIND_BITFIELD or not frame.meta.get('swarm'):
+                return  # Unknown transfer, wait for its bitfield
+            swarm = self.join_swarm(frame, own_ip)
+            if swarm is None:
+                return
+        if frame.kind == KIND_BITFIELD:
+            swarm.on_bitfield(source_ip, frame.payload)
+        elif frame.kind == KIND_HAVE:
+            swarm.on_have(source_ip, frame.seq)
+        elif frame.kind == KIND_REQUEST:
+            swarm.on_request(source_ip, frame.payload)
+        elif frame.kind == KIND_CHUNK:
+            swarm.on_chunk(source_ip, frame.seq, decode_chunk(frame.codec, frame.payload, swarm.meta.get('chunk_size', self.chunk_size)))
+
+    def join_swarm(self, frame, own_ip):
+        if own_ip not in frame.meta.get('recipients', []) or self.open_store is None:
+            return None
+        with self.swarms_lock:
+            swarm = self.swarms.get(frame.transfer_id)
+            if swarm is None:
+                store = self.open_store(self.chunk_header(frame))
+                if frame.meta.get('background'):
+                    self.background_transfers.add(frame.transfer_id)
+                swarm = Swarm(self, frame.transfer_id, frame.meta, store, own_ip)
+                self.swarms[frame.transfer_id] = swarm
+                threading.Thread(target=swarm.run, daemon=True).start()
+        return swarm
@@ -0,0 +1,83 @@
+import threading
+import time
+
+
+class PeerInfo:
+    __slots__ = ('ip', 'port', 'peer_id', 'name', 'role', 'session', 'ports', 'disk_free', 'link_speed', 'last_seen', 'rtt')
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.peer_id = None
+        self.name = None
+        self.role = None
+        self.session = None
+        self.ports = {}  # Listening ports by service, as announced
+        self.disk_free = None  # Bytes free where the peer saves files
+        self.link_speed = None  # Bytes per second the peer has measured sending
+        self.last_seen = time.monotonic()
+        self.rtt = None  # Seconds, smoothed over announce round trips
+
+
+class PeerRegistry:
+    # Live peers keyed by IP. Iterating gives (ip, port) pairs of the peers
+    # heard from within timeout seconds, so the registry can be passed
+    # anywhere a list of peers is expected; membership tests are by IP.
+    def __init__(self, timeout=15):
+        self.timeout = timeout
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def seen(self, ip, port, **fields):
+        # Records that ip is alive along with the PeerInfo fields it
+        # announced. Returns True if it is a new peer.
+        with self.lock:
+            peer = self.entries.get(ip)
+            new = peer is None
+            if new:
+                peer = self.entries[ip] = PeerInfo(ip, port)
+            peer.last_seen = time.monotonic()
+            for field, value in fields.items():
+                if value is not None:
+                    setattr(peer, field, value)
+            return new
+
+    def record_rtt(self, ip, rtt):
+        with self.lock:
+            peer = self.entries.get(ip)
+            if peer is not None:
+                peer.last_seen = time.monotonic()
+                peer.rtt = rtt if peer.rtt is None else 0.8 * peer.rtt + 0.2 * rtt
+
+    def get(self, ip):
+        return self.entries.get(ip)
+
+    def name(self, ip, default="Unknown"):
+        peer = self.entries.get(ip)
+        return peer.name if peer is not None and peer.name else default
+
+    def expire(self):
+        # Drops peers not heard from within timeout, returns them
+        cutoff = time.monotonic() - self.timeout
+        with self.lock:
+            stale = [peer for peer in self.entries.values() if peer.last_seen < cutoff]
+            for peer in stale:
+                del self.entries[peer.ip]
+        return stale
+
+    def clear(self):
+        # Drops every peer, returns them
+        with self.lock:
+            dropped = list(self.entries.values())
+            self.entries.clear()
+        return dropped
+
+    def __contains__(self, ip):
+        return ip in self.entries
+
+    def __iter__(self):
+        with self.lock:
+            return iter([(peer.ip, peer.port) for peer in self.entries.values()])
+
+    def __len__(self):
+        return len(self.entries)
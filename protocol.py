@@ -0,0 +1,196 @@
+import json
+import os
+import socket
+import struct
+
+# Every frame on a TCP stream is a fixed binary header, followed by meta_len
+# bytes of JSON metadata and payload_len bytes of payload. The metadata only
+# changes per transfer, so receivers decode it once per transfer_id.
+MAGIC = b'GP'
+PROTOCOL_VERSION = 1
+# magic, version, kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len
+HEADER = struct.Struct('!2sBBBBHIQIII')
+
+KIND_MESSAGE = 1
+KIND_CHUNK = 2
+KIND_BITFIELD = 3  # Swarm: full have-bitmap of a transfer, carries the transfer metadata
+KIND_HAVE = 4  # Swarm: the sender now has chunk seq
+KIND_REQUEST = 5  # Swarm: payload is a list of requested chunk ids
+KIND_MCAST_DATA = 6  # Multicast datagram: packet seq of a transfer
+KIND_MCAST_STATUS = 7  # Multicast datagram: transfer metadata, seq is the number of packets sent so far
+KIND_NACK = 8  # Unicast reply to a status: payload lists missing packet ranges, empty once complete
+KIND_MCAST_REPAIR = 9  # Multicast datagram: FEC repair packet seq % r of block seq // r
+KIND_MANIFEST = 10  # Sent ahead of a transfer's chunks: payload is the SHA-256 of every chunk
+KIND_ACK = 11  # Message bus: every message up to seq from the sender in the metadata has arrived
+KIND_COMPLETE = 12  # Receiver to sender: every chunk of the transfer has arrived
+KIND_SENT = 13  # Sender to receivers: every chunk of the transfer has gone out, missing ones are to be requested
+KIND_MANIFEST_REQUEST = 14  # Receiver to the peer a chunk came from: send the transfer's manifest again
+
+FLAG_RELAY = 0x01  # Receiver forwards the chunk to the transfer's other recipients
+FLAG_REPAIR = 0x02  # Chunk re-sent to one receiver after it failed verification, never forwarded
+FLAG_BACKGROUND = 0x04  # File data of a background transfer, sent after everything else (see scheduler.py)
+KIND_OFFSET = 3
+FLAGS_OFFSET = 4
+
+# Sessions keep labs sharing a network apart. A session is a 6 character
+# join code the teacher hands out, carried in every frame as its 30-bit
+# number; 0 is the session of peers that have not joined one.
+SESSION_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # No 0/O or 1/I mix-ups
+SESSION_CODE_LENGTH = 6
+
+MAX_META_SIZE = 0xFFFF  # meta_len is an unsigned short in the header
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+
+def encode_meta(meta):
+    data = json.dumps(meta, separators=(',', ':')).encode()
+    if len(data) > MAX_META_SIZE:
+        raise ValueError(f"Frame metadata too large ({len(data)} bytes)")
+    return data
+
+
+def new_join_code():
+    return ''.join(SESSION_ALPHABET[b % len(SESSION_ALPHABET)] for b in os.urandom(SESSION_CODE_LENGTH))
+
+
+def session_id(code):
+    if not code:
+        return 0
+    code = code.strip().upper()
+    if len(code) != SESSION_CODE_LENGTH or any(c not in SESSION_ALPHABET for c in code):
+        raise ValueError(f"Invalid join code {code!r}")
+    value = 0
+    for c in code:
+        value = value * len(SESSION_ALPHABET) + SESSION_ALPHABET.index(c)
+    return value + 1  # Never 0
+
+
+def pack_header(kind, meta, payload_len, transfer_id=0, seq=0, total=0, flags=0, codec=0, session=0):
+    # meta is the already encoded metadata, so senders encode it once per transfer.
+    # codec says how the payload is compressed (see compression.py).
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, kind, flags, codec, len(meta), session, transfer_id, seq, total, payload_len) + meta
+
+
+def replace_flags(raw_header, flags):
+    # Copies only the header and metadata, never the payload
+    header = bytearray(raw_header)
+    header[FLAGS_OFFSET] = flags
+    return header
+
+
+def unpack_header(data):
+    magic, version, kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("Not a GEHU P2P frame")
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version {version}")
+    if meta_len > MAX_META_SIZE or payload_len > MAX_PAYLOAD_SIZE:
+        raise ValueError("Frame too large")
+    return kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len
+
+
+class Frame:
+    __slots__ = ('kind', 'flags', 'codec', 'transfer_id', 'seq', 'total', 'meta', 'raw_header', 'payload')
+
+    def __init__(self, kind, flags, codec, transfer_id, seq, total, meta, raw_header, payload):
+        self.kind = kind
+        self.flags = flags
+        self.codec = codec
+        self.transfer_id = transfer_id
+        self.seq = seq
+        self.total = total
+        self.meta = meta
+        self.raw_header = raw_header  # Header and metadata exactly as received, for relaying
+        self.payload = payload
+
+    def copy(self):
+        # Frames from FrameReader point into its buffer, the copy owns its data
+        return Frame(self.kind, self.flags, self.codec, self.transfer_id, self.seq, self.total, self.meta,
+                     bytes(self.raw_header), bytes(self.payload))
+
+
+class MetaCache:
+    def __init__(self, size=64):
+        self.size = size
+        self.entries = {}
+
+    def decode(self, transfer_id, data):
+        # Messages use transfer_id 0 and are always decoded. Frames may omit
+        # the metadata once the receiver has seen it for the transfer.
+        if transfer_id and transfer_id in self.entries:
+            return self.entries[transfer_id]
+        if not data:
+            return {}
+        meta = json.loads(bytes(data).decode())
+        if transfer_id:
+            if len(self.entries) >= self.size:
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[transfer_id] = meta
+        return meta
+
+
+class FrameReader:
+    # Reads frames from a blocking socket with recv_into, reusing one buffer.
+    # A frame's payload is a memoryview into that buffer, so it is only valid
+    # until the next call to read_frame; copy it to keep it.
+    def __init__(self, sock, buffer_size=1024 * 1024, session=0):
+        self.sock = sock
+        self.buffer = bytearray(HEADER.size + buffer_size)
+        self.meta_cache = MetaCache()
+        self.session = session  # Frames of any other session end the stream
+
+    def recv_exact(self, view):
+        while view:
+            received = self.sock.recv_into(view)
+            if not received:
+                return False
+            view = view[received:]
+        return True
+
+    def read_frame(self, on_header=None):
+        # on_header(kind, flags, transfer_id, meta, raw_header) may return a
+        # sink whose write() is fed each piece of the payload as it arrives,
+        # for cut-through forwarding, and whose close(failed) is called at the end
+        header_view = memoryview(self.buffer)[:HEADER.size]
+        try:
+            if not self.recv_exact(header_view[:1]):
+                return None  # Clean end of stream between frames
+        except socket.timeout:
+            return None  # Sender went idle, it reconnects when it has more to send
+        if not self.recv_exact(header_view[1:]):
+            raise ConnectionError("Connection closed in the middle of a frame")
+        kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len = unpack_header(header_view)
+        if session != self.session:
+            return None  # Another lab's traffic, dropped before reading its payload
+        frame_len = HEADER.size + meta_len + payload_len
+        if len(self.buffer) < frame_len:
+            grown = bytearray(frame_len)
+            grown[:HEADER.size] = self.buffer[:HEADER.size]
+            self.buffer = grown
+        view = memoryview(self.buffer)
+        meta_end = HEADER.size + meta_len
+        if not self.recv_exact(view[HEADER.size:meta_end]):
+            raise ConnectionError("Connection closed in the middle of a frame")
+        meta = self.meta_cache.decode(transfer_id, view[HEADER.size:meta_end])
+        sink = on_header(kind, flags, transfer_id, meta, view[:meta_end]) if on_header else None
+        if sink is None:
+            complete = self.recv_exact(view[meta_end:frame_len])
+        else:
+            try:
+                complete = self.recv_streaming(view[meta_end:frame_len], sink)
+            except BaseException:
+                sink.close(failed=True)
+                raise
+            sink.close(failed=not complete)
+        if not complete:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        return Frame(kind, flags, codec, transfer_id, seq, total, meta, view[:meta_end], view[meta_end:frame_len])
+
+    def recv_streaming(self, view, sink):
+        while view:
+            received = self.sock.recv_into(view)
+            if not received:
+                return False
+            sink.write(view[:received])
+            view = view[received:]
+        return True
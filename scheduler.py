@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+
+from protocol import FLAG_BACKGROUND, FLAGS_OFFSET, KIND_CHUNK, KIND_MCAST_DATA, KIND_MCAST_REPAIR, KIND_MESSAGE, KIND_OFFSET
+
+# Traffic classes, most urgent first
+PRIORITY_CONTROL = 0  # Manifests, acks, swarm and multicast bookkeeping
+PRIORITY_CHAT = 1  # Messages
+PRIORITY_INTERACTIVE = 2  # File data of ordinary transfers
+PRIORITY_BACKGROUND = 3  # File data of transfers started in the background
+
+FILE_KINDS = (KIND_CHUNK, KIND_MCAST_DATA, KIND_MCAST_REPAIR)
+
+
+def traffic_class(header):
+    # Classifies a packed frame header, so relayed frames keep the class
+    # their sender gave them
+    kind = header[KIND_OFFSET]
+    if kind == KIND_MESSAGE:
+        return PRIORITY_CHAT
+    if kind in FILE_KINDS:
+        return PRIORITY_BACKGROUND if header[FLAGS_OFFSET] & FLAG_BACKGROUND else PRIORITY_INTERACTIVE
+    return PRIORITY_CONTROL
+
+
+class TokenBucket:
+    def __init__(self, rate=None, burst=0.05):
+        self.rate = rate  # Bytes per second, None for no limit
+        self.burst = burst  # Seconds of traffic that may go out at once after a quiet spell
+        self.tokens = 0.0  # Goes negative while sends run ahead of the rate
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        if self.rate is None:
+            return 0
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * self.burst)
+        self.updated = now
+        return max(0, -self.tokens / self.rate)
+
+    def consume(self, nbytes):
+        if self.rate is not None:
+            self.tokens -= nbytes
+
+
+class TrafficScheduler:
+    # Paces outgoing traffic with token buckets, one shared by all traffic
+    # and one per peer. Control frames and messages are never held back,
+    # only counted, so they keep their latency under a full transfer load.
+    # File data waits for tokens, and background transfers also wait while
+    # interactive ones are waiting. With no limits set nothing is paced.
+    def __init__(self, total_rate=None, peer_rate=None):
+        self.total = TokenBucket(total_rate)
+        self.peer_rate = peer_rate
+        self.peer_buckets = {}
+        self.waiting = [0, 0, 0, 0]  # Senders waiting for tokens, by traffic class
+        self.changed = threading.Condition()
+        self.config_path = None
+
+    def configure(self, total_rate=None, peer_rate=None):
+        with self.changed:
+            self.total = TokenBucket(total_rate)
+            self.peer_rate = peer_rate
+            self.peer_buckets = {}
+            self.changed.notify_all()
+
+    def limited(self):
+        return self.total.rate is not None or self.peer_rate is not None
+
+    def acquire(self, peer_ip, nbytes, priority):
+        # Blocks until nbytes of the given class may go to peer_ip, or to
+        # the network as a whole when peer_ip is None
+        if not self.limited():
+            return
+        with self.changed:
+            buckets = [self.total]
+            if peer_ip is not None and self.peer_rate is not None:
+                bucket = self.peer_buckets.get(peer_ip)
+                if bucket is None:
+                    bucket = self.peer_buckets[peer_ip] = TokenBucket(self.peer_rate)
+                buckets.append(bucket)
+            if priority >= PRIORITY_INTERACTIVE:
+                self.waiting[priority] += 1
+                try:
+                    while True:
+                        now = time.monotonic()
+                        wait = max(bucket.wait_time(now) for bucket in buckets)
+                        if priority == PRIORITY_BACKGROUND and self.waiting[PRIORITY_INTERACTIVE]:
+                            wait = max(wait, self.total.burst)  # Woken early once the interactive sends go
+                        if wait <= 0:
+                            break
+                        self.changed.wait(wait)
+                finally:
+                    self.waiting[priority] -= 1
+            for bucket in buckets:
+                bucket.consume(nbytes)
+            self.changed.notify_all()
+
+    def load(self, path):
+        # Limits are kept in a JSON file as Mbit/s, 0 for no limit
+        self.config_path = path
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            return
+        self.configure(mbps_to_rate(config.get('total_mbps')), mbps_to_rate(config.get('peer_mbps')))
+
+    def save(self):
+        if self.config_path is None:
+            return
+        with open(self.config_path, 'w') as f:
+            json.dump({'total_mbps': rate_to_mbps(self.total.rate), 'peer_mbps': rate_to_mbps(self.peer_rate)}, f)
+
+
+def mbps_to_rate(mbps):
+    return mbps * 1e6 / 8 if mbps else None
+
+
+def rate_to_mbps(rate):
+    return rate * 8 / 1e6 if rate else 0
@@ -0,0 +1,97 @@
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SENDMSG = hasattr(socket.socket, 'sendmsg')  # Not on Windows
+
+
+def send_parts(sock, parts):
+    # Writes a frame's header and payload with one sendmsg where possible,
+    # so a chunk does not leave a small segment of its own behind on the
+    # TCP_NODELAY connections
+    if not SENDMSG:
+        for part in parts:
+            sock.sendall(part)
+        return
+    views = [memoryview(part).cast('B') for part in parts if len(part)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+class StreamTuner:
+    # Picks how many parallel connections to stripe a peer's traffic over by
+    # hill climbing on measured goodput: one more stream is tried while the
+    # last one added raised throughput by at least gain, otherwise it is
+    # taken away again and the count is left alone for reprobe windows.
+    def __init__(self, max_streams, window=1.0, gain=1.1, reprobe=30):
+        self.streams = 1
+        self.max_streams = max_streams
+        self.window = window  # Seconds of traffic each measurement covers
+        self.gain = gain
+        self.reprobe = reprobe
+        self.rate = None  # Bytes per second over the last full window
+        self.bytes = 0
+        self.started = None
+        self.last_sent = None
+        self.probing = False
+        self.settled_for = 0
+        self.lock = threading.Lock()
+
+    def record(self, nbytes, now):
+        with self.lock:
+            if self.started is None or now - self.last_sent > self.window:
+                self.started, self.bytes = now, 0  # Idle time is not part of a measurement
+            self.bytes += nbytes
+            self.last_sent = now
+            elapsed = now - self.started
+            if elapsed < self.window:
+                return
+            rate = self.bytes / elapsed
+            grow = True
+            if self.probing:
+                self.probing = False
+                if rate < self.rate * self.gain:
+                    self.streams -= 1  # The extra stream did not pay for itself
+                    self.settled_for = self.reprobe
+                    grow = False
+            if grow:
+                if self.settled_for:
+                    self.settled_for -= 1
+                elif self.streams < self.max_streams:
+                    self.streams += 1
+                    self.probing = True
+            self.rate = rate
+            self.started, self.bytes = now, 0
+
+
+class StripedSender:
+    # Runs the sends of one transfer on up to width threads, so consecutive
+    # chunks to the same peer go out over parallel pooled connections. The
+    # first error is raised from the next submit or when the block ends.
+    def __init__(self, width):
+        self.pool = ThreadPoolExecutor(width)
+        self.slots = threading.BoundedSemaphore(width)
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.pool.shutdown(wait=True)
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+    def submit(self, send, *args):
+        if self.error is not None:
+            raise self.error
+        self.slots.acquire()
+        self.pool.submit(send, *args).add_done_callback(self.done)
+
+    def done(self, future):
+        self.slots.release()
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
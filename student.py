@@ -3,12 +3,20 @@ from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QObject
 import os
 from pathlib import Path
 import threading
+import shutil
+import time
+from assembler import ChunkAssembler
+from cache import ChunkCache
+from delta import FolderDelta, unpack_folder
+from journal import TransferJournal
+from protocol import session_id
 
 class SignalHandler(QObject):
     message_received = pyqtSignal(str)
     file_received = pyqtSignal(str, str, str)
     show_message_box = pyqtSignal(str, str)
     peer_discovered = pyqtSignal(str, str)
+    peer_lost = pyqtSignal(str)
     progress_update = pyqtSignal(str, int, int, float)
     error_occurred = pyqtSignal(str)  # New signal for errors
 
@@ -18,14 +26,22 @@ class StudentPanel(QWidget):
         self.network = network
         self.name = name
         self.username = username
-        self.chunks = {}
+        self.assemblers = {}  # Map transfer id to its ChunkAssembler, kept after completion for seeding
+        self.assemblers_lock = threading.Lock()
+        self.save_dir = Path.home() / "Downloads" / "GEHU_P2P"
+        self.resume_settle = 5  # Seconds without a new chunk, once the sender is done, before the missing ones are requested
+        self.resume_due = {}  # Map transfer id to the time its missing chunks are to be requested
+        self.cache_size = 2 * 1024 ** 3  # Bytes of received chunks kept to skip re-downloading shared files
+        self.folder_delta = FolderDelta()
         self.file_history = []  # Store file sharing history
         self.current_file = None  # Track the current file being received
+        self.peer_items = {}  # Map IP to the name shown in the peers list
         self.signal_handler = SignalHandler()
         self.signal_handler.message_received.connect(self.update_messages)
         self.signal_handler.file_received.connect(self.add_file_to_list)
         self.signal_handler.show_message_box.connect(self.show_message_box)
         self.signal_handler.peer_discovered.connect(self.add_peer)
+        self.signal_handler.peer_lost.connect(self.remove_peer)
         self.signal_handler.progress_update.connect(self.update_progress)
         self.signal_handler.error_occurred.connect(self.handle_error)  # Connect error signal
         self.init_ui()
@@ -38,6 +54,15 @@ class StudentPanel(QWidget):
         # Peers panel
         peers_group = QGroupBox("Connected Peers")
         peers_layout = QVBoxLayout()
+        join_layout = QHBoxLayout()
+        self.join_code_entry = QLineEdit()
+        self.join_code_entry.setPlaceholderText("Join code from your teacher...")
+        join_layout.addWidget(self.join_code_entry)
+        join_btn = QPushButton("Join")
+        join_btn.clicked.connect(self.join_session)
+        join_btn.setStyleSheet("background-color: #4f46e5; color: white; padding: 8px; border-radius: 5px;")
+        join_layout.addWidget(join_btn)
+        peers_layout.addLayout(join_layout)
         self.peers_list = QListWidget()
         peers_layout.addWidget(self.peers_list)
         refresh_btn = QPushButton("Refresh Peers")
@@ -91,44 +116,171 @@ class StudentPanel(QWidget):
     def start_listening(self):
         self.network.on_message_received = self.handle_message
         self.network.on_file_chunk_received = self.handle_file_chunk
-        self.network.on_peer_discovered = lambda ip: self.signal_handler.peer_discovered.emit(ip, self.network.peer_names.get(ip, "Unknown"))
+        self.network.open_store = self.get_assembler
+        self.network.find_local = self.find_local
+        self.network.chunk_cache = ChunkCache(self.save_dir / ".chunk_cache", self.cache_size)
+        self.network.storage_path = str(self.save_dir)
+        self.network.role = 'student'
+        self.network.on_peer_discovered = self.peer_discovered
+        self.network.on_transfer_sent = lambda transfer_id: self.resume_due.update({transfer_id: time.monotonic() + self.resume_settle})
+        self.network.on_peer_lost = self.signal_handler.peer_lost.emit
         self.network.on_error = lambda msg: self.signal_handler.error_occurred.emit(msg)
-        for target in [self.network.listen_for_peers, self.network.listen_for_messages, self.network.listen_for_file_chunks]:
-            threading.Thread(target=target, daemon=True).start()
-        self.network.discover_peers()
+        self.network.start()
+        join_code = self.load_join_code()  # Rejoin the last class, so interrupted downloads can resume
+        if join_code:
+            self.join_code_entry.setText(join_code)
+            self.network.join_session(join_code)
+        else:
+            self.network.discover_peers()
+        threading.Thread(target=self.resume_downloads, daemon=True).start()
+
+    def load_join_code(self):
+        try:
+            join_code = (self.save_dir / ".join_code").read_text().strip()
+            session_id(join_code)
+            return join_code or None
+        except (OSError, ValueError):
+            return None
+
+    def join_session(self):
+        join_code = self.join_code_entry.text().strip().upper()
+        try:
+            self.network.join_session(join_code)
+        except ValueError:
+            QMessageBox.warning(self, "Invalid Join Code", "Enter the code shown on your teacher's screen.")
+            return
+        self.join_code_entry.setText(join_code)
+        try:
+            self.save_dir.mkdir(parents=True, exist_ok=True)
+            (self.save_dir / ".join_code").write_text(join_code)
+        except OSError as e:
+            self.signal_handler.error_occurred.emit(f"Error saving join code: {str(e)}")
+        self.update_messages(f"Joined class {join_code}")
 
     def handle_message(self, message, sender_ip, sender_name):
         self.signal_handler.message_received.emit(f"From {sender_name}: {message}")
 
-    def handle_file_chunk(self, file_name, chunk_id, total_chunks, chunk_data, sender_ip, role, sender_name):
+    def folder_path(self, pack_name):
+        return self.save_dir / os.path.splitext(os.path.basename(pack_name))[0]
+
+    def find_local(self, manifest):
+        # A re-shared folder is compared with the copy received last time, so
+        # only new and changed files are sent
+        if not manifest.meta.get('folder'):
+            return {}
         try:
-            if file_name not in self.chunks:
-                self.chunks[file_name] = {}
+            return self.folder_delta.local_chunks(manifest, self.folder_path(manifest.meta['file_name']))
+        except Exception as e:
+            self.signal_handler.error_occurred.emit(f"Error comparing folder with the local copy: {str(e)}")
+            return {}
+
+    def get_assembler(self, header):
+        with self.assemblers_lock:
+            assembler = self.assemblers.get(header['transfer_id'])
+            if assembler is None:
+                file_name = os.path.basename(header['file_name'])  # Never write outside save_dir
+                self.save_dir.mkdir(parents=True, exist_ok=True)
+                file_path = self.save_dir / file_name
+                journal = None
+                manifest = self.network.manifests.get(header['transfer_id'])
+                if manifest is not None:
+                    journal = TransferJournal(f"{file_path}.part")
+                    journal.start(header['transfer_id'], manifest)
+                assembler = ChunkAssembler(file_path, header['file_size'], header['chunk_size'], journal=journal)
+                self.assemblers[header['transfer_id']] = assembler
                 self.current_file = file_name
-            self.chunks[file_name][chunk_id] = chunk_data
-            percentage = ((chunk_id + 1) / total_chunks) * 100
-            self.signal_handler.progress_update.emit(file_name, chunk_id + 1, total_chunks, percentage)
-            if len(self.chunks[file_name]) == total_chunks:
-                self.reconstruct_file(file_name, total_chunks, sender_name)
+            return assembler
+
+    def peer_discovered(self, ip):
+        # A sender that is back is asked for what its downloads still miss
+        with self.assemblers_lock:
+            for transfer_id, assembler in self.assemblers.items():
+                manifest = self.network.manifests.get(transfer_id)
+                if manifest is not None and manifest.origin == ip and not assembler.is_complete():
+                    self.resume_due[transfer_id] = time.monotonic()
+        self.signal_handler.peer_discovered.emit(ip, self.network.peers.name(ip))
+
+    def resume_downloads(self):
+        # Picks up downloads interrupted by a restart, then asks for the
+        # missing chunks of a download once its sender is done or back. A
+        # paused or throttled transfer is just slow, so a quiet download alone
+        # never triggers a request, and an unreachable sender never makes a
+        # download be thrown away.
+        for journal_path in self.save_dir.glob("*.part.journal"):
+            try:
+                transfer_id, manifest, bitmap = TransferJournal.load(str(journal_path))
+                part_path = str(journal_path)[:-len(".journal")]
+                journal = TransferJournal(part_path)
+                if not os.path.exists(part_path):
+                    journal.remove()
+                    continue
+                assembler = ChunkAssembler(part_path[:-len(".part")], manifest.file_size, manifest.chunk_size, bitmap, journal)
+                assembler.check(manifest)
+                self.network.add_manifest(transfer_id, manifest)
+                with self.assemblers_lock:
+                    self.assemblers.setdefault(transfer_id, assembler)
+                if assembler.is_complete():
+                    self.reconstruct_file(assembler, manifest.meta.get('sender_name', 'Unknown'), manifest)
+                    self.network.report_complete(transfer_id)
+                else:
+                    self.network.request_missing(transfer_id, assembler.bitmap, report=False)
+            except Exception as e:
+                self.signal_handler.error_occurred.emit(f"Error resuming {journal_path.name}: {str(e)}")
+        while True:
+            now = time.monotonic()
+            for transfer_id, due in list(self.resume_due.items()):
+                with self.assemblers_lock:
+                    assembler = self.assemblers.get(transfer_id)
+                manifest = self.network.manifests.get(transfer_id)
+                if assembler is None and manifest is not None:
+                    # Every chunk was left out as others held it already
+                    assembler = self.get_assembler(dict(manifest.meta, transfer_id=transfer_id))
+                if assembler is None or assembler.is_complete():
+                    self.resume_due.pop(transfer_id, None)
+                elif now >= due and now - assembler.last_write >= self.resume_settle:
+                    # Chunks still relayed or repaired go first. Runs in the
+                    # background, so a failure is kept quiet; the sender is
+                    # asked again when it is back.
+                    self.resume_due.pop(transfer_id, None)
+                    self.network.request_missing(transfer_id, assembler.bitmap, report=False)
+            time.sleep(1)
+
+    def handle_file_chunk(self, header, chunk_data, sender_ip):
+        file_name = os.path.basename(header['file_name'])
+        try:
+            assembler = self.get_assembler(header)
+            if not assembler.write_chunk(header['chunk_id'], chunk_data):
+                return  # Duplicate chunk
+            total_chunks = assembler.total_chunks
+            # Multicast packets are small, so report at most once per percent
+            if assembler.received % max(1, total_chunks // 100) == 0 or assembler.is_complete():
+                percentage = (assembler.received / total_chunks) * 100
+                self.signal_handler.progress_update.emit(file_name, assembler.received, total_chunks, percentage)
+            if assembler.is_complete():
+                self.reconstruct_file(assembler, header['sender_name'], self.network.manifests.get(header['transfer_id']))
+                self.network.report_complete(header['transfer_id'])  # Shows on the teacher's transfer list
                 self.current_file = None
         except Exception as e:
             self.signal_handler.error_occurred.emit(f"Error handling file chunk: {str(e)}")
 
-    def reconstruct_file(self, file_name, total_chunks, sender_name):
+    def reconstruct_file(self, assembler, sender_name, manifest=None):
         try:
-            file_data = b''.join(self.chunks[file_name][i] for i in range(total_chunks))
-            save_dir = Path.home() / "Downloads" / "GEHU_P2P"
-            save_dir.mkdir(exist_ok=True)
-            file_path = save_dir / file_name
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            size = len(file_data)
+            file_path = assembler.finalize()
+            if file_path is None:
+                return  # Another thread already finished this file
+            size = assembler.file_size
+            if manifest is not None and manifest.meta.get('folder'):
+                pack_path = file_path
+                file_path = str(self.folder_path(pack_path))
+                unpack_folder(pack_path, manifest.meta, file_path)
+                os.remove(pack_path)
+                size = sum(file[1] for file in manifest.meta['files'])
+            file_name = os.path.basename(file_path)
             size_str = f"{size // 1024} KB" if size >= 1024 else f"{size} bytes"
             self.signal_handler.file_received.emit(file_name, size_str, sender_name)
             self.signal_handler.show_message_box.emit("File Received", f"Saved {file_name} to {file_path}")
             self.file_history.append(f"Received {file_name} ({size_str}) from {sender_name}")
             self.history_list.setText("; ".join(self.file_history))
-            del self.chunks[file_name]
         except Exception as e:
             self.signal_handler.error_occurred.emit(f"Error reconstructing file: {str(e)}")
 
@@ -167,6 +319,14 @@ class StudentPanel(QWidget):
     def add_peer(self, ip, name):
         if name not in [self.peers_list.item(i).text() for i in range(self.peers_list.count())]:
             self.peers_list.addItem(name)
+        self.peer_items[ip] = name
+
+    @pyqtSlot(str)
+    def remove_peer(self, ip):
+        name = self.peer_items.pop(ip, None)
+        if name is not None and name not in self.peer_items.values():
+            for item in self.peers_list.findItems(name, Qt.MatchExactly):
+                self.peers_list.takeItem(self.peers_list.row(item))
 
     def send_reply(self):
         msg = self.reply_entry.text().strip()
@@ -176,7 +336,7 @@ class StudentPanel(QWidget):
         if not self.network.peers:
             self.signal_handler.show_message_box.emit("Warning", "No peers connected")
             return
-        success = sum(self.network.send_message(peer[0], msg, self.name) for peer in self.network.peers)
+        self.network.broadcast_message([peer[0] for peer in self.network.peers], msg, self.name)
         self.signal_handler.message_received.emit(f"You: {msg}")
         self.reply_entry.clear()
 
@@ -188,10 +348,12 @@ class StudentPanel(QWidget):
         file_name = item.text(0)
         file_path, _ = QFileDialog.getSaveFileName(self, "Save File", file_name)
         if file_path:
-            source_path = Path.home() / "Downloads" / "GEHU_P2P" / file_name
-            if source_path.exists():
-                with open(source_path, 'rb') as src, open(file_path, 'wb') as dst:
-                    dst.write(src.read())
+            source_path = self.save_dir / file_name
+            if source_path.is_dir():
+                shutil.copytree(source_path, file_path, dirs_exist_ok=True)
+                self.signal_handler.show_message_box.emit("Success", f"Saved to {file_path}")
+            elif source_path.exists():
+                shutil.copyfile(source_path, file_path)
                 self.signal_handler.show_message_box.emit("Success", f"Saved to {file_path}")
             else:
                 self.signal_handler.show_message_box.emit("Error", "File not found")
\ No newline at end of file
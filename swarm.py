@@ -0,0 +1,268 @@
+import math
+import queue
+import random
+import struct
+import threading
+import time
+
+from archive import input_size, open_input
+from assembler import ChunkBitmap
+from protocol import KIND_BITFIELD, KIND_CHUNK, KIND_HAVE, KIND_REQUEST, encode_meta
+
+CHUNK_ID = struct.Struct('!I')
+
+
+class FileSource:
+    # Serves every chunk of a complete local file, used by the seeding peer
+    def __init__(self, file_path, chunk_size):
+        self.file_path = file_path
+        self.file_size = input_size(file_path)
+        self.chunk_size = chunk_size
+        self.total_chunks = max(1, math.ceil(self.file_size / chunk_size))
+        self.bitmap = ChunkBitmap(self.total_chunks)
+        for chunk_id in range(self.total_chunks):
+            self.bitmap.add(chunk_id)
+        self.lock = threading.Lock()
+        self.file = open_input(file_path)
+
+    def read_chunk(self, chunk_id):
+        with self.lock:
+            if self.file.closed:
+                return None  # The seed stopped, queued requests are dropped
+            self.file.seek(chunk_id * self.chunk_size)
+            return self.file.read(self.chunk_size)
+
+    def is_complete(self):
+        return True
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Swarm:
+    # One transfer in swarm mode. Every member advertises a have-bitmap and
+    # pulls the chunks it is missing from its neighbours, rarest first, so
+    # chunks spread between students instead of all coming from the seed.
+    def __init__(self, network, transfer_id, meta, store, own_ip):
+        self.network = network
+        self.transfer_id = transfer_id
+        self.meta = meta
+        self.store = store
+        self.own_ip = own_ip
+        self.total_chunks = store.bitmap.total_chunks
+        self.neighbours = {}  # Map IP to the neighbour's ChunkBitmap
+        self.availability = [0] * self.total_chunks  # Number of neighbours holding each chunk
+        self.requested = {}  # Map chunk id to {peer IP: time requested}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.max_requests_per_peer = 4
+        self.request_timeout = 15
+        self.endgame_copies = 3  # Peers asked for the same chunk once in end-game mode
+        self.encoded_meta = encode_meta(meta)
+        self.outboxes = {}  # Map IP to the queue of frames waiting to be sent to it
+        self.paused = False  # Requests are ignored while paused, requesters ask again once they time out
+        self.closed = False
+
+    def members(self):
+        recipients = set(self.meta.get('recipients', []))
+        with self.lock:
+            recipients.update(self.neighbours)
+        recipients.discard(self.own_ip)
+        return [ip for ip in recipients if not self.network.is_unreachable(ip)]
+
+    def send(self, peer_ip, header, payload=b''):
+        try:
+            self.network.send_frame(peer_ip, self.network.file_port, header, payload)
+            return True
+        except Exception as e:
+            self.network.mark_unreachable(peer_ip, f"Error sending to swarm peer {peer_ip}: {str(e)}")
+            return False
+
+    def post(self, peer_ip, item):
+        # Frames are queued per peer and sent from a worker thread, so the
+        # thread reading a connection never blocks on a send. Otherwise two
+        # peers uploading to each other could deadlock.
+        with self.lock:
+            outbox = self.outboxes.get(peer_ip)
+            if outbox is None:
+                outbox = self.outboxes[peer_ip] = queue.Queue()
+                threading.Thread(target=self.drain_outbox, args=(peer_ip, outbox), daemon=True).start()
+            outbox.put(item)
+
+    def drain_outbox(self, peer_ip, outbox):
+        while True:
+            try:
+                item = outbox.get(timeout=5)
+            except queue.Empty:
+                with self.lock:
+                    if outbox.empty():
+                        del self.outboxes[peer_ip]
+                        return
+                continue
+            if isinstance(item, int):
+                # A requested chunk, only read from disk when it is its turn
+                if self.paused or self.closed:
+                    continue
+                chunk = self.store.read_chunk(item)
+                if chunk is None:
+                    continue
+                item = self.network.frame_header(KIND_CHUNK, b'', len(chunk), self.transfer_id, item, self.total_chunks), chunk
+            if not self.send(peer_ip, *item):
+                while not outbox.empty():
+                    outbox.get_nowait()  # The requester re-asks elsewhere once its requests time out
+
+    def bitfield_frame(self):
+        bits = self.store.bitmap.to_bytes()
+        return self.network.frame_header(KIND_BITFIELD, self.encoded_meta, len(bits), self.transfer_id, 0, self.total_chunks), bits
+
+    def announce(self, peers=None):
+        header, bits = self.bitfield_frame()
+        for peer_ip in peers if peers is not None else self.members():
+            self.post(peer_ip, (header, bits))
+
+    def on_bitfield(self, peer_ip, data):
+        try:
+            bitmap = ChunkBitmap(self.total_chunks, data)
+        except ValueError:
+            return  # Not a bitfield of this transfer
+        with self.lock:
+            previous = self.neighbours.get(peer_ip)
+            for chunk_id in range(self.total_chunks):
+                had = previous is not None and chunk_id in previous
+                if chunk_id in bitmap and not had:
+                    self.availability[chunk_id] += 1
+                elif had and chunk_id not in bitmap:
+                    self.availability[chunk_id] -= 1
+            self.neighbours[peer_ip] = bitmap
+            self.wakeup.notify_all()
+        if previous is None:
+            self.announce([peer_ip])  # Let a newly seen neighbour know what we have
+
+    def on_have(self, peer_ip, chunk_id):
+        with self.lock:
+            bitmap = self.neighbours.get(peer_ip)
+            if bitmap is not None and 0 <= chunk_id < self.total_chunks and bitmap.add(chunk_id):
+                self.availability[chunk_id] += 1
+                self.wakeup.notify_all()
+
+    def on_request(self, peer_ip, data):
+        if self.paused or self.closed:
+            return
+        for (chunk_id,) in CHUNK_ID.iter_unpack(bytes(data)):
+            if 0 <= chunk_id < self.total_chunks and chunk_id in self.store.bitmap:
+                self.post(peer_ip, chunk_id)
+
+    def chunk_header(self, chunk_id):
+        return dict(self.meta, transfer_id=self.transfer_id, chunk_id=chunk_id, total_chunks=self.total_chunks)
+
+    def on_chunk(self, peer_ip, chunk_id, data):
+        if self.closed:
+            return
+        if not 0 <= chunk_id < self.total_chunks or chunk_id in self.store.bitmap:
+            return  # Duplicate, expected in end-game mode
+        if not self.network.verify_chunk(self.transfer_id, self.meta, chunk_id, data, peer_ip):
+            # Ask another peer, and leave the one that sent it out for a while
+            self.network.mark_unreachable(peer_ip, f"Skipping swarm peer {peer_ip} after a bad chunk")
+            with self.lock:
+                self.requested.pop(chunk_id, None)
+                self.wakeup.notify_all()
+            return
+        if self.network.on_file_chunk_received:
+            self.network.on_file_chunk_received(self.chunk_header(chunk_id), data, peer_ip)
+        else:
+            self.store.write_chunk(chunk_id, data)
+        with self.lock:
+            self.requested.pop(chunk_id, None)
+            self.wakeup.notify_all()
+        if chunk_id in self.store.bitmap:
+            header = self.network.frame_header(KIND_HAVE, b'', 0, self.transfer_id, chunk_id, self.total_chunks)
+            for member in self.members():
+                self.post(member, (header, b''))
+
+    def close(self):
+        # Stops serving; the store is closed by whoever opened it
+        with self.lock:
+            self.closed = True
+            for outbox in self.outboxes.values():
+                while not outbox.empty():
+                    outbox.get_nowait()
+            self.wakeup.notify_all()
+
+    def progress(self):
+        # Chunks held across all known neighbours, for the seed's progress display
+        with self.lock:
+            recipients = set(self.meta.get('recipients', [])) - {self.own_ip}
+            held = sum(len(self.neighbours[ip]) for ip in recipients if ip in self.neighbours)
+            done = all(ip in self.neighbours and self.neighbours[ip].is_complete() for ip in recipients)
+        return held, self.total_chunks * max(1, len(recipients)), done
+
+    def run(self):
+        # Scheduler loop for a peer that is still downloading. A download
+        # thrown away takes its swarm with it.
+        while not self.store.is_complete():
+            if self.closed or self.store.aborted:
+                self.network.close_swarm(self.transfer_id, self)
+                return
+            requests = self.schedule()
+            for peer_ip, chunk_ids in requests.items():
+                payload = b''.join(CHUNK_ID.pack(chunk_id) for chunk_id in chunk_ids)
+                header = self.network.frame_header(KIND_REQUEST, b'', len(payload), self.transfer_id, 0, self.total_chunks)
+                self.post(peer_ip, (header, payload))
+            with self.lock:
+                self.wakeup.wait(0.5)
+        self.announce()
+
+    def schedule(self):
+        now = time.monotonic()
+        requests = {}
+        with self.lock:
+            # Forget requests that timed out so the chunk can be asked elsewhere
+            for chunk_id in list(self.requested):
+                peers = self.requested[chunk_id]
+                for peer_ip, requested_at in list(peers.items()):
+                    if now - requested_at > self.request_timeout:
+                        del peers[peer_ip]
+                if not peers:
+                    del self.requested[chunk_id]
+
+            load = {}
+            for peers in self.requested.values():
+                for peer_ip in peers:
+                    load[peer_ip] = load.get(peer_ip, 0) + 1
+            live = [ip for ip in self.neighbours if not self.network.is_unreachable(ip)]
+            seeds = {ip for ip in live if self.neighbours[ip].is_complete()}
+
+            def pick_peer(chunk_id, exclude=()):
+                holders = [ip for ip in live if chunk_id in self.neighbours[ip]
+                           and ip not in exclude and load.get(ip, 0) < self.max_requests_per_peer]
+                if not holders:
+                    return None
+                # Prefer other downloaders so the seed's upload is spent on rare chunks
+                return min(holders, key=lambda ip: (ip in seeds, load.get(ip, 0), random.random()))
+
+            def assign(chunk_id, peer_ip):
+                self.requested.setdefault(chunk_id, {})[peer_ip] = now
+                load[peer_ip] = load.get(peer_ip, 0) + 1
+                requests.setdefault(peer_ip, []).append(chunk_id)
+
+            missing = [i for i in range(self.total_chunks) if i not in self.store.bitmap]
+            pending = [i for i in missing if i not in self.requested and self.availability[i]]
+            random.shuffle(pending)
+            pending.sort(key=lambda i: self.availability[i])  # Rarest first, random among equals
+            for chunk_id in pending:
+                peer_ip = pick_peer(chunk_id)
+                if peer_ip is not None:
+                    assign(chunk_id, peer_ip)
+
+            # End-game: every missing chunk is already requested, so ask more
+            # peers for the stragglers and keep whichever copy arrives first
+            if missing and all(i in self.requested for i in missing):
+                for chunk_id in missing:
+                    asked = self.requested[chunk_id]
+                    while len(asked) < self.endgame_copies:
+                        peer_ip = pick_peer(chunk_id, exclude=asked)
+                        if peer_ip is None:
+                            break
+                        assign(chunk_id, peer_ip)
+        return requests
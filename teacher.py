@@ -1,16 +1,22 @@
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QTextEdit, QLineEdit, QPushButton, QListWidget, QFileDialog, QMessageBox, QHBoxLayout, QGroupBox, QComboBox
-from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QTextEdit, QLineEdit, QPushButton, QListWidget, QFileDialog, QMessageBox, QHBoxLayout, QGroupBox, QComboBox, QLabel, QCheckBox, QDoubleSpinBox, QFormLayout, QTreeWidget, QTreeWidgetItem, QSpinBox
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, pyqtSlot
 import os
 import threading
-import zipfile
 import shutil
+from functools import partial
 from pathlib import Path
 
+from archive import FolderArchive, FolderPack
+from protocol import new_join_code
+from scheduler import mbps_to_rate, rate_to_mbps
+from transfers import CANCELLED, DONE, FAILED, PAUSED, TransferManager
+
 class SignalHandler(QObject):
     peer_discovered = pyqtSignal(str, str)
+    peer_lost = pyqtSignal(str)
     status_update = pyqtSignal(str)
     show_message_box = pyqtSignal(str, str)
-    progress_update = pyqtSignal(int, int, float)
+    job_update = pyqtSignal(object)
     error_occurred = pyqtSignal(str)  # New signal for errors
 
 class TeacherPanel(QWidget):
@@ -20,13 +26,17 @@ class TeacherPanel(QWidget):
         self.name = name
         self.username = username
         self.file_history = []  # Store file sharing history
-        self.current_file = None
-        self.temp_zip_path = None  # Store path of temporary zip file
+        self.transfers = TransferManager(network)
+        self.job_items = {}  # Map job id to its row in the transfers list
+        self.peer_items = {}  # Map IP to the name shown in the peers list
+        self.join_code = new_join_code()  # Students enter it to join this class
         self.signal_handler = SignalHandler()
         self.signal_handler.peer_discovered.connect(self.add_peer)
+        self.signal_handler.peer_lost.connect(self.remove_peer)
         self.signal_handler.status_update.connect(self.update_status)
         self.signal_handler.show_message_box.connect(self.show_message_box)
-        self.signal_handler.progress_update.connect(self.update_progress)
+        self.signal_handler.job_update.connect(self.update_job)
+        self.transfers.on_update = self.signal_handler.job_update.emit
         self.signal_handler.error_occurred.connect(self.handle_error)  # Connect error signal
         self.init_ui()
         self.start_listening()
@@ -38,6 +48,10 @@ class TeacherPanel(QWidget):
         # Peers panel
         peers_group = QGroupBox("Connected Peers")
         peers_layout = QVBoxLayout()
+        join_code_label = QLabel(f"Join code: {self.join_code}")
+        join_code_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        join_code_label.setStyleSheet("font-size: 16px; font-weight: bold; padding: 4px;")
+        peers_layout.addWidget(join_code_label)
         self.peers_list = QListWidget()
         peers_layout.addWidget(self.peers_list)
         refresh_btn = QPushButton("Refresh Peers")
@@ -66,6 +80,15 @@ class TeacherPanel(QWidget):
         self.selection_type = QComboBox()
         self.selection_type.addItems(["File", "Folder"])
         file_layout.addWidget(self.selection_type)
+        self.distribution_mode = QComboBox()
+        self.distribution_mode.addItems(["Relay", "Tree", "Chain", "Swarm", "Multicast"])
+        self.distribution_mode.setToolTip("Relay: students forward each chunk to the class. Tree/Chain: students pass chunks "
+                                          "down a tree or a chain while still receiving them. Swarm: students trade chunks with each other. "
+                                          "Multicast: every chunk is sent once to the whole lab network.")
+        file_layout.addWidget(self.distribution_mode)
+        self.background_send = QCheckBox("Send in background")
+        self.background_send.setToolTip("The transfer only uses bandwidth that messages and other transfers leave free.")
+        file_layout.addWidget(self.background_send)
         self.file_path = QLineEdit()
         self.file_path.setReadOnly(True)
         file_layout.addWidget(self.file_path)
@@ -82,6 +105,49 @@ class TeacherPanel(QWidget):
         file_group.setLayout(file_layout)
         layout.addWidget(file_group)
 
+        # Transfers panel
+        transfers_group = QGroupBox("Transfers")
+        transfers_layout = QVBoxLayout()
+        self.jobs_tree = QTreeWidget()
+        self.jobs_tree.setHeaderLabels(["File", "State", "Progress", "Students Done", "Time Left"])
+        self.jobs_tree.setColumnWidth(0, 200)
+        transfers_layout.addWidget(self.jobs_tree)
+        jobs_btn_layout = QHBoxLayout()
+        for label, slot in (("Pause/Resume", self.toggle_pause_job), ("Cancel", self.cancel_job),
+                            ("Move Up", self.move_job_up), ("Background", self.toggle_background_job)):
+            button = QPushButton(label)
+            button.clicked.connect(slot)
+            button.setStyleSheet("background-color: #4f46e5; color: white; padding: 8px; border-radius: 5px;")
+            jobs_btn_layout.addWidget(button)
+        self.max_active = QSpinBox()
+        self.max_active.setRange(1, 8)
+        self.max_active.setValue(self.transfers.max_active)
+        self.max_active.setPrefix("At once: ")
+        self.max_active.valueChanged.connect(self.transfers.set_max_active)
+        jobs_btn_layout.addWidget(self.max_active)
+        transfers_layout.addLayout(jobs_btn_layout)
+        transfers_group.setLayout(transfers_layout)
+        layout.addWidget(transfers_group)
+
+        # Bandwidth panel
+        bandwidth_group = QGroupBox("Bandwidth Limits")
+        bandwidth_layout = QFormLayout()
+        self.total_limit = QDoubleSpinBox()
+        self.peer_limit = QDoubleSpinBox()
+        for spin_box, rate in ((self.total_limit, self.network.scheduler.total.rate), (self.peer_limit, self.network.scheduler.peer_rate)):
+            spin_box.setRange(0, 100000)
+            spin_box.setSuffix(" Mbit/s")
+            spin_box.setSpecialValueText("No limit")
+            spin_box.setValue(rate_to_mbps(rate))
+        bandwidth_layout.addRow("Total upload:", self.total_limit)
+        bandwidth_layout.addRow("Per student:", self.peer_limit)
+        apply_limits_btn = QPushButton("Apply Limits")
+        apply_limits_btn.clicked.connect(self.apply_bandwidth_limits)
+        apply_limits_btn.setStyleSheet("background-color: #4f46e5; color: white; padding: 8px; border-radius: 5px;")
+        bandwidth_layout.addRow(apply_limits_btn)
+        bandwidth_group.setLayout(bandwidth_layout)
+        layout.addWidget(bandwidth_group)
+
         # Status panel (includes progress)
         status_group = QGroupBox("Status")
         status_layout = QVBoxLayout()
@@ -102,13 +168,15 @@ class TeacherPanel(QWidget):
         layout.addWidget(history_group)
 
     def start_listening(self):
-        self.network.on_peer_discovered = lambda ip: self.signal_handler.peer_discovered.emit(ip, self.network.peer_names.get(ip, "Unknown"))
+        self.network.role = 'teacher'
+        self.network.on_peer_discovered = lambda ip: self.signal_handler.peer_discovered.emit(ip, self.network.peers.name(ip))
+        self.network.on_peer_lost = self.signal_handler.peer_lost.emit
         self.network.on_message_received = self.handle_message
         # Pass error signal handler to network
         self.network.on_error = lambda msg: self.signal_handler.error_occurred.emit(msg)
-        threading.Thread(target=self.network.listen_for_peers, daemon=True).start()
-        threading.Thread(target=self.network.listen_for_messages, daemon=True).start()
-        self.network.discover_peers()
+        self.network.start()  # The file listener serves chunk requests in swarm mode
+        self.network.join_session(self.join_code)  # Also asks the students already in it to announce themselves
+        self.signal_handler.status_update.emit(f"Students join this class with the code {self.join_code}")
 
     def handle_message(self, message, sender_ip, sender_name):
         self.signal_handler.status_update.emit(f"From {sender_name}: {message}")
@@ -118,23 +186,69 @@ class TeacherPanel(QWidget):
         if name not in [self.peers_list.item(i).text() for i in range(self.peers_list.count())]:
             self.peers_list.addItem(name)
             self.signal_handler.status_update.emit(f"Peer discovered: {name}")
+        self.peer_items[ip] = name
+
+    @pyqtSlot(str)
+    def remove_peer(self, ip):
+        name = self.peer_items.pop(ip, None)
+        if name is not None and name not in self.peer_items.values():
+            for item in self.peers_list.findItems(name, Qt.MatchExactly):
+                self.peers_list.takeItem(self.peers_list.row(item))
+            self.signal_handler.status_update.emit(f"Peer left: {name}")
 
     @pyqtSlot(str)
     def update_status(self, msg):
         self.status.append(msg)
         self.status.verticalScrollBar().setValue(self.status.verticalScrollBar().maximum())
 
-    @pyqtSlot(int, int, float)
-    def update_progress(self, chunk_id, total_chunks, percentage):
-        msg = f"Sending: {self.current_file} | Chunk: {chunk_id}/{total_chunks} | Progress: {percentage:.1f}%"
-        current_text = self.status.toPlainText()
-        lines = current_text.split("\n")
-        if lines and lines[-1].startswith(f"Sending: {self.current_file}"):
-            lines[-1] = msg
-        else:
-            lines.append(msg)
-        self.status.setText("\n".join(lines))
-        self.status.verticalScrollBar().setValue(self.status.verticalScrollBar().maximum())
+    @pyqtSlot(object)
+    def update_job(self, job):
+        item = self.job_items.get(job.id)
+        if item is None:
+            item = self.job_items[job.id] = QTreeWidgetItem([job.name])
+            item.setData(0, Qt.UserRole, job)
+            self.jobs_tree.addTopLevelItem(item)
+        finished = item.text(1) in (DONE, FAILED, CANCELLED)
+        state = job.state + (" (background)" if job.background and job.state not in (DONE, FAILED, CANCELLED) else "")
+        item.setText(1, state)
+        item.setText(2, f"{(job.bytes_sent / job.size * 100) if job.size else 100:.1f}% of {job.size / 1024 / 1024:.1f} MB")
+        item.setText(3, f"{job.completed_peers()}/{len(job.peers)}")
+        eta = job.eta()
+        item.setText(4, f"{int(eta) // 60}:{int(eta) % 60:02d}" if eta is not None else "")
+        if job.state in (DONE, FAILED, CANCELLED) and not finished:
+            detail = job.error or (f"{job.goodput * 8 / 1e6:.0f} Mbit/s goodput" if job.state == DONE and job.goodput else None)
+            self.signal_handler.status_update.emit(f"{job.name}: {job.state}" + (f" ({detail})" if detail else ""))
+
+    def selected_job(self):
+        item = self.jobs_tree.currentItem()
+        if item is None:
+            self.signal_handler.show_message_box.emit("Warning", "Select a transfer")
+            return None
+        return item.data(0, Qt.UserRole)
+
+    def toggle_pause_job(self):
+        job = self.selected_job()
+        if job is not None:
+            if job.state == PAUSED:
+                self.transfers.resume(job)
+            else:
+                self.transfers.pause(job)
+
+    def cancel_job(self):
+        job = self.selected_job()
+        if job is not None:
+            self.transfers.cancel(job)
+
+    def move_job_up(self):
+        # Queued jobs start in priority order, lowest first
+        job = self.selected_job()
+        if job is not None:
+            self.transfers.reprioritise(job, priority=min(other.priority for other in self.transfers.jobs) - 1)
+
+    def toggle_background_job(self):
+        job = self.selected_job()
+        if job is not None:
+            self.transfers.reprioritise(job, background=not job.background)
 
     @pyqtSlot(str, str)
     def show_message_box(self, title, message):
@@ -155,20 +269,21 @@ class TeacherPanel(QWidget):
             if folder_path:
                 self.file_path.setText(folder_path)
 
-    def zip_folder(self, folder_path):
+    def send_folder(self, send, folder_path, *args, **kwargs):
+        # The folder is laid out on the send thread and read straight from
+        # disk as it goes out, so no temporary copy is written. Relay and
+        # tree modes send a FolderPack, which students unpack and diff later
+        # shares against; swarm peers serve the received file to each other
+        # and multicast has no manifest, so those get a zip.
         try:
-            folder_name = os.path.basename(folder_path)
-            self.temp_zip_path = os.path.join(os.path.dirname(folder_path), f"{folder_name}.zip")
-            with zipfile.ZipFile(self.temp_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(folder_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, os.path.dirname(folder_path))
-                        zipf.write(file_path, arcname)
-            return self.temp_zip_path
+            if send in (self.network.seed_file, self.network.send_file_multicast):
+                archive = FolderArchive(folder_path)
+            else:
+                archive = FolderPack(folder_path)
         except Exception as e:
-            self.signal_handler.error_occurred.emit(f"Failed to zip folder: {str(e)}")
-            return None
+            self.signal_handler.error_occurred.emit(f"Failed to archive folder: {str(e)}")
+            return False
+        return send(archive, *args, **kwargs)
 
     def send_file_or_folder(self):
         path = self.file_path.text()
@@ -184,39 +299,43 @@ class TeacherPanel(QWidget):
                 if not os.path.isfile(path):
                     self.signal_handler.show_message_box.emit("Warning", "Select a valid file")
                     return
-                self.current_file = os.path.basename(path)
-                file_path = path
-            else:
-                if not os.path.isdir(path):
-                    self.signal_handler.show_message_box.emit("Warning", "Select a valid folder")
-                    return
-                file_path = self.zip_folder(path)
-                if not file_path:  # Zipping failed
-                    return
-                self.current_file = os.path.basename(file_path)
+            elif not os.path.isdir(path):
+                self.signal_handler.show_message_box.emit("Warning", "Select a valid folder")
+                return
 
-            # Start sending in a thread
-            threading.Thread(
-                target=self.network.send_file_chunks,
-                args=(file_path, self.network.peers, 'teacher', self.name, self.signal_handler.progress_update.emit),
-                daemon=True
-            ).start()
+            # Queue the share, the transfer manager runs it on its own thread
+            mode = self.distribution_mode.currentText()
+            options = {}
+            if mode == "Swarm":
+                send = self.network.seed_file
+            elif mode == "Tree":
+                send = self.network.broadcast_file
+            elif mode == "Chain":
+                send = self.network.broadcast_file
+                options['fanout'] = 1
+            elif mode == "Multicast":
+                send = self.network.send_file_multicast
+            else:
+                send = self.network.send_file_chunks
+            if self.selection_type.currentText() == "Folder":
+                send = partial(self.send_folder, send)
+            job = self.transfers.submit(send, path, self.network.peers, 'teacher', self.name,
+                                        background=self.background_send.isChecked(), **options)
 
             # Add to history
-            self.file_history.append(f"Sent {self.current_file} to {len(self.network.peers)} peer(s)")
+            self.file_history.append(f"Sent {job.name} to {len(job.peers)} peer(s)")
             self.history_list.setText("; ".join(self.file_history))
 
         except Exception as e:
             self.signal_handler.error_occurred.emit(f"Error preparing file/folder for sending: {str(e)}")
-        finally:
-            # Safely clean up temporary zip file
-            if self.selection_type.currentText() == "Folder" and self.temp_zip_path and os.path.exists(self.temp_zip_path):
-                try:
-                    os.remove(self.temp_zip_path)
-                    self.signal_handler.status_update.emit(f"Cleaned up temporary file: {self.temp_zip_path}")
-                except Exception as e:
-                    self.signal_handler.error_occurred.emit(f"Failed to clean up temporary file: {str(e)}")
-                self.temp_zip_path = None
+
+    def apply_bandwidth_limits(self):
+        self.network.scheduler.configure(mbps_to_rate(self.total_limit.value()), mbps_to_rate(self.peer_limit.value()))
+        try:
+            self.network.scheduler.save()
+        except Exception as e:
+            self.signal_handler.error_occurred.emit(f"Error saving bandwidth limits: {str(e)}")
+        self.signal_handler.status_update.emit("Bandwidth limits applied")
 
     def broadcast_message(self):
         msg = self.message_entry.toPlainText().strip()
@@ -226,6 +345,16 @@ class TeacherPanel(QWidget):
         if not self.network.peers:
             self.signal_handler.show_message_box.emit("Warning", "No peers connected")
             return
-        success = sum(self.network.send_message(peer[0], msg, self.name) for peer in self.network.peers)
-        self.signal_handler.status_update.emit(f"Message sent to {success} peer(s)")
+        peer_ips = [peer[0] for peer in self.network.peers]
+        results = []
+        results_lock = threading.Lock()
+
+        def on_result(peer_ip, delivered):
+            with results_lock:
+                results.append(delivered)
+                done = len(results) == len(peer_ips)
+            if done:
+                self.signal_handler.status_update.emit(f"Message sent to {sum(results)} of {len(peer_ips)} peer(s)")
+
+        self.network.broadcast_message(peer_ips, msg, self.name, on_result)  # Returns at once, on_result runs off the GUI thread
         self.message_entry.clear()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import random
+import zlib
+
+from archive import FolderPack
+from delta import FolderDelta, pack_entries, read_block
+from integrity import Manifest
+
+CHUNK_SIZE = 4096
+WEAK_MIN_SIZE = 16 * 1024
+
+
+def share(folder):
+    # The manifest a receiver gets for a FolderPack of folder, listing included
+    pack = FolderPack(str(folder), chunk_size=CHUNK_SIZE, weak_min_size=WEAK_MIN_SIZE)
+    manifest = Manifest.from_file(pack, CHUNK_SIZE)
+    manifest.meta = dict(pack.meta, **json.loads(zlib.decompress(pack.listing())))
+    return manifest
+
+
+def file_entry(manifest, relpath):
+    return next(entry for entry in pack_entries(manifest.meta) if entry[0] == relpath)
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def test_moved_blocks_are_found_after_an_insertion(tmp_path):
+    rng = random.Random(1)
+    data = bytes(rng.getrandbits(8) for _ in range(40 * CHUNK_SIZE + 100))
+    old_path = tmp_path / 'old' / 'video.bin'
+    write(old_path, data)
+    # 1000 bytes inserted in chunk 5 shift everything after it
+    write(tmp_path / 'new' / 'video.bin', data[:5 * CHUNK_SIZE + 10] + os.urandom(1000) + data[5 * CHUNK_SIZE + 10:])
+    manifest = share(tmp_path / 'new')
+    relpath, size, weak, offset = file_entry(manifest, 'video.bin')
+    assert weak
+
+    found = FolderDelta().match_file(manifest, str(old_path), size, weak, offset // CHUNK_SIZE)
+    first = offset // CHUNK_SIZE
+    assert set(range(first, first + 5)) <= set(found)  # In place
+    assert first + 5 not in found  # Holds the inserted bytes
+    moved = [chunk_id for chunk_id in found if chunk_id > first + 6]
+    assert len(moved) >= 30
+    for chunk_id in moved:
+        old_offset, length = found[chunk_id]
+        assert old_offset == (chunk_id - first) * CHUNK_SIZE - 1000
+    for chunk_id, (old_offset, length) in found.items():
+        chunk = read_block(str(old_path), old_offset, length, CHUNK_SIZE)
+        assert hashlib.sha256(chunk).digest() == manifest.chunk_hash(chunk_id)
+
+
+def test_searches_are_bounded_for_a_rewritten_file(tmp_path):
+    old_path = tmp_path / 'old' / 'video.bin'
+    write(old_path, os.urandom(40 * CHUNK_SIZE))
+    write(tmp_path / 'new' / 'video.bin', os.urandom(40 * CHUNK_SIZE))
+    manifest = share(tmp_path / 'new')
+    relpath, size, weak, offset = file_entry(manifest, 'video.bin')
+    delta = FolderDelta(max_searches=3)
+    assert delta.match_file(manifest, str(old_path), size, weak, offset // CHUNK_SIZE) == {}
+
+
+def test_local_chunks_rebuild_unchanged_small_files(tmp_path):
+    old = tmp_path / 'old'
+    new = tmp_path / 'new'
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        write(old / name, name.encode() * 500)
+        write(new / name, name.encode() * 500)
+    # b.txt grows, so c.txt moves within the pack but still matches
+    write(new / 'b.txt', b'b.txt' * 900)
+    manifest = share(new)
+    found = FolderDelta().local_chunks(manifest, str(old))
+    assert found
+    for chunk_id, read in found.items():
+        assert hashlib.sha256(read()).digest() == manifest.chunk_hash(chunk_id)
+    assert len(found) < manifest.total_chunks
@@ -0,0 +1,46 @@
+import itertools
+import os
+import random
+
+import pytest
+
+from fec import BlockCode
+
+
+def make_block(k, length, seed):
+    rng = random.Random(seed)
+    # The last packet of a file is usually short, so lengths vary
+    return [os.urandom(rng.randint(1, length)) for _ in range(k)]
+
+
+@pytest.mark.parametrize('k, r', [(1, 1), (3, 2), (5, 3), (16, 2)])
+def test_any_k_packets_rebuild_the_block(k, r):
+    length = 64
+    sources = make_block(k, length, k * 100 + r)
+    code = BlockCode(k, r)
+    packets = [packet.ljust(length, b'\0') for packet in sources] + code.encode(sources, length)
+    for indexes in itertools.combinations(range(k + r), k):
+        rebuilt = code.decode({i: packets[i] for i in indexes}, length)
+        assert sorted(rebuilt) == [i for i in range(k) if i not in indexes]
+        for i, data in rebuilt.items():
+            assert data == packets[i]
+
+
+def test_no_repair_needed_when_all_sources_arrive():
+    code = BlockCode(4, 2)
+    sources = make_block(4, 32, 1)
+    assert code.decode({i: packet for i, packet in enumerate(sources)}, 32) == {}
+
+
+def test_too_few_packets_is_an_error():
+    code = BlockCode(4, 2)
+    sources = make_block(4, 32, 2)
+    repairs = code.encode(sources, 32)
+    with pytest.raises(ValueError):
+        code.decode({0: sources[0], 1: sources[1], 4: repairs[0]}, 32)
+
+
+@pytest.mark.parametrize('k, r', [(0, 1), (4, -1), (200, 57)])
+def test_unsupported_codes_are_rejected(k, r):
+    with pytest.raises(ValueError):
+        BlockCode(k, r)
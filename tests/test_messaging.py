@@ -0,0 +1,112 @@
+import json
+
+from messaging import MessageBus
+from protocol import HEADER, KIND_ACK, KIND_MESSAGE, Frame, pack_header, unpack_header
+
+SENDER_IP = '10.0.0.1'
+RECEIVER_IP = '10.0.0.2'
+
+
+class FakeNetwork:
+    # The parts of PeerNetwork a MessageBus uses, with frames captured
+    # instead of sent and deliveries collected in order
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.sent = []  # (peer IP, Frame)
+        self.delivered = []
+
+    def on_message_received(self, message, sender_ip, sender_name):
+        self.delivered.append(message)
+
+    def frame_header(self, kind, meta, payload_len, transfer_id=0, seq=0, total=0, flags=0, codec=0):
+        return pack_header(kind, meta, payload_len, transfer_id, seq, total, flags, codec)
+
+    def transmit_messages(self, peer_ip, frames, done=None):
+        for header, payload in frames:
+            kind, flags, codec, meta_len, session, transfer_id, seq, total, payload_len = unpack_header(header[:HEADER.size])
+            meta = json.loads(header[HEADER.size:HEADER.size + meta_len])
+            self.sent.append((peer_ip, Frame(kind, flags, codec, transfer_id, seq, total, meta, header, payload)))
+        if done:
+            done()
+
+    def take(self, kind):
+        frames = [frame for peer_ip, frame in self.sent if frame.kind == kind]
+        self.sent = [(peer_ip, frame) for peer_ip, frame in self.sent if frame.kind != kind]
+        return frames
+
+
+def make_buses():
+    sender = MessageBus(FakeNetwork('aaaa'), retransmit_timeout=60)
+    receiver = MessageBus(FakeNetwork('bbbb'))
+    return sender, receiver
+
+
+def send_all(sender, messages):
+    for message in messages:
+        sender.send([RECEIVER_IP], message, 'Teacher')
+    return sender.network.take(KIND_MESSAGE)
+
+
+def test_out_of_order_messages_are_delivered_in_order():
+    sender, receiver = make_buses()
+    frames = send_all(sender, ['m1', 'm2', 'm3', 'm4'])
+    delivered = []
+    for index in (2, 0, 3, 1):
+        receiver.handle_frame(frames[index], SENDER_IP)
+        delivered.append(list(receiver.network.delivered))
+    # m3 and m4 are held back until the gap before them fills
+    assert delivered == [[], ['m1'], ['m1'], ['m1', 'm2', 'm3', 'm4']]
+
+
+def test_duplicates_are_delivered_once_and_acknowledged():
+    sender, receiver = make_buses()
+    results = []
+    for message in ('m1', 'm2'):
+        sender.send([RECEIVER_IP], message, 'Teacher', on_result=lambda peer_ip, ok: results.append((peer_ip, ok)))
+    first, second = sender.network.take(KIND_MESSAGE)
+    for frame in (first, first, second, first, second):
+        receiver.handle_frame(frame, SENDER_IP)
+    assert receiver.network.delivered == ['m1', 'm2']
+
+    # One cumulative ack covers both, however many copies came in
+    receiver.flush_acks()
+    acks = receiver.network.take(KIND_ACK)
+    assert [ack.seq for ack in acks] == [2]
+    sender.handle_frame(acks[0], RECEIVER_IP)
+    assert results == [(RECEIVER_IP, True), (RECEIVER_IP, True)]
+    assert not sender.outboxes[RECEIVER_IP].pending
+
+
+def test_receiver_skips_messages_the_sender_gave_up_on():
+    sender, receiver = make_buses()
+    results = []
+    for message in ('m1', 'm2', 'm3'):
+        sender.send([RECEIVER_IP], message, 'Teacher', on_result=lambda peer_ip, ok: results.append(ok))
+    first, lost, third = sender.network.take(KIND_MESSAGE)
+    receiver.handle_frame(first, SENDER_IP)
+    receiver.handle_frame(third, SENDER_IP)
+    assert receiver.network.delivered == ['m1']
+    receiver.flush_acks()
+    sender.handle_frame(receiver.network.take(KIND_ACK)[0], RECEIVER_IP)
+
+    # m2 times out, so the next frame's base tells the receiver to stop
+    # waiting for it
+    sender.outboxes[RECEIVER_IP].pending[2].first_sent -= sender.message_timeout + 1
+    sender.retransmit()
+    assert results == [True, False]
+    sender.send([RECEIVER_IP], 'm4', 'Teacher')
+    fourth, = sender.network.take(KIND_MESSAGE)
+    assert fourth.meta['base'] == 3
+    receiver.handle_frame(fourth, SENDER_IP)
+    assert receiver.network.delivered == ['m1', 'm3', 'm4']
+
+
+def test_acks_for_an_earlier_run_are_ignored():
+    sender, receiver = make_buses()
+    frame, = send_all(sender, ['m1'])
+    receiver.handle_frame(frame, SENDER_IP)
+    receiver.flush_acks()
+    ack = receiver.network.take(KIND_ACK)[0]
+    ack.meta = dict(ack.meta, to='cccc')
+    sender.handle_frame(ack, RECEIVER_IP)
+    assert list(sender.outboxes[RECEIVER_IP].pending) == [1]
@@ -0,0 +1,128 @@
+import math
+import os
+import random
+
+import pytest
+
+import multicast
+from fec import BlockCode
+from multicast import NACK_RANGE, MulticastReceiver, parse_datagram
+from protocol import KIND_MCAST_DATA, KIND_MCAST_REPAIR, KIND_MCAST_STATUS, KIND_NACK, encode_meta, pack_header
+
+CHUNK_SIZE = 1400
+TRANSFER_ID = 7
+
+
+class LoopbackSocket:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+
+class FakeNetwork:
+    # The parts of PeerNetwork a MulticastReceiver uses, with chunks
+    # collected in memory and NACKs captured instead of sent
+    def __init__(self, loss_rate):
+        self.multicast_loss_rate = loss_rate
+        self.session_id = 0
+        self.socket = LoopbackSocket()
+        self.on_error = None
+        self.chunks = {}
+
+    def on_file_chunk_received(self, header, data, sender_ip):
+        self.chunks[header['chunk_id']] = bytes(data)
+
+    def frame_header(self, kind, meta, payload_len, transfer_id=0, seq=0, total=0, flags=0, codec=0):
+        return pack_header(kind, meta, payload_len, transfer_id, seq, total, flags, codec, self.session_id)
+
+    def take_nacks(self):
+        # Missing packet ids from the NACKs sent so far, None once the
+        # receiver has reported a complete copy
+        nacks, self.socket.sent = self.socket.sent, []
+        missing = set()
+        for data in nacks:
+            kind, session, transfer_id, seq, total, meta, payload = parse_datagram(data)
+            assert kind == KIND_NACK and transfer_id == TRANSFER_ID
+            if not payload:
+                return None
+            for first, count in NACK_RANGE.iter_unpack(bytes(payload)):
+                missing.update(range(first, first + count))
+        return missing
+
+
+def datagrams(data, fec):
+    # What MulticastSender puts on the wire for one pass over the file
+    total = max(1, math.ceil(len(data) / CHUNK_SIZE))
+    packets = [data[seq * CHUNK_SIZE:(seq + 1) * CHUNK_SIZE] for seq in range(total)]
+    k, r = fec
+    for block_id in range(math.ceil(total / k)):
+        block = packets[block_id * k:(block_id + 1) * k]
+        for index, packet in enumerate(block):
+            yield pack_header(KIND_MCAST_DATA, b'', len(packet), TRANSFER_ID, block_id * k + index, total) + packet
+        for j, repair in enumerate(BlockCode(len(block), r).encode(block, CHUNK_SIZE)):
+            yield pack_header(KIND_MCAST_REPAIR, b'', len(repair), TRANSFER_ID, block_id * r + j, total) + repair
+
+
+def status(data, fec, sent):
+    total = max(1, math.ceil(len(data) / CHUNK_SIZE))
+    meta = encode_meta({'file_name': 'f.bin', 'file_size': len(data), 'chunk_size': CHUNK_SIZE, 'fec': list(fec)})
+    return pack_header(KIND_MCAST_STATUS, meta, 0, TRANSFER_ID, sent, total)
+
+
+@pytest.mark.parametrize('fec, loss_rate', [((16, 2), 0.02), ((16, 4), 0.1), ((8, 2), 0.05)])
+def test_file_survives_simulated_loss(monkeypatch, fec, loss_rate):
+    rng = random.Random(sum(fec) * 1000 + int(loss_rate * 100))
+    drops = []
+
+    def lossy():
+        value = rng.random()
+        drops.append(value < loss_rate)
+        return value
+
+    monkeypatch.setattr(multicast.random, 'random', lossy)
+    data = os.urandom(300 * CHUNK_SIZE + 123)
+    total = math.ceil(len(data) / CHUNK_SIZE)
+    network = FakeNetwork(loss_rate)
+    receiver = MulticastReceiver(network)
+    addr = ('127.0.0.1', 50010)
+
+    # Status packets can be lost too, so the sender repeats them
+    while TRANSFER_ID not in receiver.transfers:
+        receiver.handle_datagram(status(data, fec, 0), addr)
+    wire = list(datagrams(data, fec))
+    for packet in wire:
+        receiver.handle_datagram(packet, addr)
+    dropped = sum(drops[-len(wire):])
+    missing = None
+    while missing is None:
+        receiver.handle_datagram(status(data, fec, total), addr)
+        missing = network.take_nacks()
+    assert dropped > 0
+    # FEC rebuilt most losses without a NACK round trip
+    assert len(missing) < dropped / 2
+
+    # NACKed packets are sent again, as plain data, until the receiver
+    # reports a complete copy
+    for _ in range(20):
+        if missing is None:
+            break
+        for seq in sorted(missing):
+            packet = data[seq * CHUNK_SIZE:(seq + 1) * CHUNK_SIZE]
+            receiver.handle_datagram(pack_header(KIND_MCAST_DATA, b'', len(packet), TRANSFER_ID, seq, total) + packet, addr)
+        missing = set()
+        while missing == set():
+            receiver.handle_datagram(status(data, fec, total), addr)
+            missing = network.take_nacks()
+    assert missing is None
+    assert b''.join(network.chunks[seq] for seq in range(total)) == data
+
+
+def test_other_sessions_are_ignored():
+    network = FakeNetwork(0.0)
+    receiver = MulticastReceiver(network)
+    data = os.urandom(10 * CHUNK_SIZE)
+    network.session_id = 5
+    receiver.handle_datagram(status(data, (4, 1), 0), ('127.0.0.1', 50010))
+    assert receiver.transfers == {}
@@ -0,0 +1,208 @@
+import itertools
+import os
+import threading
+import time
+
+from archive import input_name, input_size, list_folder
+
+QUEUED = 'queued'
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class TransferCancelled(Exception):
+    # Raised from a job's progress callback to stop its send
+    pass
+
+
+class TransferJob:
+    # State of one queued share, safe to read from any thread
+    def __init__(self, job_id, send, file_path, peers, role, sender_name, priority, background, options):
+        self.id = job_id
+        self.send = send
+        self.file_path = file_path
+        self.name = input_name(file_path) if not os.path.isdir(file_path) else os.path.basename(os.path.normpath(file_path))
+        self.size = sum(os.path.getsize(path) for path, _ in list_folder(file_path)) if os.path.isdir(file_path) else input_size(file_path)
+        self.peers = {peer_ip: False for peer_ip, _ in peers}  # Map recipient IP to whether it reported a complete copy
+        self.recipients = list(peers)
+        self.role = role
+        self.sender_name = sender_name
+        self.priority = priority  # Lower runs first
+        self.background = background
+        self.options = options  # Extra keyword arguments for send, e.g. fanout
+        self.state = QUEUED
+        self.transfer_id = None
+        self.bytes_sent = 0
+        self.active_time = 0.0  # Seconds spent sending, pauses excluded
+        self.goodput = None  # Bytes per second written to sockets, known once done
+        self.resumed_at = None
+        self.error = None
+        self.cancelled = False
+        self.unpaused = threading.Event()
+        self.unpaused.set()
+
+    def elapsed(self):
+        if self.resumed_at is None:
+            return self.active_time
+        return self.active_time + time.monotonic() - self.resumed_at
+
+    def rate(self):
+        # Bytes per second so far
+        elapsed = self.elapsed()
+        return self.bytes_sent / elapsed if elapsed > 0 else 0
+
+    def eta(self):
+        # Seconds left, or None until there is a rate to go by
+        rate = self.rate()
+        if self.state != RUNNING or not rate:
+            return None
+        return max(0, self.size - self.bytes_sent) / rate
+
+    def completed_peers(self):
+        return sum(self.peers.values())
+
+
+class TransferManager:
+    # Queues share jobs and runs up to max_active of them at once, highest
+    # priority first. Jobs can be paused, cancelled or reprioritised while
+    # queued or running; on_update is called with a job whenever its state
+    # or progress changes, from the job's own thread.
+    def __init__(self, network, max_active=2, on_update=None):
+        self.network = network
+        self.max_active = max_active
+        self.on_update = on_update
+        self.jobs = []  # Every job in submission order
+        self.by_transfer = {}  # Map transfer id to its job, for completion reports
+        self.active = 0
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        network.on_transfer_complete = self.on_transfer_complete
+
+    def submit(self, send, file_path, peers, role, sender_name, priority=0, background=False, **options):
+        # send is one of the network's send methods, or anything taking the
+        # same arguments
+        job = TransferJob(next(self.ids), send, file_path, list(peers), role, sender_name, priority, background, options)
+        with self.lock:
+            self.jobs.append(job)
+        self.notify(job)
+        self.dispatch()
+        return job
+
+    def dispatch(self):
+        started = []
+        with self.lock:
+            while self.active < self.max_active:
+                queued = [job for job in self.jobs if job.state == QUEUED]
+                if not queued:
+                    break
+                job = min(queued, key=lambda job: (job.priority, job.id))
+                job.state = RUNNING
+                job.transfer_id = self.network.new_transfer_id()
+                self.by_transfer[job.transfer_id] = job
+                self.active += 1
+                started.append(job)
+        for job in started:
+            threading.Thread(target=self.run, args=(job,), daemon=True).start()
+
+    def run(self, job):
+        job.resumed_at = time.monotonic()
+        self.notify(job)
+        try:
+            ok = job.send(job.file_path, job.recipients, job.role, job.sender_name, on_progress=lambda done, total, percentage: self.progress(job, done, total),
+                          background=job.background, transfer_id=job.transfer_id, **job.options)
+        except Exception as e:
+            ok, job.error = False, str(e)
+        job.goodput = self.network.send_goodput(job.transfer_id)
+        with self.lock:
+            job.active_time = job.elapsed()
+            job.resumed_at = None
+            job.state = CANCELLED if job.cancelled else DONE if ok else FAILED
+            if ok:
+                job.bytes_sent = job.size
+            self.active -= 1
+        self.notify(job)
+        self.dispatch()
+
+    def progress(self, job, done, total):
+        # Runs on the sending thread, which is where pausing and cancelling act
+        job.bytes_sent = int(job.size * done / total) if total else job.size
+        self.notify(job)
+        if not job.unpaused.is_set():
+            with self.lock:
+                job.active_time = job.elapsed()
+                job.resumed_at = None
+            job.unpaused.wait()
+            job.resumed_at = time.monotonic()
+        if job.cancelled:
+            raise TransferCancelled()
+
+    def pause(self, job):
+        # A paused running job gives up its slot to the next queued one
+        with self.lock:
+            if job.state not in (QUEUED, RUNNING):
+                return
+            if job.state == RUNNING:
+                self.active -= 1
+            job.unpaused.clear()
+            job.state = PAUSED
+        if job.transfer_id is not None:
+            self.network.set_paused(job.transfer_id, True)
+        self.notify(job)
+        self.dispatch()
+
+    def resume(self, job):
+        with self.lock:
+            if job.state != PAUSED:
+                return
+            if job.transfer_id is None:
+                job.state = QUEUED
+            else:
+                job.state = RUNNING
+                self.active += 1
+            job.unpaused.set()
+        if job.transfer_id is not None:
+            self.network.set_paused(job.transfer_id, False)
+        self.notify(job)
+        self.dispatch()
+
+    def cancel(self, job):
+        with self.lock:
+            if job.state in (DONE, FAILED, CANCELLED):
+                return
+            job.cancelled = True
+            if job.transfer_id is None:
+                job.state = CANCELLED  # Never started
+            elif job.state == PAUSED:
+                self.active += 1  # Its thread takes the slot back to wind down
+            job.unpaused.set()
+        if job.transfer_id is not None:
+            self.network.drop_transfer(job.transfer_id)
+        self.notify(job)
+
+    def reprioritise(self, job, priority=None, background=None):
+        # A new priority reorders the queue; background moves a running
+        # transfer to or from the background from its next chunk on
+        if priority is not None:
+            job.priority = priority
+        if background is not None:
+            job.background = background
+            if job.transfer_id is not None:
+                self.network.set_background(job.transfer_id, background)
+        self.notify(job)
+
+    def set_max_active(self, max_active):
+        self.max_active = max(1, max_active)
+        self.dispatch()
+
+    def on_transfer_complete(self, transfer_id, peer_ip):
+        job = self.by_transfer.get(transfer_id)
+        if job is not None and peer_ip in job.peers and not job.peers[peer_ip]:
+            job.peers[peer_ip] = True
+            self.notify(job)
+
+    def notify(self, job):
+        if self.on_update:
+            self.on_update(job)